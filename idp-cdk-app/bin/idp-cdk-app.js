@@ -69,10 +69,12 @@ const sfnStack = new IDPDeidStepFunctionStack(app, 'IDPDeidStepFunctionStack', {
     phiProcessOutput: lambdaStack.IDPPhiProcessOutput,
     prepRedact: lambdaStack.IDPPrepRedact,
     redactDocuments: lambdaStack.IDPRedactDocuments,
+    redactDocumentsLarge: lambdaStack.IDPRedactDocumentsLarge,
+    resumeWorkflow: lambdaStack.IDPResumeWorkflow,
+    writeSummary: lambdaStack.IDPWriteSummary,
     //Shared resources
     idpInputBucket: idpStack.IDPRootBucket,
     idpTable: backendStack.IDPDynamoTable,
-    idpSQSQueue: backendStack.IDPSQSQueue,    
     idpSNSTopic: backendStack.IDPSNSTopic,
     idpSNSRole: backendStack.IDPSNSRole
 });
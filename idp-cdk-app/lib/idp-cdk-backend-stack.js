@@ -42,14 +42,31 @@ class IDPDeidBackendStack extends Stack{
                                                     type: dynamodb.AttributeType.STRING
                                                 },
                                                 encryption: dynamodb.TableEncryption.AWS_MANAGED,
-                                                writeCapacity: 5
+                                                // Expires the content addressed cache entries (cache#<sha256> items)
+                                                timeToLiveAttribute: 'expires_at',
+                                                // A bulk submission writes two items per document (document and queue items) within
+                                                // seconds, far beyond what provisioned capacity scales to in time
+                                                billingMode: dynamodb.BillingMode.PAY_PER_REQUEST
                                             });
                                             
-        const readScaling = idpTable.autoScaleReadCapacity({minCapacity: 5, maxCapacity: 100});
-        readScaling.scaleOnUtilization({ targetUtilizationPercent: 50 });
+        /**
+         * Workflow listing index, partitioned by the UTC day of submission (submit_day) and sorted by submit_ts.
+         * Only workflow items carry submit_day so the index is sparse, and the heavy docs map is not projected.
+         */
+        idpTable.addGlobalSecondaryIndex({
+                                            indexName: 'submit_day-submit_ts-index',
+                                            partitionKey: {
+                                                name: 'submit_day',
+                                                type: dynamodb.AttributeType.STRING
+                                            },
+                                            sortKey: {
+                                                name: 'submit_ts',
+                                                type: dynamodb.AttributeType.NUMBER
+                                            },
+                                            projectionType: dynamodb.ProjectionType.INCLUDE,
+                                            nonKeyAttributes: ['status', 'de_identification_status', 'total_files', 'de_identify', 'retain_orig_docs']
+                                        });
 
-        const writeScaling = idpTable.autoScaleWriteCapacity({ minCapacity: 5, maxCapacity: 100});
-        writeScaling.scaleOnUtilization({ targetUtilizationPercent: 50 });
         this.IDPDynamoTable = idpTable;
 
         /******
@@ -164,7 +181,9 @@ class IDPDeidBackendStack extends Stack{
                                 "dynamodb:PartiQLInsert",
                                 "dynamodb:PartiQLUpdate",
                                 "dynamodb:PartiQLDelete",
-                                "dynamodb:PartiQLSelect"
+                                "dynamodb:PartiQLSelect",
+                                "dynamodb:UpdateItem",
+                                "dynamodb:DeleteItem"
                             ],
                             resources: ["*"]
                         })
@@ -180,7 +199,8 @@ class IDPDeidBackendStack extends Stack{
                                 "s3:DeleteObject",
                                 "s3:GetObject",
                                 "s3:PutObject",
-                                "s3:PutObjectAcl"
+                                "s3:PutObjectAcl",
+                                "s3:PutObjectTagging"
                             ],
                             resources: ["*"]
                         })
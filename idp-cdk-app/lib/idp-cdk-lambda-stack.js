@@ -3,6 +3,7 @@ const { S3EventSource, SnsEventSource } = require('aws-cdk-lib/aws-lambda-event-
 const iam = require('aws-cdk-lib/aws-iam');
 const s3 = require('aws-cdk-lib/aws-s3');
 const lambda = require('aws-cdk-lib/aws-lambda');
+const destinations = require('aws-cdk-lib/aws-lambda-destinations');
 const cr = require('aws-cdk-lib/custom-resources');
 const path = require('path');
 
@@ -19,11 +20,26 @@ class IDPDeidLambdaStack extends Stack{
     static IDPPhiProcessOutput;
     static IDPPrepRedact;
     static IDPRedactDocuments;    
+    static IDPRedactDocumentsLarge;
+    static IDPResumeWorkflow;
+    static IDPWriteSummary;
+    static IDPAsyncFailure;
 
     constructor(scope, id, props){
         super(scope, id, props);
         
         const inputBucketName = props.idpInputBucket.bucketName;
+        // Each function image only gets the packages its group needs (src/lambda/requirements-<group>.txt).
+        // PDF pages are rasterized with PDFium (see RasterFunctions.py), no image needs ImageMagick
+        const imageBuildArgs = {
+            core: { REQUIREMENTS: 'requirements-core.txt', IMAGEMAGICK: 'false' },
+            textract: { REQUIREMENTS: 'requirements-textract.txt', IMAGEMAGICK: 'false' },
+            redact: { REQUIREMENTS: 'requirements-redact.txt', IMAGEMAGICK: 'false' }
+        };
+        // Memory of the redaction Lambda, also used by the PHI post-processing to size the redaction Map batches.
+        // Documents estimated to need more (see MemoryFunctions.py) are redacted by the larger variant
+        const redactMemorySize = 256;
+        const redactLargeMemorySize = 3008;
 
         /**
          * Lambda as S3 trigger to invoke Step Function IDP flow
@@ -35,9 +51,12 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-init-state-machine.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             role: props.idpLambdaRole,
-            timeout: Duration.minutes(1),
+            // Writes the document and queue items of every document of the manifests of an event, tens of
+            // thousands for bulk submissions
+            timeout: Duration.minutes(15),
             memorySize: 128
         });
 
@@ -65,10 +84,11 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-init-textract.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.textract,
                     }),
             role: props.idpLambdaRole,
             timeout: Duration.minutes(5),
-            memorySize: 128
+            memorySize: 512
         });
 
         this.IDPTextractAsync = initTextractFn;
@@ -83,6 +103,7 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-get-workflows.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
@@ -138,10 +159,12 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-update-wf-status.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
-                IDP_TABLE: props.idpTable.tableName
+                IDP_TABLE: props.idpTable.tableName,
+                IDP_BKT: inputBucketName
             },
             role: props.idpLambdaRole,
             timeout: Duration.minutes(2),
@@ -159,11 +182,14 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-process-textract-output.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.textract,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
                 IDP_TABLE: props.idpTable.tableName,
-                IDP_BKT: inputBucketName
+                IDP_BKT: inputBucketName,
+                // Rule based PHI detection: off, merge (with Comprehend Medical) or skip (Comprehend Medical for covered documents)
+                PHI_RULES_MODE: 'merge'
             },
             role: props.idpLambdaRole,
             timeout: Duration.minutes(10),
@@ -182,10 +208,11 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-init-textract-bulk.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.textract,
                     }),
             role: props.idpLambdaRole,
             timeout: Duration.minutes(10),
-            memorySize: 128
+            memorySize: 512
         });
 
         this.IDPTextractAsyncBulk = initTextractBulkFn;
@@ -202,11 +229,16 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-init-phi-detection.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
                 IAM_ROLE: props.compMedDataRole.roleArn,
-                IDP_TABLE: props.idpTable.tableName
+                IDP_TABLE: props.idpTable.tableName,
+                // PHI input is split into shards (one Comprehend Medical job each) above these limits
+                PHI_SHARD_MAX_FILES: '5000',
+                PHI_SHARD_MAX_BYTES: `${500*1024*1024}`,
+                PHI_MAX_SHARDS: '10'
             },
             role: props.idpLambdaRole,
             timeout: Duration.minutes(10),
@@ -225,6 +257,7 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-phi-job-status-check.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
@@ -247,10 +280,14 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-process-phi-output.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG',
-                IDP_TABLE: props.idpTable.tableName
+                IDP_TABLE: props.idpTable.tableName,
+                // Cost (pages + source size) of the documents each redaction Map iteration gets
+                REDACT_BRANCH_COST: '200',
+                REDACT_MEMORY_MB: `${redactMemorySize}`
             },
             role: props.idpLambdaRole,
             timeout: Duration.minutes(10),
@@ -270,6 +307,7 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-prep-doc-for-redaction.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
                     }),
             environment:{
                 LOG_LEVEL: 'DEBUG'
@@ -291,16 +329,146 @@ class IDPDeidLambdaStack extends Stack{
             code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
                         cmd: [ "idp-phi-redact-doc.lambda_handler" ],
                         entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.redact,
                     }),
             environment:{
-                LOG_LEVEL: 'DEBUG'
+                LOG_LEVEL: 'DEBUG',
+                IDP_TABLE: props.idpTable.tableName,
+                RASTERIZER: 'pdfium',
+                RASTER_MIN_DPI: '100',
+                RASTER_MAX_DPI: '300',
+                RASTER_MIN_BOX_PX: '10',
+                // Default encoding of redacted documents for workflows submitted without a profile
+                ENCODING_PROFILE: 'auto',
+                ENCODING_JPEG_QUALITY: '75',
+                REDACT_DEFER_OVERSIZED: 'true'
             },
             role: props.idpLambdaRole,
             timeout: Duration.minutes(15),
-            memorySize: 256
+            memorySize: redactMemorySize
         });
 
         this.IDPRedactDocuments = idpRedactDocuments;
+
+        /**
+         * Larger memory variant of the redaction function for the documents the redaction function defers.
+         * It does not defer, documents estimated to exceed even its memory are rasterized at a lower DPI
+         */
+
+         const idpRedactDocumentsLarge = new lambda.DockerImageFunction(this, 'idp-poc-redact-documents-large', {
+            functionName: 'idp-poc-redact-documents-large',
+            description: 'IDP Lambda function that redacts the documents too large for the redaction function',
+            code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
+                        cmd: [ "idp-phi-redact-doc.lambda_handler" ],
+                        entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.redact,
+                    }),
+            environment:{
+                LOG_LEVEL: 'DEBUG',
+                IDP_TABLE: props.idpTable.tableName,
+                RASTERIZER: 'pdfium',
+                RASTER_MIN_DPI: '100',
+                RASTER_MAX_DPI: '300',
+                RASTER_MIN_BOX_PX: '10',
+                ENCODING_PROFILE: 'auto',
+                ENCODING_JPEG_QUALITY: '75',
+                REDACT_DEFER_OVERSIZED: 'false'
+            },
+            role: props.idpLambdaRole,
+            timeout: Duration.minutes(15),
+            memorySize: redactLargeMemorySize
+        });
+
+        this.IDPRedactDocumentsLarge = idpRedactDocumentsLarge;
+
+        // Streaming pipeline mode: the Textract post-processing starts the redaction of each document, which hands
+        // the documents it defers to the larger variant (see src/lambda/PipelineFunctions.py)
+        idpProcessTextractOpFn.addEnvironment('PIPELINE_MODE', 'staged');
+        idpProcessTextractOpFn.addEnvironment('LAMBDA_REDACT', idpRedactDocuments.functionName);
+        idpRedactDocuments.addEnvironment('LAMBDA_REDACT_LARGE', idpRedactDocumentsLarge.functionName);
+
+        /**
+         * On-failure destination of the asynchronous invocations of the pipeline, it completes the documents
+         * of an invocation that failed every attempt so that the workflow does not wait for them
+         */
+
+         const idpAsyncFailure = new lambda.DockerImageFunction(this, 'idp-poc-async-failure', {
+            functionName: 'idp-poc-async-failure',
+            description: 'IDP Lambda function that completes the documents of failed asynchronous invocations',
+            code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
+                        cmd: [ "idp-async-failure.lambda_handler" ],
+                        entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
+                    }),
+            environment:{
+                LOG_LEVEL: 'DEBUG',
+                IDP_TABLE: props.idpTable.tableName,
+                IDP_BKT: inputBucketName
+            },
+            role: props.idpLambdaRole,
+            timeout: Duration.minutes(2),
+            memorySize: 128
+        });
+
+        this.IDPAsyncFailure = idpAsyncFailure;
+
+        // Streamed redactions are started asynchronously (see src/lambda/PipelineFunctions.py), one that fails
+        // every attempt leaves its documents to the redaction Map
+        for (const redactFn of [idpRedactDocuments, idpRedactDocumentsLarge]) {
+            redactFn.configureAsyncInvoke({
+                onFailure: new destinations.LambdaDestination(idpAsyncFailure),
+                retryAttempts: 1
+            });
+        }
+
+        // The Textract post-processing is invoked asynchronously and writes the temp processing file of its
+        // document, one that crashes or times out on every attempt would never count the document
+        idpProcessTextractOpFn.configureAsyncInvoke({
+            onFailure: new destinations.LambdaDestination(idpAsyncFailure)
+        });
+
+        /**
+         * Lambda function to write the de-identification summary read by the workflow detail API
+         */
+
+         const idpWriteSummary = new lambda.DockerImageFunction(this, 'idp-poc-write-wf-summary', {
+            functionName: 'idp-poc-write-wf-summary',
+            description: 'IDP Lambda function to write the de-identification summary of a workflow once redaction finished',
+            code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
+                        cmd: [ "idp-write-wf-summary.lambda_handler" ],
+                        entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
+                    }),
+            environment:{
+                LOG_LEVEL: 'DEBUG',
+                IDP_TABLE: props.idpTable.tableName
+            },
+            role: props.idpLambdaRole,
+            timeout: Duration.minutes(5),
+            memorySize: 256
+        });
+
+        this.IDPWriteSummary = idpWriteSummary;
+
+        /**
+         * Lambda function to resume a failed workflow from its per-document stage checkpoints.
+         * Environment variables are set by the Step Functions stack since they need the state machine ARN
+         */
+
+         const idpResumeWorkflow = new lambda.DockerImageFunction(this, 'idp-poc-resume-workflow', {
+            functionName: 'idp-poc-resume-workflow',
+            description: 'IDP Lambda function to restart a workflow and re-run only the incomplete stages of incomplete documents',
+            code: lambda.DockerImageCode.fromImageAsset(path.join(__dirname, '../src/lambda'), {
+                        cmd: [ "idp-resume-workflow.lambda_handler" ],
+                        entrypoint: ["/lambda-entrypoint.sh"],
+                        buildArgs: imageBuildArgs.core,
+                    }),
+            role: props.idpLambdaRole,
+            timeout: Duration.minutes(5),
+            memorySize: 128
+        });
+
+        this.IDPResumeWorkflow = idpResumeWorkflow;
         
     }
 }
@@ -1,7 +1,7 @@
 // Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 // SPDX-License-Identifier: MIT-0
 
-const { Stack } = require('aws-cdk-lib');
+const { Stack, Duration } = require('aws-cdk-lib');
 const sfn = require('aws-cdk-lib/aws-stepfunctions');
 const cr = require('aws-cdk-lib/custom-resources');
 const tasks = require('aws-cdk-lib/aws-stepfunctions-tasks');
@@ -29,7 +29,10 @@ class IDPDeidStepFunctionStack extends Stack{
               workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
               bucket: sfn.JsonPath.stringAt('$.bucket')
           }),
-          outputPath: '$.Payload',                                            
+          outputPath: '$.Payload',
+          // Documents whose asynchronous processing fails are completed by idp-poc-async-failure, the timeout only
+          // bounds the wait on anything else. A timed out workflow can be resumed (idp-resume-workflow)
+          taskTimeout: sfn.Timeout.duration(Duration.hours(48)),
         });
 
         const idpTextractAsyncStatusUpdateStep = new tasks.LambdaInvoke(this, "idp-update-workflow-status", {
@@ -51,7 +54,9 @@ class IDPDeidStepFunctionStack extends Stack{
             workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
             bucket: sfn.JsonPath.stringAt('$.bucket'),
             de_identify: sfn.JsonPath.stringAt('$.de_identify'),
-            phi_input_dir: sfn.JsonPath.stringAt('$.phi_input_dir')
+            phi_input_dir: sfn.JsonPath.stringAt('$.phi_input_dir'),
+            // Retried invocations of an execution start each shard job once (ClientRequestToken)
+            execution: sfn.JsonPath.stringAt('$$.Execution.Name')
           }),
           outputPath: '$.Payload'
         });
@@ -62,6 +67,7 @@ class IDPDeidStepFunctionStack extends Stack{
           payload: sfn.TaskInput.fromObject({                                              
             workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
             phi_job_id: sfn.JsonPath.stringAt('$.phi_job_id'),
+            phi_job_ids: sfn.JsonPath.listAt('$.phi_job_ids'),
             phi_output_dir: sfn.JsonPath.stringAt('$.phi_output_dir'),
             bucket: sfn.JsonPath.stringAt('$.bucket')
           }),
@@ -87,6 +93,7 @@ class IDPDeidStepFunctionStack extends Stack{
             bucket: sfn.JsonPath.stringAt('$.bucket'),
             workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
             retain_docs: sfn.JsonPath.stringAt('$.retain_docs'),
+            encoding_profile: sfn.JsonPath.stringAt('$.encoding_profile'),
             doc_prefixes: sfn.JsonPath.stringAt('$.doc_prefixes'),
           }),
           outputPath: '$.Payload'
@@ -100,11 +107,41 @@ class IDPDeidStepFunctionStack extends Stack{
             bucket: sfn.JsonPath.stringAt('$.bucket'),
             workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
             retain_docs: sfn.JsonPath.stringAt('$.retain_docs'),
+            encoding_profile: sfn.JsonPath.stringAt('$.encoding_profile'),
             redact_data: sfn.JsonPath.stringAt('$.redact_data'),
           }),
+          // Keeps the state input for the larger variant, which redacts the documents this function deferred
+          resultSelector: {
+            'deferred': sfn.JsonPath.stringAt('$.Payload.deferred')
+          },
+          resultPath: '$.redacted'
+        });
+
+        //redactDocumentsLarge, documents estimated to exceed the memory of redactDocuments
+        const redactDocumentsLarge = new tasks.LambdaInvoke(this, "idp-redact-documents-large", {
+          comment: "idp-redact-documents-large",
+          lambdaFunction: props.redactDocumentsLarge,
+          payload: sfn.TaskInput.fromObject({
+            bucket: sfn.JsonPath.stringAt('$.bucket'),
+            workflow_id: sfn.JsonPath.stringAt('$.workflow_id'),
+            retain_docs: sfn.JsonPath.stringAt('$.retain_docs'),
+            encoding_profile: sfn.JsonPath.stringAt('$.encoding_profile'),
+            redact_data: sfn.JsonPath.stringAt('$.redacted.deferred'),
+          }),
           outputPath: '$.Payload'
         });
 
+        const writeSummary = new tasks.LambdaInvoke(this, "idp-write-workflow-summary", {
+          comment: "idp-write-workflow-summary",
+          lambdaFunction: props.writeSummary,
+          payload: sfn.TaskInput.fromObject({
+            bucket: sfn.JsonPath.stringAt('$.bucket'),
+            workflow_id: sfn.JsonPath.stringAt('$.workflow_id')
+          }),
+          // Keeps the state input for phiStatusUpdate
+          resultPath: sfn.JsonPath.DISCARD
+        });
+
         const phiStatusUpdate = new tasks.DynamoUpdateItem(this, 'idp-phi-status-finalize', {                    
           key:{
             part_key: tasks.DynamoAttributeValue.fromString(sfn.JsonPath.stringAt('$.workflow_id')),
@@ -142,7 +179,10 @@ class IDPDeidStepFunctionStack extends Stack{
          * Step Functions flow definitions
          */
         const redactionChain = sfn.Chain.start(prepRedactDocuments)
-                               .next(redactDocuments);
+                               .next(redactDocuments)
+                               .next(new sfn.Choice(this, "Documents deferred?")
+                                     .when(sfn.Condition.isPresent('$.redacted.deferred[0]'), redactDocumentsLarge)
+                                     .otherwise(new sfn.Pass(this, "redaction-done")));
 
         const redactMap = new sfn.Map(this, 'redact-documents', {
                                                   inputPath: sfn.JsonPath.stringAt('$'),
@@ -150,6 +190,7 @@ class IDPDeidStepFunctionStack extends Stack{
                                                   parameters:{
                                                     "workflow_id": sfn.JsonPath.stringAt('$.workflow_id'),
                                                     "retain_docs": sfn.JsonPath.stringAt('$.retain_docs'),
+                                                    "encoding_profile": sfn.JsonPath.stringAt('$.encoding_profile'),
                                                     "bucket": sfn.JsonPath.stringAt('$.bucket'),
                                                     "doc_prefixes": sfn.JsonPath.stringAt("$$.Map.Item.Value")                                                    
                                                   },
@@ -159,6 +200,7 @@ class IDPDeidStepFunctionStack extends Stack{
         redactMap.iterator(redactionChain);
 
         const redactMapChain = sfn.Chain.start(redactMap)
+                               .next(writeSummary)
                                .next(phiStatusUpdate)
                                .next(finalStep);
 
@@ -180,7 +222,7 @@ class IDPDeidStepFunctionStack extends Stack{
 
         const phiProcessChain = sfn.Chain.start(phiDetectionStep)
                                 .next(new sfn.Choice(this, "Job launched successfully?")
-                                      .when(sfn.Condition.isNull('$.phi_job_id'),
+                                      .when(sfn.Condition.isPresent('$.error'),
                                             phiJobLaunchFail)
                                       .otherwise(phiStatusCheckChain));
                                   
@@ -220,7 +262,6 @@ class IDPDeidStepFunctionStack extends Stack{
               Environment: {
                 Variables: {
                     LOG_LEVEL: 'DEBUG',
-                    IDP_QUEUE: props.idpSQSQueue,
                     IDP_TABLE: props.idpTable.tableName,
                     STATE_MACHINE: idpStateMachine.stateMachineArn,
                 },
@@ -246,11 +287,16 @@ class IDPDeidStepFunctionStack extends Stack{
               Environment: {
                 Variables: {
                     LOG_LEVEL: 'DEBUG',
-                    IDP_QUEUE: props.idpSQSQueue,
+                    SCHEDULER_WEIGHTS: 'urgent:8,standard:2,bulk:1',
+                    TEXTRACT_PROFILE: 'analysis',
+                    PHI_RULES_MODE: 'merge',
                     IDP_TABLE: props.idpTable.tableName,
                     IDP_INPUT_BKT: inputBucketName,
                     SNS_TOPIC: props.idpSNSTopic.topicArn,
-                    SNS_ROLE: props.idpSNSRole.roleArn
+                    SNS_ROLE: props.idpSNSRole.roleArn,
+                    LAMBDA_POST_PROCESS: props.processTextractOp.functionName,
+                    TEXTRACT_SPLIT_PAGES: '200',
+                    TEXTRACT_PART_PAGES: '100'
                 },
               },
             },
@@ -275,12 +321,16 @@ class IDPDeidStepFunctionStack extends Stack{
             Environment: {
               Variables: {
                   LOG_LEVEL: 'DEBUG',
-                  IDP_QUEUE: props.idpSQSQueue,
+                  SCHEDULER_WEIGHTS: 'urgent:8,standard:2,bulk:1',
+                  TEXTRACT_PROFILE: 'analysis',
+                  PHI_RULES_MODE: 'merge',
                   IDP_TABLE: props.idpTable.tableName,
                   IDP_INPUT_BKT: inputBucketName,
                   SNS_TOPIC: props.idpSNSTopic.topicArn,
                   SNS_ROLE: props.idpSNSRole.roleArn,
-                  LAMBDA_POST_PROCESS: props.processTextractOp.functionName
+                  LAMBDA_POST_PROCESS: props.processTextractOp.functionName,
+                  TEXTRACT_SPLIT_PAGES: '200',
+                  TEXTRACT_PART_PAGES: '100'
               },
             },
           },
@@ -294,6 +344,33 @@ class IDPDeidStepFunctionStack extends Stack{
               installLatestAwsSdk: true
       });
 
+      /**
+       * Update Resume Workflow Lambda Function environment variables
+       */
+      const sdkActionResume = {
+        service: 'Lambda',
+        action: 'updateFunctionConfiguration',
+        parameters: {
+          FunctionName: props.resumeWorkflow.functionArn,
+          Environment: {
+            Variables: {
+                LOG_LEVEL: 'DEBUG',
+                IDP_TABLE: props.idpTable.tableName,
+                IDP_BKT: inputBucketName,
+                STATE_MACHINE: idpStateMachine.stateMachineArn
+            },
+          },
+        },
+        physicalResourceId: cr.PhysicalResourceId.of(`lambda-resumeWorkflow-update`),
+      };
+
+      new cr.AwsCustomResource(this, 'update-resume-lambda-environ', {
+              onCreate: sdkActionResume,
+              onUpdate: sdkActionResume,
+              policy: physicalResourcePolicy,
+              installLatestAwsSdk: true
+      });
+
       /**
        * Update Textract Async bulk Lambda with invoke Function permission
        */
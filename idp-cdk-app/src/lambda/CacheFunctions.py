@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Content addressed cache of pipeline artifacts. Entries are kept in the workflow DynamoDB table under
+part_key cache#<sha256 of the source document> and sort_key <CACHE_VERSION>#<textract features>, so that a
+change of feature types or a CACHE_VERSION bump never returns stale artifacts. Entries hold S3 keys of the
+Textract JSON, Excel report, PHI input text, Comprehend Medical output and redacted document of the first
+workflow that processed the document, and expire CACHE_TTL_DAYS after they were last written (DynamoDB TTL
+on expires_at). Each document of a workflow gets an item under part_key <workflow_id>, sort_key doc/<name>
+holding the digest of its content and the key of its entry (cache_version), so that later stages can find the
+cache entry without re-reading the document or knowing the features it was analyzed with.
+"""
+
+import hashlib
+import logging
+import os
+import time
+from DDBFunctions import DDB
+from MetricsFunctions import put_metric
+from RetryFunctions import retrying_client
+
+s3 = retrying_client('s3')
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_VERSION = os.environ.get('CACHE_VERSION', 'v1')
+CACHE_TTL_DAYS = int(os.environ.get('CACHE_TTL_DAYS', '30'))
+
+class DocumentCache:
+    def __init__(self, table: str, features: str = 'TABLES,FORMS', log_level: str = 'INFO'):
+        self.ddb = DDB(table=table, log_level=log_level)
+        self.version = f"{CACHE_VERSION}#{features}"
+        self.enabled = CACHE_ENABLED
+        logger.setLevel(log_level)
+
+    def digest(self, bucket: str, key: str) -> str:
+        """Returns the SHA-256 of an S3 object, read in 1MB chunks
+        """
+        try:
+            logger.info(f"Attempting to compute digest of object: {key} in bucket: {bucket}")
+            sha = hashlib.sha256()
+            body = s3.get_object(Bucket=bucket, Key=key)['Body']
+            for chunk in iter(lambda: body.read(1024*1024), b''):
+                sha.update(chunk)
+            return sha.hexdigest()
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def digest_file(self, path: str) -> str:
+        """Returns the SHA-256 of a local file, read in 1MB chunks
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as local_file:
+            for chunk in iter(lambda: local_file.read(1024*1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def lookup(self, digest: str, stage: str) -> dict:
+        """Returns the cache entry of a document digest, None on a miss or an expired entry. DynamoDB TTL
+        deletes expired items lazily so expiry is checked here as well
+        """
+        if not self.enabled or not digest:
+            return None
+        try:
+            logger.info(f"Looking up cache entry for digest: {digest}, version: {self.version}")
+            entry = self.ddb.get_item(part_key=f"cache#{digest}", sort_key=self.version)
+            if entry and int(entry.get('expires_at', 0)) < time.time():
+                entry = None
+            put_metric(name='CacheHit' if entry else 'CacheMiss', dimensions={'Stage': stage})
+            logger.debug(entry)
+            return entry
+        except Exception as e:
+            # The cache is an optimization, never fail the document because of it
+            logger.error(e)
+            return None
+
+    def put(self, digest: str, **pointers) -> bool:
+        """Records the S3 keys of artifacts of a document (textract_json, report, phi_text, comp_med,
+        redacted_doc) and extends the expiry of the entry
+        """
+        if not self.enabled or not digest:
+            return False
+        try:
+            logger.info(f"Updating cache entry for digest: {digest} with {list(pointers.keys())}")
+            pointers['expires_at'] = int(time.time()) + CACHE_TTL_DAYS*24*60*60
+            return self.ddb.upsert_item(part_key=f"cache#{digest}", sort_key=self.version, attributes=pointers)
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def record_document(self, workflow_id: str, document: str, digest: str) -> bool:
+        try:
+            logger.info(f"Recording digest of document: {document} in workflow: {workflow_id}")
+            return self.ddb.upsert_item(part_key=workflow_id, sort_key=f"doc/{document}", attributes={'sha256': digest, 'cache_version': self.version})
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def document_digest(self, workflow_id: str, document: str) -> str:
+        """Returns the digest recorded for a document, the cache then uses the entry of the features the
+        document was analyzed with
+        """
+        if not self.enabled:
+            return None
+        try:
+            item = self.ddb.get_item(part_key=workflow_id, sort_key=f"doc/{document}")
+            if item and item.get('cache_version'):
+                self.version = item['cache_version']
+            return item.get('sha256') if item else None
+        except Exception as e:
+            logger.error(e)
+            return None
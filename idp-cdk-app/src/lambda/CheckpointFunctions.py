@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Per-document progress through the pipeline stages. Each stage a document completes is recorded as a
+stage_<name> timestamp (epoch milliseconds) on the document item (part_key <workflow_id>, sort_key doc/<name>)
+so that idp-resume-workflow can re-run only the incomplete stages of the incomplete documents.
+    ocr      - Amazon Textract job succeeded (job_id holds the Textract JobId)
+    text     - Textract JSON, Excel report and PHI input text written
+    phi      - Amazon Comprehend Medical PHI entities moved to the workflow output
+    redacted - Redacted document written to the workflow output
+"""
+
+import logging
+import math
+import time
+from DDBFunctions import DDB
+from RetryFunctions import retrying_client
+
+ddb = retrying_client('dynamodb')
+logger = logging.getLogger(__name__)
+
+STAGES = ['ocr', 'text', 'phi', 'redacted']
+
+# Workflow timeline. Stages record when documents start them as well (start_<stage>, see start() and the started
+# argument of record()), and the state machine steps record their first start and last end on the workflow item
+# (step_<name>_start, step_<name>_end, see record_step()). timeline() turns them into the start, end and
+# document latencies of every stage, the latency of a document in a stage being measured from
+#     queue    workflow submit_ts           to start_ocr (wait in the workflow queue, see SchedulerFunctions)
+#     ocr      start_ocr                    to stage_ocr
+#     text     start_text                   to stage_text
+#     phi      stage_text                   to stage_phi (PHI detection job and its post-processing)
+#     redacted start_redacted               to stage_redacted
+DOCUMENT_STAGES = {'queue': ('submit_ts', 'start_ocr'), 'ocr': ('start_ocr', 'stage_ocr'), 'text': ('start_text', 'stage_text'),
+                   'phi': ('stage_text', 'stage_phi'), 'redacted': ('start_redacted', 'stage_redacted')}
+STEPS = ['init_textract', 'update_status', 'phi_init', 'phi_check', 'phi_output', 'redact']
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def percentile(values: list, pct: float) -> int:
+    """Nearest-rank percentile of a list of numbers
+    """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)] if ordered else None
+
+def timeline(workflow: dict, documents: list) -> dict:
+    """Returns the stages of a workflow with their start, end and duration, the p50 and p95 document latency
+    of the document stages, and the throughput in documents per minute from submit to the last end.
+    workflow is the workflow item, documents its document items
+    """
+    submit_ts = int(workflow.get('submit_ts', 0))
+    stages, latency = {}, {}
+    for stage, (start_name, end_name) in DOCUMENT_STAGES.items():
+        durations, starts, ends = [], [], []
+        for item in documents:
+            start = submit_ts if start_name == 'submit_ts' else item.get(start_name)
+            end = item.get(end_name)
+            if start and end:
+                durations.append(int(end) - int(start))
+                starts.append(int(start))
+                ends.append(int(end))
+        if durations:
+            stages[stage] = dict(start=min(starts), end=max(ends), duration_ms=max(ends) - min(starts))
+            latency[stage] = dict(count=len(durations), p50_ms=percentile(durations, 50), p95_ms=percentile(durations, 95), max_ms=max(durations))
+    for step in STEPS:
+        start, end = workflow.get(f"step_{step}_start"), workflow.get(f"step_{step}_end")
+        if start and end:
+            stages[step] = dict(start=int(start), end=int(end), duration_ms=int(end) - int(start))
+
+    completed = [item for item in documents if item.get('stage_redacted' if workflow.get('de_identify') else 'stage_text')]
+    last_end = max([stage['end'] for stage in stages.values()], default=0)
+    minutes = (last_end - submit_ts) / 60000 if submit_ts and last_end > submit_ts else 0
+    return dict(submit_ts=submit_ts, stages=dict(sorted(stages.items(), key=lambda stage: stage[1]['start'])), latency=latency,
+                throughput=dict(documents=len(completed), elapsed_ms=int(minutes * 60000), docs_per_minute=round(len(completed) / minutes, 2) if minutes else None))
+
+class Checkpoints:
+    def __init__(self, table: str, log_level: str = 'INFO'):
+        self.ddb = DDB(table=table, log_level=log_level)
+        logger.setLevel(log_level)
+
+    def record(self, workflow_id: str, document: str, stage: str, started: int = None, **attributes) -> bool:
+        """Records that a document completed a stage, and when it started the stage (epoch milliseconds) when
+        known. Checkpoints never fail the document
+        """
+        try:
+            logger.info(f"Checkpoint {stage} for document: {document} in workflow: {workflow_id}")
+            attributes[f"stage_{stage}"] = now_ms()
+            if started:
+                attributes[f"start_{stage}"] = started
+            return self.ddb.upsert_item(part_key=workflow_id, sort_key=f"doc/{document}", attributes=attributes)
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def start(self, workflow_id: str, document: str, stage: str) -> bool:
+        """Records that a document started a stage completed by another invocation
+        """
+        try:
+            return self.ddb.upsert_item(part_key=workflow_id, sort_key=f"doc/{document}", attributes={f"start_{stage}": now_ms()})
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def record_step(self, workflow_id: str, step: str, started: int) -> bool:
+        """Records the timing of a state machine step on the workflow item. The start of the first invocation is
+        kept, steps invoked several times (status polling, one redaction per Map branch) extend the end
+        """
+        try:
+            logger.debug(f"Step {step} of workflow: {workflow_id} took {now_ms() - started}ms")
+            ddb.update_item(TableName=self.ddb.table, Key={'part_key': {'S': workflow_id}, 'sort_key': {'S': f"input/{workflow_id}/"}},
+                            UpdateExpression=f"SET step_{step}_start = if_not_exists(step_{step}_start, :start), step_{step}_end = :end",
+                            ExpressionAttributeValues={':start': {'N': str(started)}, ':end': {'N': str(now_ms())}})
+            return True
+        except Exception as e:
+            logger.error(e)
+            return False
+
+    def get_documents(self, workflow_id: str) -> dict:
+        """Returns the document items of a workflow keyed by document name
+        """
+        items = self.ddb.query_items(part_key=workflow_id, sort_key_prefix="doc/")
+        return {item['sort_key'][len("doc/"):]: item for item in items}
+
+    @staticmethod
+    def completed(item: dict, stage: str) -> bool:
+        return f"stage_{stage}" in item if item else False
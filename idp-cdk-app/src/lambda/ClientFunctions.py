@@ -0,0 +1,91 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Shared pool of AWS clients. Clients are created on first use instead of at import time, so that a cold start
+only pays for the clients the invocation actually calls, and are cached per service and configuration so
+that every module of a function shares the same client and its connection pool. Modules keep declaring their
+clients at module level, e.g.
+    s3 = LazyClient('s3')
+and use them as boto3 clients.
+
+Connection settings come from the environment:
+    CLIENT_POOL_SIZE            connections kept per client (botocore defaults to 10), CLIENT_POOL_SIZE_<SERVICE>
+                                overrides it for one service, e.g. CLIENT_POOL_SIZE_S3
+    CLIENT_TCP_KEEPALIVE        TCP keep-alive on pooled connections
+    CLIENT_CONNECT_TIMEOUT      seconds
+    CLIENT_READ_TIMEOUT         seconds
+"""
+
+import boto3
+import logging
+import os
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+CLIENT_POOL_SIZE = int(os.environ.get('CLIENT_POOL_SIZE', '32'))
+# The S3 paths copy, move and read objects from thread pools of up to 16 workers
+SERVICE_POOL_SIZES = {'s3': 64}
+CLIENT_TCP_KEEPALIVE = os.environ.get('CLIENT_TCP_KEEPALIVE', 'true').lower() == 'true'
+CLIENT_CONNECT_TIMEOUT = int(os.environ.get('CLIENT_CONNECT_TIMEOUT', '10'))
+CLIENT_READ_TIMEOUT = int(os.environ.get('CLIENT_READ_TIMEOUT', '60'))
+
+_clients = {}
+
+def pool_size(service: str) -> int:
+    return int(os.environ.get(f"CLIENT_POOL_SIZE_{service.upper()}", SERVICE_POOL_SIZES.get(service, CLIENT_POOL_SIZE)))
+
+def client_config(service: str, config: Config = None) -> Config:
+    """Returns the shared connection settings of a service merged with the settings of the caller, which win
+    """
+    options = dict(max_pool_connections=pool_size(service),
+                   connect_timeout=CLIENT_CONNECT_TIMEOUT,
+                   read_timeout=CLIENT_READ_TIMEOUT)
+    # tcp_keepalive is only known to botocore releases newer than the one pinned with boto3 in requirements-core.txt
+    if 'tcp_keepalive' in getattr(Config, 'OPTION_DEFAULTS', {}):
+        options['tcp_keepalive'] = CLIENT_TCP_KEEPALIVE
+    shared = Config(**options)
+    return shared.merge(config) if config else shared
+
+def get_client(service: str, resource: bool = False, config: Config = None):
+    """Returns the cached client (or resource) of a service for a configuration, creating it on first use
+    """
+    key = (service, resource, repr(sorted(vars(config).items())) if config else None)
+    if key not in _clients:
+        logger.debug(f"Creating {'resource' if resource else 'client'} for {service}")
+        factory = boto3.resource if resource else boto3.client
+        _clients[key] = factory(service, config=client_config(service, config))
+    return _clients[key]
+
+def connection_stats() -> dict:
+    """Returns, per client, the requests sent and the connections opened by its connection pools. Requests over
+    connections is the reuse ratio, a ratio close to 1 means connections are not reused
+    """
+    stats = {}
+    for (service, resource, config), client in _clients.items():
+        client = client.meta.client if resource else client
+        requests, connections = 0, 0
+        try:
+            # botocore keeps its urllib3 PoolManager on the endpoint's http session
+            manager = client._endpoint.http_session._manager
+            for pool_key in manager.pools.keys():
+                pool = manager.pools[pool_key]
+                requests += pool.num_requests
+                connections += pool.num_connections
+        except Exception as e:
+            logger.debug(f"No connection statistics for {service}: {e}")
+            continue
+        name = f"{service}{'-resource' if resource else ''}{'-custom' if config else ''}"
+        stats[name] = dict(requests=requests, connections=connections, pool_size=pool_size(service),
+                           reuse_ratio=round(requests / connections, 2) if connections else None)
+    return stats
+
+class LazyClient:
+    def __init__(self, service: str, resource: bool = False, config: Config = None):
+        self._service = service
+        self._resource = resource
+        self._config = config
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service, resource=self._resource, config=self._config), name)
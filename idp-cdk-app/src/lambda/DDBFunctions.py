@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from ClientFunctions import LazyClient
+from RetryFunctions import NO_RETRY_CONFIG, call, retrying_client
+
+ddb = retrying_client('dynamodb')
+# batch_execute retries the throttled statements of a batch through RetryFunctions.call itself
+batch_ddb = LazyClient('dynamodb', config=NO_RETRY_CONFIG)
+deserializer = TypeDeserializer()
+serializer = TypeSerializer()
+logger = logging.getLogger(__name__)
+
+BATCH_RETRY_CODES = ['ThrottlingError', 'ProvisionedThroughputExceeded', 'RequestLimitExceeded']
+
+class BatchThrottled(ClientError):
+    """Statements of a batch failed with one of BATCH_RETRY_CODES, retried by RetryFunctions.call like a throttled call
+    """
+    pass
+
+class DDB:
+    def __init__(self, table: str, log_level: str = 'INFO'):
+        self.table = table
+        logger.setLevel(log_level)
+
+    def get_item(self, part_key: str, sort_key: str) -> dict:
+        try:
+            logger.debug(f"Attempting to get item part_key: {part_key}, sort_key: {sort_key} from table: {self.table}")
+            stmt = f"SELECT * FROM \"{self.table}\" WHERE part_key=? AND sort_key=?"
+            ddb_response = ddb.execute_statement(Statement=stmt, Parameters=[{'S': part_key}, {'S': sort_key}])
+            if not ddb_response['Items']:
+                return None
+            return {k: deserializer.deserialize(v) for k, v in ddb_response['Items'][0].items()}
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def upsert_item(self, part_key: str, sort_key: str, attributes: dict) -> bool:
+        """PartiQL INSERT fails on an existing item and UPDATE fails on a missing one, so INSERT first and fall
+        back to UPDATE of the given attributes
+        """
+        try:
+            logger.debug(f"Attempting to upsert item part_key: {part_key}, sort_key: {sort_key} in table: {self.table}")
+            try:
+                values = ", ".join([f"'{name}': ?" for name in attributes.keys()])
+                stmt = f"INSERT INTO \"{self.table}\" VALUE {{'part_key': ?, 'sort_key': ?, {values}}}"
+                ddb.execute_statement(Statement=stmt, Parameters=[{'S': part_key}, {'S': sort_key}] + [serializer.serialize(v) for v in attributes.values()])
+            except ddb.exceptions.DuplicateItemException:
+                sets = " ".join([f"SET {name}=?" for name in attributes.keys()])
+                stmt = f"UPDATE \"{self.table}\" {sets} WHERE part_key=? AND sort_key=?"
+                ddb.execute_statement(Statement=stmt, Parameters=[serializer.serialize(v) for v in attributes.values()] + [{'S': part_key}, {'S': sort_key}])
+            return True
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def query_items(self, part_key: str, sort_key_prefix: str = None) -> list:
+        """Returns every item of a partition, optionally limited to sort keys starting with sort_key_prefix,
+        following NextToken through all the result pages
+        """
+        try:
+            logger.debug(f"Attempting to query part_key: {part_key}, sort_key prefix: {sort_key_prefix} in table: {self.table}")
+            if sort_key_prefix:
+                stmt = f"SELECT * FROM \"{self.table}\" WHERE part_key=? AND begins_with(sort_key, ?)"
+                params = [{'S': part_key}, {'S': sort_key_prefix}]
+            else:
+                stmt = f"SELECT * FROM \"{self.table}\" WHERE part_key=?"
+                params = [{'S': part_key}]
+
+            items, next_token = [], None
+            while True:
+                if next_token:
+                    ddb_response = ddb.execute_statement(Statement=stmt, Parameters=params, NextToken=next_token)
+                else:
+                    ddb_response = ddb.execute_statement(Statement=stmt, Parameters=params)
+                items.extend([{k: deserializer.deserialize(v) for k, v in item.items()} for item in ddb_response['Items']])
+                next_token = ddb_response.get('NextToken')
+                if not next_token:
+                    break
+            return items
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def query_page(self, part_key: str, sort_key_prefix: str, limit: int, next_token: str = None) -> tuple:
+        """Returns one page of at most limit items of a partition whose sort keys start with sort_key_prefix and
+        the NextToken of the next page, None on the last page
+        """
+        try:
+            logger.debug(f"Attempting to query a page of {limit} items of part_key: {part_key}, sort_key prefix: {sort_key_prefix} in table: {self.table}")
+            params = dict(Statement=f"SELECT * FROM \"{self.table}\" WHERE part_key=? AND begins_with(sort_key, ?)",
+                          Parameters=[{'S': part_key}, {'S': sort_key_prefix}], Limit=limit)
+            if next_token:
+                params['NextToken'] = next_token
+            ddb_response = ddb.execute_statement(**params)
+            return [{k: deserializer.deserialize(v) for k, v in item.items()} for item in ddb_response['Items']], ddb_response.get('NextToken')
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def batch_execute(self, statement: str, parameters: list, batch_size: int = 25) -> list:
+        """Runs one PartiQL statement for each parameter list with BatchExecuteStatement, batch_size (at most 25)
+        statements per call. Throttled statements are retried with the backoff and time budget of RetryFunctions,
+        returns the errors of the statements that failed
+        """
+        try:
+            logger.debug(f"Attempting batch of {len(parameters)} statements on table: {self.table}")
+            errors = []
+            for idx in range(0, len(parameters), batch_size):
+                # Statements still to run with the error of their last attempt
+                pending = [(params, None) for params in parameters[idx:idx+batch_size]]
+                def attempt():
+                    ddb_response = batch_ddb.batch_execute_statement(Statements=[dict(Statement=statement, Parameters=params) for params, error in pending])
+                    failed = [(params, response['Error']) for (params, error), response in zip(pending, ddb_response['Responses']) if 'Error' in response]
+                    errors.extend([error for params, error in failed if error.get('Code') not in BATCH_RETRY_CODES])
+                    pending[:] = [(params, error) for params, error in failed if error.get('Code') in BATCH_RETRY_CODES]
+                    if pending:
+                        raise BatchThrottled({'Error': {'Code': pending[0][1]['Code'], 'Message': f"{len(pending)} statements throttled"}}, 'BatchExecuteStatement')
+                try:
+                    call('dynamodb', 'batch_execute_statement', attempt)
+                except BatchThrottled:
+                    # Out of attempts or time
+                    errors.extend([error for params, error in pending])
+            if errors:
+                logger.error(f"{len(errors)} of {len(parameters)} statements failed: {errors[:10]}")
+            return errors
+        except Exception as e:
+            logger.error(e)
+            raise e
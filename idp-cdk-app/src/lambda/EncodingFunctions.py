@@ -0,0 +1,104 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Encoding of redacted documents. The redacted document keeps the format of the source (PDF, TIFF, PNG or JPEG)
+and a profile selects how its pages are encoded:
+    original   Pillow defaults of the format, the encoding used before profiles
+    bilevel    1 bit black and white, CCITT Group 4 in PDF and TIFF, for scanned faxes and printed text
+    grayscale  8 bit gray, JPEG in PDF and JPEG, Deflate in TIFF, optimized PNG
+    photo      color, JPEG in PDF, TIFF and JPEG, optimized PNG
+    auto       bilevel, grayscale or photo chosen from the mode and colors of the pages
+JPEG is written at ENCODING_JPEG_QUALITY, a profile can override it for a workflow as <profile>:<quality>,
+e.g. photo:60. The profile of a workflow comes from the workflow submitted by the web app, ENCODING_PROFILE
+otherwise.
+"""
+
+import logging
+import os
+import time
+from PIL import Image, ImageChops
+
+logger = logging.getLogger(__name__)
+
+ENCODING_PROFILE = os.environ.get('ENCODING_PROFILE', 'auto')
+ENCODING_JPEG_QUALITY = int(os.environ.get('ENCODING_JPEG_QUALITY', '75'))
+# auto: pages whose channels differ by at most this much are gray, gray pages with at least this share of
+# pixels near black or white are bilevel (text pages, antialiased text edges are the rest)
+ENCODING_GRAY_TOLERANCE = int(os.environ.get('ENCODING_GRAY_TOLERANCE', '8'))
+ENCODING_BILEVEL_RATIO = float(os.environ.get('ENCODING_BILEVEL_RATIO', '0.9'))
+
+PROFILES = ['original', 'bilevel', 'grayscale', 'photo', 'auto']
+FORMATS = {'application/pdf': 'PDF', 'image/tiff': 'TIFF', 'image/png': 'PNG', 'image/jpeg': 'JPEG'}
+# Page mode and save options of every profile and format
+MODES = {'bilevel': '1', 'grayscale': 'L', 'photo': 'RGB'}
+OPTIONS = {
+    'bilevel': {'PDF': {}, 'TIFF': {'compression': 'group4'}, 'PNG': {'optimize': True}, 'JPEG': {'quality': None}},
+    'grayscale': {'PDF': {'quality': None}, 'TIFF': {'compression': 'tiff_adobe_deflate'}, 'PNG': {'optimize': True}, 'JPEG': {'quality': None}},
+    'photo': {'PDF': {'quality': None}, 'TIFF': {'compression': 'jpeg', 'quality': None}, 'PNG': {'optimize': True}, 'JPEG': {'quality': None, 'optimize': True}},
+}
+
+def parse_profile(spec: str) -> tuple:
+    """Returns the (profile, JPEG quality) of a profile spec, the default profile for an unknown one
+    """
+    name, _, quality = (spec if spec else ENCODING_PROFILE).partition(':')
+    if name not in PROFILES:
+        logger.warning(f"Unknown encoding profile {name}, using {ENCODING_PROFILE}")
+        name, _, quality = ENCODING_PROFILE.partition(':')
+    quality = int(quality) if quality.isdigit() else ENCODING_JPEG_QUALITY
+    return name, min(max(quality, 1), 95)
+
+def page_profile(image: Image.Image) -> str:
+    """Returns the profile that keeps the content of a page: bilevel, grayscale or photo
+    """
+    if image.mode == '1':
+        return 'bilevel'
+    # A thumbnail is enough to tell color and gray pages apart and keeps this fast on large pages
+    sample = image.copy()
+    sample.thumbnail((512, 512))
+    if sample.mode not in ['L', 'LA', 'I', 'I;16']:
+        rgb = sample.convert('RGB')
+        gray = rgb.convert('L').convert('RGB')
+        if max([high for _, high in ImageChops.difference(rgb, gray).getextrema()]) > ENCODING_GRAY_TOLERANCE:
+            return 'photo'
+    # Thumbnails blur text into grays, the histogram is taken on the full page
+    histogram = image.convert('L').histogram()
+    extremes = sum(histogram[:32]) + sum(histogram[-32:])
+    return 'bilevel' if extremes >= ENCODING_BILEVEL_RATIO * sum(histogram) else 'grayscale'
+
+def choose_profile(spec: str, images: list) -> tuple:
+    """Resolves a profile spec for the pages of a document, auto picks the profile of the most colorful page
+    """
+    name, quality = parse_profile(spec)
+    if name == 'auto':
+        pages = {page_profile(image) for image in images}
+        name = next((profile for profile in ['photo', 'grayscale', 'bilevel'] if profile in pages), 'photo')
+    return name, quality
+
+def encode(images: list, path: str, mime: str, spec: str = None, dpi: int = None) -> dict:
+    """Saves the pages of a redacted document with an encoding profile, returns the profile used, the size
+    of the file and the encode time
+    """
+    start = time.perf_counter()
+    profile, quality = choose_profile(spec, images)
+    file_format = FORMATS.get(mime)
+    save_args = {}
+    if profile != 'original' and file_format:
+        # JPEG has no 1 bit mode, bilevel pages are written as gray
+        mode = 'L' if file_format == 'JPEG' and profile == 'bilevel' else MODES[profile]
+        # Thresholding keeps text and redaction boxes sharp where dithering would add noise
+        images = [image if image.mode == mode else image.convert(mode, dither=Image.Dither.NONE) for image in images]
+        save_args = {name: quality if value is None else value for name, value in OPTIONS[profile][file_format].items()}
+        save_args['format'] = file_format
+    # Rasterized PDF pages keep their size in inches
+    if dpi:
+        save_args['resolution'] = dpi
+
+    if len(images) == 1:
+        images[0].save(path, **save_args)
+    else:
+        images[0].save(path, save_all=True, append_images=images[1:], **save_args)
+
+    stats = dict(encoding_profile=profile, redacted_bytes=os.path.getsize(path), encode_ms=int((time.perf_counter() - start) * 1000))
+    logger.info(f"Encoded {len(images)} pages as {profile} in {stats['encode_ms']}ms, {stats['redacted_bytes']} bytes")
+    return stats
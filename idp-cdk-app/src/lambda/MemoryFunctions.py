@@ -0,0 +1,74 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Memory model of the redaction Lambda. Redacting a document holds its parsed Textract JSON and the Pillow images
+of all its pages, so its peak memory is estimated as
+    REDACT_BASE_MB                                      runtime, Pillow, PDFium and the overlayer
+  + Textract JSON bytes * REDACT_JSON_FACTOR            parsed blocks are several times their JSON size
+  + page pixels * bytes per pixel * REDACT_RASTER_FACTOR  Pillow keeps RGB in 4 bytes per pixel, the factor covers
+                                                      the renderer bitmap and the copies made when encoding
+The PHI post-processing plans the redaction Map with the estimate of letter pages at REDACT_PLAN_DPI, the
+redaction function checks it again with the page sizes and DPI of the document before rasterizing it.
+Predictions are logged next to the observed peak (VmHWM) of every document to calibrate the factors.
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+REDACT_BASE_MB = float(os.environ.get('REDACT_BASE_MB', '120'))
+REDACT_JSON_FACTOR = float(os.environ.get('REDACT_JSON_FACTOR', '8'))
+REDACT_RASTER_FACTOR = float(os.environ.get('REDACT_RASTER_FACTOR', '1.5'))
+REDACT_PLAN_DPI = int(os.environ.get('REDACT_PLAN_DPI', '150'))
+# US letter in points, the page size assumed when only the page count of a document is known
+LETTER_PAGE = (612, 792)
+BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'I;16': 2, 'I': 4, 'F': 4, 'RGB': 4, 'RGBA': 4, 'CMYK': 4}
+MB = 1024 * 1024
+
+def estimate_peak_mb(page_pixels: list, mode: str = 'RGB', textract_bytes: int = 0) -> float:
+    """Estimated peak memory in MB of redacting a document whose pages are page_pixels (width, height) in mode
+    """
+    raster = sum([width * height for width, height in page_pixels]) * BYTES_PER_PIXEL.get(mode, 4) * REDACT_RASTER_FACTOR
+    return round(REDACT_BASE_MB + textract_bytes * REDACT_JSON_FACTOR / MB + raster / MB, 1)
+
+def plan_peak_mb(pages: int, textract_bytes: int = 0) -> float:
+    """Estimate of a document known only by its page count, as letter pages rasterized at REDACT_PLAN_DPI
+    """
+    width, height = [round(points * REDACT_PLAN_DPI / 72) for points in LETTER_PAGE]
+    return estimate_peak_mb(page_pixels=[(width, height)] * pages, textract_bytes=textract_bytes)
+
+def max_page_pixels(budget_mb: float, pages: int, mode: str = 'RGB', textract_bytes: int = 0) -> int:
+    """Pixels per page that keep a document of pages pages within budget_mb, 0 when even the base does not fit
+    """
+    available = budget_mb - REDACT_BASE_MB - textract_bytes * REDACT_JSON_FACTOR / MB
+    if available <= 0 or pages <= 0:
+        return 0
+    return int(available * MB / (pages * BYTES_PER_PIXEL.get(mode, 4) * REDACT_RASTER_FACTOR))
+
+def memory_budget_mb() -> int:
+    """Memory of the running Lambda function, set by the Lambda runtime
+    """
+    return int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '0'))
+
+def reset_peak_memory():
+    """Resets the peak resident memory (VmHWM) of the process so that the next reading covers one document only
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError as e:
+        logger.debug(f"Unable to reset peak memory: {e}")
+
+def peak_memory_mb() -> float:
+    """Peak resident memory of the process in MB since the last reset_peak_memory, None where /proc is missing
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError as e:
+        logger.debug(f"Unable to read peak memory: {e}")
+    return None
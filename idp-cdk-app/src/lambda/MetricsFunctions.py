@@ -0,0 +1,27 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import time
+
+METRICS_NAMESPACE = 'IDPDeidentification'
+
+def put_metric(name: str, value: float = 1, unit: str = 'Count', dimensions: dict = None) -> dict:
+    """Publishes a metric by writing it to the function log in CloudWatch Embedded Metric Format, so that no
+    PutMetricData call is made. See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+    dimensions = dimensions if dimensions else {}
+    metric = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit}]
+            }]
+        },
+        name: value,
+        **dimensions
+    }
+    print(json.dumps(metric))
+    return metric
@@ -0,0 +1,54 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Layout of the output of a workflow. Every document has a job directory public/output/<workflow_id>/<job_id>/
+holding
+    <job_id>/1, 2, ...      Amazon Textract job output
+    <doc>.json              merged Textract JSON (txtract)
+    <doc>-report.xlsx       Excel report
+    <doc>.phi-rules         rule based PHI entities (phi_rules), missing with PHI_RULES_MODE off
+    <doc>.comp-med          Comprehend Medical PHI entities (comp_med)
+    orig-doc/<doc>          original document (doc)
+    redacted-doc/<doc>      redacted document
+The PHI post-processing lists the workflow output once, groups its keys by job directory with index_by_job and
+hands the artifacts of every document (document_artifacts) to the redaction Map, so that no branch lists it again.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# redact_data key of an artifact to the test of its key relative to the job directory
+ARTIFACTS = {
+    'comp_med': lambda name: '/' not in name and name.endswith('.comp-med'),
+    'txtract': lambda name: '/' not in name and name.endswith('.json'),
+    'doc': lambda name: name.startswith('orig-doc/') and name.count('/') == 1,
+    'phi_rules': lambda name: '/' not in name and name.endswith('.phi-rules'),
+}
+REQUIRED_ARTIFACTS = ['comp_med', 'txtract', 'doc']
+
+def index_by_job(object_sizes, workflow_prefix: str) -> dict:
+    """Groups (key, size) pairs of the workflow output into {job prefix: {key: size}} in a single pass
+    """
+    index = {}
+    for key, size in object_sizes:
+        job_dir, separator, name = key[len(workflow_prefix):].partition('/')
+        if separator:
+            index.setdefault(f"{workflow_prefix}{job_dir}/", {})[key] = size
+    return index
+
+def document_artifacts(job_prefix: str, keys) -> dict:
+    """Returns the redaction artifacts (see ARTIFACTS) found among the keys of a job directory
+    """
+    found = {}
+    for key in keys:
+        name = key[len(job_prefix):]
+        for artifact, test in ARTIFACTS.items():
+            if test(name):
+                found.setdefault(artifact, key)
+                break
+    return found
+
+def missing_artifacts(found: dict) -> list:
+    return [artifact for artifact in REQUIRED_ARTIFACTS if artifact not in found]
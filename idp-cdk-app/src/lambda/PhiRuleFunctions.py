@@ -0,0 +1,149 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Rule based detection of structured PHI identifiers in the PHI input text, run by the Textract post-processing
+before the text goes to Amazon Comprehend Medical. Entities are returned in the shape of the Comprehend Medical
+PHI output (Id, BeginOffset, EndOffset, Score, Text, Category, Type, Traits, Attributes) with offsets into the
+text, so that the redaction merges them with the Comprehend Medical entities. Rules:
+    SSN     ddd-dd-dddd with a valid area, group and serial number                              ID
+    NPI     10 digit National Provider Identifier with a valid check digit (Luhn on 80840+NPI)   ID
+    CARD    13 to 19 digit card numbers with a valid Luhn check digit                           ID
+    MRN     identifier following an MRN / medical record number label, PHI_RULES_MRN_LABELS     ID
+    PHONE   US phone and fax numbers                                                            PHONE_OR_FAX
+    EMAIL   email addresses                                                                     EMAIL
+    URL     http(s) and www. addresses                                                          URL
+    DATE    numeric dates and dates with month names                                            DATE
+    ZIP     5 and 9 digit ZIP codes following a state code                                      ADDRESS
+PHI_RULES_TERMS adds a dictionary of terms to detect, a JSON object of entity type to terms (names of the
+providers and facilities of a customer, ...), matched as whole words regardless of case.
+
+PHI_RULES_MODE selects how the entities are used:
+    off    no rule based detection
+    merge  the entities are written next to the Comprehend Medical output and merged by the redaction (default)
+    skip   as merge, and documents the rules fully cover skip Comprehend Medical. A document is covered when
+           every word of its text is part of an entity or one of PHI_RULES_SAFE_WORDS, the labels of the forms
+           of a customer (Patient, DOB, SSN, ...), so that nothing is left where Comprehend Medical could find
+           PHI the rules do not know about
+The entities are recorded in the document cache with the other artifacts, bump CACHE_VERSION when the rules or
+the dictionary change.
+"""
+
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+PHI_RULES_MODE = os.environ.get('PHI_RULES_MODE', 'merge')
+PHI_RULES_TERMS = os.environ.get('PHI_RULES_TERMS', '{}')
+PHI_RULES_SAFE_WORDS = os.environ.get('PHI_RULES_SAFE_WORDS', '')
+PHI_RULES_MRN_LABELS = os.environ.get('PHI_RULES_MRN_LABELS', 'MRN,Medical Record Number,Medical Record No,Medical Record #,Patient ID,Chart No')
+CATEGORY = 'PROTECTED_HEALTH_INFORMATION'
+
+MONTHS = r'(?:Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?|Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)\.?'
+STATES = ('AL|AK|AZ|AR|CA|CO|CT|DE|DC|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MD|MA|MI|MN|MS|MO|MT|NE|NV|NH|NJ|NM|NY|NC|ND|OH|OK|OR|PA|'
+          'PR|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY')
+
+def luhn(digits: str) -> bool:
+    total = 0
+    for idx, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if idx % 2 else 1)
+        total += value - 9 if value > 9 else value
+    return total % 10 == 0
+
+def valid_ssn(text: str) -> bool:
+    area, group, serial = re.split(r'[- ]', text)
+    return area not in ('000', '666') and not area.startswith('9') and group != '00' and serial != '0000'
+
+def valid_npi(text: str) -> bool:
+    return luhn(f"80840{text}")
+
+def valid_card(text: str) -> bool:
+    return luhn(re.sub(r'[- ]', '', text))
+
+def mrn_pattern(labels: str) -> str:
+    names = '|'.join([re.escape(label.strip()).replace(r'\ ', r'\s+') for label in labels.split(',') if label.strip()])
+    return rf'\b(?:{names})\s*[:#.]?\s*(?P<entity>[A-Z0-9][A-Z0-9-]{{4,15}}\d)\b'
+
+# (rule, entity type, compiled pattern, check of the matched text), a pattern with an entity group only
+# detects that group
+RULES = [
+    ('SSN', 'ID', re.compile(r'\b\d{3}-\d{2}-\d{4}\b'), valid_ssn),
+    ('NPI', 'ID', re.compile(r'\b(?:NPI\s*[:#]?\s*)(?P<entity>\d{10})\b', re.IGNORECASE), valid_npi),
+    ('CARD', 'ID', re.compile(r'\b\d{4}(?:[- ]?\d{4}){2}[- ]?\d{1,7}\b'), valid_card),
+    ('MRN', 'ID', re.compile(mrn_pattern(PHI_RULES_MRN_LABELS), re.IGNORECASE), None),
+    ('PHONE', 'PHONE_OR_FAX', re.compile(r'(?<![\w-])(?:\+?1[-. ]?)?(?:\(\d{3}\)\s?|\d{3}[-. ])\d{3}[-. ]\d{4}\b'), None),
+    ('EMAIL', 'EMAIL', re.compile(r'\b[\w.+-]+@[\w-]+(?:\.[\w-]+)+\b'), None),
+    ('URL', 'URL', re.compile(r'\b(?:https?://|www\.)[^\s<>"]+[^\s<>".,;:)]'), None),
+    ('DATE', 'DATE', re.compile(rf'\b(?:\d{{1,2}}[/-]\d{{1,2}}[/-](?:\d{{4}}|\d{{2}})|\d{{4}}-\d{{2}}-\d{{2}}|{MONTHS}\s+\d{{1,2}}(?:st|nd|rd|th)?,?\s+\d{{4}}|\d{{1,2}}\s+{MONTHS},?\s+\d{{4}})\b', re.IGNORECASE), None),
+    ('ZIP', 'ADDRESS', re.compile(rf'\b(?:{STATES}),?\s+(?P<entity>\d{{5}}(?:-\d{{4}})?)\b'), None),
+]
+
+def parse_terms(spec: str) -> list:
+    """Compiles the PHI_RULES_TERMS dictionary into (rule, entity type, pattern, check) rules, one per type
+    """
+    try:
+        terms = json.loads(spec) if spec else {}
+    except ValueError:
+        logger.warning(f"PHI_RULES_TERMS is not a JSON object of entity type to terms, ignoring it")
+        return []
+    rules = []
+    for entity_type, words in terms.items():
+        words = sorted([word for word in words if word.strip()], key=len, reverse=True)
+        if words:
+            pattern = re.compile(r'\b(?:' + '|'.join([re.escape(word.strip()) for word in words]) + r')\b', re.IGNORECASE)
+            rules.append(('TERM', entity_type, pattern, None))
+    return rules
+
+TERM_RULES = parse_terms(PHI_RULES_TERMS)
+SAFE_WORDS = {word.strip().lower() for word in PHI_RULES_SAFE_WORDS.split(',') if word.strip()}
+WORD = re.compile(r'[A-Za-z0-9]+')
+
+def detect(text: str) -> list:
+    """Returns the PHI entities the rules find in text, in the shape of Comprehend Medical entities. Entities
+    overlapping an earlier one are dropped, so that a date inside an MRN is not detected twice
+    """
+    found = []
+    for rule, entity_type, pattern, check in RULES + TERM_RULES:
+        for match in pattern.finditer(text):
+            group = 'entity' if 'entity' in pattern.groupindex else 0
+            begin, end = match.span(group)
+            if check and not check(match.group(group)):
+                continue
+            found.append((begin, end, rule, entity_type))
+
+    entities, last_end = [], -1
+    for begin, end, rule, entity_type in sorted(found, key=lambda entity: (entity[0], -entity[1])):
+        if begin < last_end:
+            continue
+        entities.append(dict(Id=len(entities), BeginOffset=begin, EndOffset=end, Score=1.0, Text=text[begin:end], Category=CATEGORY,
+                             Type=entity_type, Traits=[], Attributes=[], Rule=rule))
+        last_end = end
+    logger.debug(f"Rules found {len(entities)} PHI entities")
+    return entities
+
+def covered(text: str, entities: list) -> bool:
+    """Whether every word of text is part of an entity or a safe word
+    """
+    spans = [(entity['BeginOffset'], entity['EndOffset']) for entity in entities]
+    for match in WORD.finditer(text):
+        if match.group(0).lower() in SAFE_WORDS:
+            continue
+        if not any(begin <= match.start() and match.end() <= end for begin, end in spans):
+            return False
+    return True
+
+def merge_entities(*outputs) -> list:
+    """Entities of Comprehend Medical and rule outputs without duplicates, an entity spanning the same text
+    as one already kept is dropped
+    """
+    entities, seen = [], set()
+    for output in outputs:
+        for entity in (output or {}).get('Entities', []):
+            span = (entity.get('BeginOffset'), entity.get('EndOffset'), entity['Text'])
+            if span not in seen:
+                seen.add(span)
+                entities.append(entity)
+    return entities
@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Pipeline modes of de-identification workflows, selected with PIPELINE_MODE:
+    staged     every document of a workflow goes through Textract, then one Comprehend Medical batch job detects
+               the PHI of all of them, then the redaction Map redacts them (default)
+    streaming  each document moves on as soon as its Textract output is processed: its PHI is detected with the
+               synchronous DetectPHI API, in segments of at most PHI_SYNC_MAX_BYTES, and the redaction function
+               (LAMBDA_REDACT) is invoked for it alone. The document only counts as processed for the workflow
+               once it is redacted, so the workflow completes when its last document is redacted and the stages
+               of the state machine after Textract only move the outputs into place
+In streaming mode the PHI entities of a document are staged under phi-cached/ like a cached Comprehend Medical
+output, and the redaction reads the original document from the workflow input and leaves it there, so the PHI
+post-processing files both as for any other document and skips their redaction. Documents the redaction function
+defers are handed to LAMBDA_REDACT_LARGE. A redaction invocation that fails every attempt (error, timeout, crash)
+goes to the on-failure destination idp-async-failure, which marks its documents processed for the redaction Map.
+A document whose PHI cannot be detected synchronously falls back to the staged path.
+"""
+
+import json
+import logging
+import os
+from ClientFunctions import LazyClient
+from RetryFunctions import retrying_client
+
+# DetectPHI is throttled per account, throttled segments are retried by RetryFunctions
+comp_med = retrying_client('comprehendmedical')
+lambda_client = LazyClient('lambda')
+logger = logging.getLogger(__name__)
+
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'staged')
+# DetectPHI accepts at most 20,000 bytes of UTF-8 text per request
+PHI_SYNC_MAX_BYTES = int(os.environ.get('PHI_SYNC_MAX_BYTES', '20000'))
+
+def segments(text: str, max_bytes: int = PHI_SYNC_MAX_BYTES) -> list:
+    """Splits text into (offset, segment) of at most max_bytes UTF-8 bytes, at line ends where possible
+    """
+    result, start = [], 0
+    while start < len(text):
+        end = start
+        size = 0
+        for line in text[start:].splitlines(keepends=True):
+            line_bytes = len(line.encode('utf-8'))
+            if size + line_bytes > max_bytes:
+                break
+            end += len(line)
+            size += line_bytes
+        if end == start:
+            # A single line longer than a segment is cut where it fits
+            end = start + 1
+            while end < len(text) and len(text[start:end + 1].encode('utf-8')) <= max_bytes:
+                end += 1
+        result.append((start, text[start:end]))
+        start = end
+    return result
+
+def detect_phi(text: str) -> dict:
+    """PHI entities of text detected with the synchronous DetectPHI API, in the shape of the output of a
+    Comprehend Medical PHI detection job with offsets into the whole text
+    """
+    entities, model_version = [], None
+    for offset, segment in segments(text):
+        if not segment.strip():
+            continue
+        response = comp_med.detect_phi(Text=segment)
+        model_version = response.get('ModelVersion', model_version)
+        for entity in response['Entities']:
+            entity['BeginOffset'] += offset
+            entity['EndOffset'] += offset
+            entity['Id'] = len(entities)
+            entities.append(entity)
+    logger.info(f"DetectPHI found {len(entities)} PHI entities")
+    return dict(Entities=entities, ModelVersion=model_version)
+
+def start_redaction(function_name: str, payload: dict):
+    """Invokes a redaction function asynchronously for the documents of payload['redact_data']
+    """
+    logger.info(f"Starting redaction of {len(payload['redact_data'])} documents with {function_name}")
+    lambda_client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload))
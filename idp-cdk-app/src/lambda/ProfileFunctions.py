@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+On demand profiling of Lambda handlers. Handlers are decorated with
+    @profiled
+    def lambda_handler(event, context):
+and an invocation is profiled when its event has "profile": true or, with PROFILE_SAMPLE_PERCENT, for that
+percentage of the invocations. A profiled invocation runs under cProfile and tracemalloc, and writes to
+    <PROFILE_PREFIX>/<workflow_id>/<function>/<request id>.pstats   cProfile stats, load with pstats.Stats(path)
+    <PROFILE_PREFIX>/<workflow_id>/<function>/<request id>.txt      top functions by cumulative time, peak traced
+                                                                     memory and top allocations by size
+in the bucket of the event (IDP_BKT when the event has none), tagged with the workflow_id. Settings:
+    PROFILE_SAMPLE_PERCENT      0 to 100, percentage of the invocations profiled (default 0)
+    PROFILE_PREFIX              diagnostics prefix (default public/diagnostics)
+    PROFILE_TOP                 functions and allocations listed in the .txt report (default 40)
+    PROFILE_TRACE_FRAMES        frames kept per allocation by tracemalloc (default 10)
+When an invocation is not profiled the handler is called directly, the event flag and one random number are
+the only cost. Profiling slows the invocation down several times, keep the sample percentage low.
+"""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import time
+import tracemalloc
+import uuid
+from ClientFunctions import LazyClient
+
+s3 = LazyClient('s3')
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_PERCENT = float(os.environ.get('PROFILE_SAMPLE_PERCENT', '0'))
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX', 'public/diagnostics')
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', '40'))
+PROFILE_TRACE_FRAMES = int(os.environ.get('PROFILE_TRACE_FRAMES', '10'))
+
+def sampled(event) -> bool:
+    """Whether an invocation is profiled, from the profile flag of its event or the sample percentage
+    """
+    if isinstance(event, dict) and event.get('profile'):
+        return True
+    return PROFILE_SAMPLE_PERCENT > 0 and random.random() * 100 < PROFILE_SAMPLE_PERCENT
+
+def event_workflow_id(event) -> str:
+    """workflow_id of a Step Functions task event, or of the Textract notification (JobTag) of an SNS event
+    """
+    if not isinstance(event, dict):
+        return 'none'
+    if event.get('workflow_id'):
+        return event['workflow_id']
+    try:
+        message = json.loads(event['Records'][0]['Sns']['Message'])
+        return message.get('JobTag') or 'none'
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 'none'
+
+def report(stats: pstats.Stats, snapshot, elapsed_ms: int, peak_bytes: int) -> str:
+    out = io.StringIO()
+    out.write(f"Elapsed {elapsed_ms}ms\n\n")
+    stats.stream = out
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP)
+    if snapshot:
+        out.write(f"Peak traced memory {peak_bytes / 1024:.1f} KiB, top {PROFILE_TOP} allocations still held at the end by size\n")
+        for stat in snapshot.statistics('traceback')[:PROFILE_TOP]:
+            out.write(f"{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format(limit=PROFILE_TRACE_FRAMES):
+                out.write(f"    {line}\n")
+    return out.getvalue()
+
+def upload(event, context, handler_name: str, stats: pstats.Stats, snapshot, elapsed_ms: int, peak_bytes: int):
+    bucket = event.get('bucket') if isinstance(event, dict) else None
+    bucket = bucket or os.environ.get('IDP_BKT')
+    if not bucket:
+        logger.warning("No bucket to upload the profile to")
+        return
+    workflow_id = event_workflow_id(event)
+    function_name = getattr(context, 'function_name', None) or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', handler_name)
+    request_id = getattr(context, 'aws_request_id', None) or str(uuid.uuid4())
+    key = f"{PROFILE_PREFIX}/{workflow_id}/{function_name}/{request_id}"
+    tags = f"workflow_id={workflow_id}&function={function_name}"
+    s3.put_object(Bucket=bucket, Key=f"{key}.pstats", Body=marshal.dumps(stats.stats), ContentType='application/octet-stream', Tagging=tags)
+    s3.put_object(Bucket=bucket, Key=f"{key}.txt", Body=report(stats, snapshot, elapsed_ms, peak_bytes), ContentType='text/plain', Tagging=tags)
+    logger.info(f"Profile of {function_name} uploaded to s3://{bucket}/{key}.pstats")
+
+def profiled(handler):
+    """Decorates a Lambda handler to profile the invocations selected by sampled
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not sampled(event):
+            return handler(event, context)
+
+        profiler = cProfile.Profile()
+        # tracemalloc is process wide, an invocation already tracing (a nested handler) keeps its trace
+        tracing = not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        start = time.monotonic()
+        profiler.enable()
+        try:
+            return handler(event, context)
+        finally:
+            profiler.disable()
+            elapsed_ms = int((time.monotonic() - start) * 1000)
+            snapshot, peak_bytes = None, 0
+            if tracing:
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+                tracemalloc.stop()
+            try:
+                upload(event, context, handler.__module__, pstats.Stats(profiler), snapshot, elapsed_ms, peak_bytes)
+            except Exception as e:
+                # A profile must never fail the invocation it profiles
+                logger.warning(f"Unable to upload the profile: {e}")
+    return wrapper
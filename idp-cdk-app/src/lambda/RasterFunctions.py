@@ -0,0 +1,136 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Rasterization of PDF pages for redaction. Backends are selected with RASTERIZER:
+    pdfium      pypdfium2, renders with PDFium directly (default)
+    pdfplumber  pdfplumber page.to_image, which also renders through pypdfium2 since pdfplumber 0.10 but
+                parses the whole page layout first
+    pdf2image   poppler pdftoppm, only available when pdf2image and poppler-utils are added to the image
+An unavailable backend falls back to pdfium, then pdfplumber.
+
+Every backend renders a page of W x H points at D DPI to exactly round(W*D/72) x round(H*D/72) pixels, so the
+redaction boxes computed from the Textract geometry land on the same pixels whichever backend is used.
+
+The DPI of a document is the lowest that renders the smallest box to redact at least RASTER_MIN_BOX_PX pixels
+high and wide, within RASTER_MIN_DPI and RASTER_MAX_DPI, and lowered so that no page exceeds
+RASTER_MAX_PAGE_PIXELS pixels (memory bound of the redaction Lambda).
+"""
+
+import abc
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+RASTERIZER = os.environ.get('RASTERIZER', 'pdfium')
+RASTER_MIN_DPI = int(os.environ.get('RASTER_MIN_DPI', '100'))
+RASTER_MAX_DPI = int(os.environ.get('RASTER_MAX_DPI', '300'))
+RASTER_MIN_BOX_PX = int(os.environ.get('RASTER_MIN_BOX_PX', '10'))
+RASTER_MAX_PAGE_PIXELS = int(os.environ.get('RASTER_MAX_PAGE_PIXELS', str(4*1000*1000)))
+
+def page_pixels(page_size: tuple, dpi: int) -> tuple:
+    """Pixel size of a page of (width, height) points rendered at dpi
+    """
+    return round(page_size[0] * dpi / 72), round(page_size[1] * dpi / 72)
+
+def choose_dpi(page_sizes: list, boxes: list, max_pixels: int = None) -> int:
+    """Returns the rasterization DPI of a document. page_sizes are the (width, height) in points of every page,
+    boxes the (page_number, width, height) of every box to redact as ratios of the page size, like the Textract
+    BoundingBox. max_pixels lowers the page pixel limit further, to fit the document into a memory budget
+    """
+    dpi = RASTER_MIN_DPI
+    for page_number, width, height in boxes:
+        page_width, page_height = page_sizes[page_number - 1]
+        smallest_inches = min(width * page_width, height * page_height) / 72
+        if smallest_inches > 0:
+            dpi = max(dpi, math.ceil(RASTER_MIN_BOX_PX / smallest_inches))
+    dpi = min(dpi, RASTER_MAX_DPI)
+    largest_inches = max([width * height / 72 / 72 for width, height in page_sizes], default=0)
+    if largest_inches:
+        max_pixels = min(RASTER_MAX_PAGE_PIXELS, max_pixels) if max_pixels is not None else RASTER_MAX_PAGE_PIXELS
+        dpi = max(min(dpi, int(math.sqrt(max_pixels / largest_inches))), 1)
+    logger.debug(f"Rasterizing {len(page_sizes)} pages at {dpi} DPI for {len(boxes)} boxes")
+    return dpi
+
+class Rasterizer(abc.ABC):
+    name = None
+
+    def page_sizes(self, path: str) -> list:
+        """(width, height) in points of every page
+        """
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return [pdf[idx].get_size() for idx in range(len(pdf))]
+        finally:
+            pdf.close()
+
+    @abc.abstractmethod
+    def render_pages(self, path: str, dpi: int) -> list:
+        """Pillow image of every page rendered at dpi, as the backend sizes it
+        """
+
+    def render(self, path: str, dpi: int, page_sizes: list = None) -> list:
+        """Returns a Pillow image of every page, each exactly page_pixels(page size, dpi)
+        """
+        page_sizes = page_sizes if page_sizes else self.page_sizes(path)
+        images = self.render_pages(path, dpi)
+        for idx, (image, page_size) in enumerate(zip(images, page_sizes)):
+            size = page_pixels(page_size, dpi)
+            if image.size != size:
+                # Backends round partial pixels differently, never by more than a pixel
+                images[idx] = image.resize(size)
+        return images
+
+class PdfiumRasterizer(Rasterizer):
+    name = 'pdfium'
+
+    def render_pages(self, path: str, dpi: int) -> list:
+        import pypdfium2 as pdfium
+        pdf = pdfium.PdfDocument(path)
+        try:
+            return [pdf[idx].render(scale=dpi / 72).to_pil() for idx in range(len(pdf))]
+        finally:
+            pdf.close()
+
+class PdfplumberRasterizer(Rasterizer):
+    name = 'pdfplumber'
+
+    def page_sizes(self, path: str) -> list:
+        import pdfplumber
+        with pdfplumber.open(path) as pdf:
+            return [(float(page.width), float(page.height)) for page in pdf.pages]
+
+    def render_pages(self, path: str, dpi: int) -> list:
+        import pdfplumber
+        with pdfplumber.open(path) as pdf:
+            return [page.to_image(resolution=dpi).original for page in pdf.pages]
+
+class Pdf2imageRasterizer(Rasterizer):
+    name = 'pdf2image'
+
+    def render_pages(self, path: str, dpi: int) -> list:
+        from pdf2image import convert_from_path
+        return convert_from_path(path, dpi=dpi)
+
+RASTERIZERS = {rasterizer.name: rasterizer for rasterizer in [PdfiumRasterizer, PdfplumberRasterizer, Pdf2imageRasterizer]}
+
+def available(name: str) -> bool:
+    modules = {'pdfium': ['pypdfium2'], 'pdfplumber': ['pdfplumber', 'pypdfium2'], 'pdf2image': ['pdf2image', 'pypdfium2']}
+    try:
+        for module in modules[name]:
+            __import__(module)
+        return True
+    except ImportError:
+        return False
+
+def get_rasterizer(name: str = None) -> Rasterizer:
+    name = name if name else RASTERIZER
+    for candidate in [name, 'pdfium', 'pdfplumber']:
+        if candidate in RASTERIZERS and available(candidate):
+            if candidate != name:
+                logger.warning(f"Rasterizer {name} is not available, using {candidate}")
+            return RASTERIZERS[candidate]()
+    raise Exception(f"No rasterizer available for {name}")
@@ -0,0 +1,174 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Retry layer of the S3, DynamoDB and Comprehend Medical calls. Modules declare these clients with
+    s3 = retrying_client('s3')
+instead of LazyClient('s3') and use them as boto3 clients: a call failing with a throttling or transient error (THROTTLE_CODES,
+TRANSIENT_CODES, 5xx, connection errors) is retried with decorrelated jitter backoff,
+    delay = min(RETRY_CAP_MS, random between RETRY_BASE_MS and 3 * previous delay)
+for at most RETRY_MAX_ATTEMPTS attempts, and only while the invocation keeps RETRY_RESERVE_MS of its remaining
+time, so that a handler still has the time to record its failure. The remaining time comes from the Lambda
+context of the handler, which the time_budget decorator records:
+    @time_budget
+    def lambda_handler(event, context):
+botocore's own retries are turned off on these clients (NO_RETRY_CONFIG), they would multiply the attempts.
+Paginators, waiters and managed transfers (upload_file, download_file, copy) make their calls inside botocore
+and s3transfer, out of reach of call, they run on a second client of the service with botocore's standard
+retries (STANDARD_RETRY_CONFIG). Textract keeps its own retry settings (see TextractFunctions.py).
+
+A circuit breaker per service opens after BREAKER_THRESHOLD consecutive retryable failures: calls then fail
+immediately with CircuitOpenError for BREAKER_COOLDOWN_S seconds instead of spending the time of the invocation
+on a service that is not answering, after which one call is let through to probe it. Other errors are raised
+at once and do not count. Retries, throttles, exhausted retries and open circuits are published as metrics
+with the operation (e.g. s3.get_object) as dimension.
+"""
+
+import functools
+import logging
+import os
+import random
+import threading
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from ClientFunctions import LazyClient
+from MetricsFunctions import put_metric
+
+logger = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', '6'))
+RETRY_BASE_MS = int(os.environ.get('RETRY_BASE_MS', '50'))
+RETRY_CAP_MS = int(os.environ.get('RETRY_CAP_MS', '5000'))
+RETRY_RESERVE_MS = int(os.environ.get('RETRY_RESERVE_MS', '3000'))
+BREAKER_THRESHOLD = int(os.environ.get('BREAKER_THRESHOLD', '20'))
+BREAKER_COOLDOWN_S = float(os.environ.get('BREAKER_COOLDOWN_S', '10'))
+
+THROTTLE_CODES = ['Throttling', 'ThrottlingException', 'ThrottledException', 'ThrottlingError', 'SlowDown',
+                  'RequestLimitExceeded', 'ProvisionedThroughputExceededException', 'ProvisionedThroughputExceeded',
+                  'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException']
+TRANSIENT_CODES = ['RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalServerError',
+                   'InternalServerException', 'ServiceUnavailable', 'ServiceUnavailableException', 'TransactionConflict']
+NO_RETRY_CONFIG = Config(retries={'max_attempts': 0})
+STANDARD_RETRY_CONFIG = Config(retries={'max_attempts': RETRY_MAX_ATTEMPTS, 'mode': 'standard'})
+
+class CircuitOpenError(Exception):
+    pass
+
+# Deadline (time.monotonic) of the running invocation, None outside of a Lambda invocation
+_deadline = None
+_breakers = {}
+_lock = threading.Lock()
+
+def time_budget(handler):
+    """Decorates a Lambda handler to record the deadline of its invocations for the retries
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _deadline
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            _deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
+        try:
+            return handler(event, context)
+        finally:
+            _deadline = None
+    return wrapper
+
+def remaining_ms() -> float:
+    """Time left in the invocation in milliseconds, infinite outside of a Lambda invocation
+    """
+    return (_deadline - time.monotonic()) * 1000 if _deadline else float('inf')
+
+def retryable(error: Exception) -> str:
+    """Error code of a throttling or transient error, None for errors not worth retrying
+    """
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return type(error).__name__
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in THROTTLE_CODES or code in TRANSIENT_CODES or status >= 500:
+            return code
+    return None
+
+def backoff_ms(previous_ms: float) -> float:
+    return min(RETRY_CAP_MS, random.uniform(RETRY_BASE_MS, previous_ms * 3))
+
+def check_breaker(service: str, operation: str):
+    with _lock:
+        failures, open_until = _breakers.get(service, (0, 0))
+        if open_until and time.monotonic() < open_until:
+            put_metric(name='CircuitOpen', dimensions={'Operation': operation})
+            raise CircuitOpenError(f"Circuit of {service} is open after {failures} consecutive failures")
+        if open_until:
+            # Cooldown over, let this call probe the service, the next failure opens the circuit again
+            _breakers[service] = (BREAKER_THRESHOLD - 1, 0)
+
+def record_result(service: str, failed: bool):
+    with _lock:
+        failures, open_until = _breakers.get(service, (0, 0))
+        if not failed:
+            _breakers[service] = (0, 0)
+            return
+        failures += 1
+        if failures >= BREAKER_THRESHOLD:
+            logger.warning(f"Opening the circuit of {service} for {BREAKER_COOLDOWN_S}s after {failures} consecutive failures")
+            open_until = time.monotonic() + BREAKER_COOLDOWN_S
+        _breakers[service] = (failures, open_until)
+
+def call(service: str, name: str, method, *args, **kwargs):
+    """Calls method, retrying throttling and transient errors within the attempts and time budget
+    """
+    operation = f"{service}.{name}"
+    check_breaker(service, operation)
+    delay_ms = RETRY_BASE_MS
+    attempt = 1
+    while True:
+        try:
+            result = method(*args, **kwargs)
+        except Exception as e:
+            code = retryable(e)
+            if not code:
+                raise
+            record_result(service, failed=True)
+            if code in THROTTLE_CODES:
+                put_metric(name='Throttles', dimensions={'Operation': operation})
+            delay_ms = backoff_ms(delay_ms)
+            if attempt >= RETRY_MAX_ATTEMPTS or remaining_ms() - delay_ms < RETRY_RESERVE_MS:
+                logger.warning(f"{operation} failed with {code} after {attempt} attempts")
+                put_metric(name='RetriesExhausted', dimensions={'Operation': operation})
+                raise
+            logger.info(f"{operation} failed with {code}, retrying in {int(delay_ms)}ms (attempt {attempt})")
+            put_metric(name='Retries', dimensions={'Operation': operation})
+            time.sleep(delay_ms / 1000)
+            attempt += 1
+            check_breaker(service, operation)
+            continue
+        record_result(service, failed=False)
+        return result
+
+class RetryingClient:
+    """boto3 client whose calls go through call. Attributes that are not methods (exceptions, meta) are returned
+    as they are, paginators, waiters and transfers come from standard_client
+    """
+    PASSTHROUGH = ['exceptions', 'meta']
+    STANDARD_RETRIES = ['get_paginator', 'get_waiter', 'can_paginate', 'upload_file', 'download_file', 'upload_fileobj',
+                        'download_fileobj', 'copy']
+
+    def __init__(self, client, service: str, standard_client=None):
+        self._client = client
+        self._service = service
+        self._standard_client = standard_client if standard_client is not None else client
+
+    def __getattr__(self, name):
+        if name in self.STANDARD_RETRIES:
+            return getattr(self._standard_client, name)
+        attribute = getattr(self._client, name)
+        if name in self.PASSTHROUGH or not callable(attribute):
+            return attribute
+        return functools.partial(call, self._service, name, attribute)
+
+def retrying_client(service: str) -> RetryingClient:
+    """Shared client of a service, see ClientFunctions, whose calls are retried
+    """
+    return RetryingClient(LazyClient(service, config=NO_RETRY_CONFIG), service, LazyClient(service, config=STANDARD_RETRY_CONFIG))
@@ -1,14 +1,46 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
+import gzip
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from MetricsFunctions import put_metric
+from RetryFunctions import retrying_client
 
-s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+s3 = retrying_client('s3')
 logger = logging.getLogger(__name__)
 
+# Intermediate artifacts read back by later stages (the merged Textract JSON) are written with put_object(compress=True),
+# which stores them gzip compressed with Content-Encoding: gzip when they are at least S3_COMPRESS_MIN_BYTES, smaller
+# ones gain nothing. S3_COMPRESSION=none writes them uncompressed. get_object_content decompresses gzip encoded
+# objects while reading the body and returns any other object as stored, so artifacts of workflows written before
+# compression, and objects written by other services, read the same. Browsers decode the Content-Encoding of the
+# objects the web app fetches with signed URLs. Stored and raw bytes and the CPU time spent compressing and
+# decompressing are published as metrics.
+#
+# Objects read by other AWS services (the PHI input text of Comprehend Medical) must not be compressed, none of
+# them decode Content-Encoding.
+S3_COMPRESSION = os.environ.get('S3_COMPRESSION', 'gzip')
+S3_COMPRESSION_LEVEL = int(os.environ.get('S3_COMPRESSION_LEVEL', '6'))
+S3_COMPRESS_MIN_BYTES = int(os.environ.get('S3_COMPRESS_MIN_BYTES', str(64*1024)))
+
+def compress_body(body) -> tuple:
+    """Returns the body to store and its Content-Encoding, None when it is stored as is
+    """
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    if S3_COMPRESSION != 'gzip' or not isinstance(raw, bytes) or len(raw) < S3_COMPRESS_MIN_BYTES:
+        return body, None
+    cpu = time.process_time()
+    compressed = gzip.compress(raw, compresslevel=S3_COMPRESSION_LEVEL)
+    cpu_ms = int((time.process_time() - cpu) * 1000)
+    logger.info(f"Compressed {len(raw)} bytes to {len(compressed)} bytes in {cpu_ms}ms CPU")
+    put_metric(name='ArtifactRawBytes', value=len(raw), unit='Bytes', dimensions={'Operation': 'Write'})
+    put_metric(name='ArtifactStoredBytes', value=len(compressed), unit='Bytes', dimensions={'Operation': 'Write'})
+    put_metric(name='ArtifactCompressionCPUTime', value=cpu_ms, unit='Milliseconds', dimensions={'Operation': 'Write'})
+    return compressed, 'gzip'
+
 class S3:
     def __init__(self, bucket: str, log_level: str ='INFO'):
         self.bucket=bucket
@@ -17,20 +49,19 @@ class S3:
     def list_objects(self, prefix: str, filters: list = None, search: list = None) -> list:
         try:
             logger.info(f"Attempting file listing for bucket: {self.bucket}, prefix: {prefix}, filters: {filters}, searches: {search}")
-            obj_bucket = s3_resource.Bucket(self.bucket)
-            logger.debug(obj_bucket)
+            keys = [key for key in self.list_object_sizes(prefix=prefix).keys()]
             
             processed_files = None
             
             if filters and not search:
-                processed_files = [obj.key for obj in obj_bucket.objects.filter(Prefix=prefix) if not obj.key.endswith("/") and not any(x in obj.key for x in filters)]
+                processed_files = [key for key in keys if not any(x in key for x in filters)]
             elif search and not filters:
-                processed_files = [obj.key for obj in obj_bucket.objects.filter(Prefix=prefix) if not obj.key.endswith("/") and any(x in obj.key for x in search)]
+                processed_files = [key for key in keys if any(x in key for x in search)]
             elif search and filters:
-                processed_files = [obj.key for obj in obj_bucket.objects.filter(Prefix=prefix) if not obj.key.endswith("/") and any(x in obj.key for x in search)]
+                processed_files = [key for key in keys if any(x in key for x in search)]
                 processed_files = [key for key in processed_files if not any(x in key for x in filters)]
             else:
-                processed_files = [obj.key for obj in obj_bucket.objects.filter(Prefix=prefix) if not obj.key.endswith("/")]
+                processed_files = keys
             logger.debug(processed_files)
             
             return processed_files
@@ -38,12 +69,43 @@ class S3:
             logger.error(e)
             raise e
     
+    def list_object_sizes(self, prefix: str) -> dict:
+        try:
+            logger.info(f"Attempting file size listing for bucket: {self.bucket}, prefix: {prefix}")
+            sizes = dict(self.iter_object_sizes(prefix=prefix))
+            logger.debug(sizes)
+            
+            return sizes
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def iter_object_sizes(self, prefix: str):
+        """Yields (key, size) of the objects under prefix as the listing pages arrive, one LIST request per 1000
+        objects. Pages are requested one by one instead of with a paginator so that each request is retried
+        """
+        page_args = dict(Bucket=self.bucket, Prefix=prefix)
+        while True:
+            page = s3.list_objects_v2(**page_args)
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith("/"):
+                    yield obj['Key'], obj['Size']
+            if not page.get('NextContinuationToken'):
+                break
+            page_args['ContinuationToken'] = page['NextContinuationToken']
+
     def list_prefixes(self, prefix: str) -> list:
         try:
             logger.info(f"Attempting prefix listing for bucket: {self.bucket}, prefix: {prefix}")
-            obj_bucket = s3.list_objects_v2(Bucket=self.bucket, Delimiter="/", Prefix=prefix.rstrip("/")+"/")
-            prefixes = obj_bucket['CommonPrefixes']
-            processed_files = [obj['Prefix'] for obj in prefixes if obj['Prefix'].endswith("/")]
+            page_args = dict(Bucket=self.bucket, Delimiter="/", Prefix=prefix.rstrip("/")+"/")
+            processed_files = []
+            while True:
+                page = s3.list_objects_v2(**page_args)
+                processed_files.extend([obj['Prefix'] for obj in page.get('CommonPrefixes', []) if obj['Prefix'].endswith("/")])
+                if not page.get('NextContinuationToken'):
+                    break
+                page_args['ContinuationToken'] = page['NextContinuationToken']
+            processed_files = list(dict.fromkeys(processed_files))
             logger.debug(processed_files)
             
             return processed_files
@@ -59,7 +121,16 @@ class S3:
             logger.debug(s3_response)
             
             content_stream = s3_response['Body']
-            content = content_stream.read()
+            if s3_response.get('ContentEncoding') == 'gzip':
+                cpu = time.process_time()
+                content = gzip.GzipFile(fileobj=content_stream, mode='rb').read()
+                cpu_ms = int((time.process_time() - cpu) * 1000)
+                logger.info(f"Decompressed {s3_response.get('ContentLength')} bytes to {len(content)} bytes in {cpu_ms}ms CPU")
+                put_metric(name='ArtifactRawBytes', value=len(content), unit='Bytes', dimensions={'Operation': 'Read'})
+                put_metric(name='ArtifactStoredBytes', value=s3_response.get('ContentLength', 0), unit='Bytes', dimensions={'Operation': 'Read'})
+                put_metric(name='ArtifactCompressionCPUTime', value=cpu_ms, unit='Milliseconds', dimensions={'Operation': 'Read'})
+            else:
+                content = content_stream.read()
             logger.debug(f"Content from object {key}")
             logger.debug(content)
             
@@ -68,12 +139,23 @@ class S3:
             logger.error(e)
             raise e
         
+    def get_object_metadata(self, key: str) -> dict:
+        try:
+            logger.info(f"Attempting to read metadata of object: {key} in bucket: {self.bucket}")
+            s3_response = s3.head_object(Bucket=self.bucket, Key=key)
+            logger.debug(s3_response)
+            
+            return s3_response.get('Metadata', {})
+        except Exception as e:
+            logger.error(e)
+            raise e
+        
     def copy_object(self, source_object: str, destination_object: str) -> bool:
         try:
             logger.info(f"Attempting copy {source_object} to {destination_object} within bucket: {self.bucket}")
             copy_source = {'Bucket': self.bucket, 'Key': source_object }
             
-            response = s3_resource.Object(self.bucket, destination_object).copy(copy_source)
+            response = s3.copy(copy_source, self.bucket, destination_object)
             logger.debug(response)
             return True
         except Exception as e:
@@ -122,6 +204,27 @@ class S3:
             logger.error(e)
             raise e
     
+    def move_keys(self, moves: dict, max_workers: int = 16) -> bool:
+        """Moves every source key in moves to its destination key. Copies run concurrently on the
+        S3 client (which is thread safe, unlike the resource) and the sources are deleted in batches of 1000
+        """
+        try:
+            logger.info(f"Attempting move of {len(moves)} objects within bucket: {self.bucket}")
+            def copy(item):
+                source_object, destination_object = item
+                s3.copy_object(Bucket=self.bucket, Key=destination_object, CopySource={'Bucket': self.bucket, 'Key': source_object})
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(copy, moves.items()))
+
+            sources = list(moves.keys())
+            for idx in range(0, len(sources), 1000):
+                self.delete_objects(objects=sources[idx:idx+1000])
+            return True
+        except Exception as e:
+            logger.error(e)
+            raise e
+
     def delete_objects(self, objects: list) -> dict:
         try:
             logger.info(f"Attempting to delete {len(objects)} objects from bucket: {self.bucket}")
@@ -141,10 +244,12 @@ class S3:
     
     def delete_prefix(self, prefix: str, filters: list = None) -> dict:
         try:
-            logger.info(f"Attempting to delete {len(objects)} objects from bucket: {self.bucket}")
             delete_us = dict(Objects=[])
             
             objects = self.list_objects(prefix=prefix, filters=filters)
+            logger.info(f"Attempting to delete {len(objects)} objects from bucket: {self.bucket}")
+            if not objects:
+                return {}
             
             for item in objects:
                 delete_us['Objects'].append(dict(Key=item))
@@ -158,13 +263,28 @@ class S3:
             logger.error(e)
             raise e
             
+    def put_object(self, key: str, body, ContentType: str = 'application/json', Metadata: dict = None, compress: bool = False) -> bool:
+        try:
+            logger.info(f"Attempting to write object {key} to bucket: {self.bucket}")
+            put_args = dict(Metadata=Metadata) if Metadata else {}
+            if compress:
+                body, content_encoding = compress_body(body)
+                if content_encoding:
+                    put_args['ContentEncoding'] = content_encoding
+            response = s3.put_object(Body=body, Bucket=self.bucket, Key=key, ContentType=ContentType, **put_args)
+            logger.debug(response)
+            return True
+        except Exception as e:
+            logger.error(e)
+            raise e
+
     def upload_file(self, source_file: str, destination_object: str, ExtraArgs: dict = None) -> bool:
         try:
             logger.info(f"Attempting to upload file {source_file} to bucket: {self.bucket}, destination: {destination_object}")
             if ExtraArgs:
-                s3_resource.Bucket(self.bucket).upload_file(source_file, destination_object, ExtraArgs=ExtraArgs)
+                s3.upload_file(source_file, self.bucket, destination_object, ExtraArgs=ExtraArgs)
             else:    
-                s3_resource.Bucket(self.bucket).upload_file(source_file, destination_object)
+                s3.upload_file(source_file, self.bucket, destination_object)
             return True
         except Exception as e:
             logger.error(e)
@@ -173,7 +293,7 @@ class S3:
     def download_file(self, source_object: str, destination_file: str) -> bool:
         try:
             logger.info(f"Attempting to download file {source_object} from bucket: {self.bucket}, to : {destination_file}")
-            s3_resource.Bucket(self.bucket).download_file(source_object, destination_file)
+            s3.download_file(self.bucket, source_object, destination_file)
             return True
         except Exception as e:
             logger.error(e)
@@ -0,0 +1,256 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Fair-share scheduling of the Textract submissions across workflows. Every workflow has its own queue of the
+documents waiting for Textract, one item per document under part_key <workflow_id>, sort_key queue/<name>, and
+workflows with queued documents are listed under part_key scheduler#active, sort_key <workflow_id> with their
+priority class, queue depth (queued) and deficit.
+
+When submission slots free up (a workflow starts or a Textract job completes) the slots are shared with deficit
+round-robin: workflows take turns, least recently started first, and a turn is worth the weight of the priority
+class of the workflow in documents. A turn cut short because the slots ran out, or because Textract throttled
+the submission, is continued first when slots free up again. A workflow's share of the submissions is therefore
+its weight over the weights of the active workflows whatever the size of its queue, so a small or urgent
+workflow is served within one round even behind a large backfill. Drained workflows leave the active list.
+Priority classes and their weights are set with SCHEDULER_WEIGHTS, workflows without a known class get
+SCHEDULER_DEFAULT_PRIORITY.
+
+Documents are claimed by deleting their queue item, so concurrent invocations never submit the same document.
+Turns (deficit, served) are written back without a condition and may lose an update under concurrency, which
+only shifts the share of one round.
+"""
+
+import json
+import logging
+import os
+from DDBFunctions import DDB
+from CheckpointFunctions import now_ms
+from MetricsFunctions import put_metric
+from RetryFunctions import retrying_client
+
+ddb = retrying_client('dynamodb')
+logger = logging.getLogger(__name__)
+
+SCHEDULER_WEIGHTS = os.environ.get('SCHEDULER_WEIGHTS', 'urgent:8,standard:2,bulk:1')
+SCHEDULER_DEFAULT_PRIORITY = os.environ.get('SCHEDULER_DEFAULT_PRIORITY', 'standard')
+ACTIVE_KEY = 'scheduler#active'
+QUEUE_PREFIX = 'queue/'
+
+def parse_weights(spec: str) -> dict:
+    """Returns the weight of every priority class of a <class>:<weight>,... spec, weights are at least 1
+    """
+    weights = {}
+    for entry in spec.split(','):
+        name, _, weight = entry.strip().partition(':')
+        if name:
+            weights[name] = max(int(weight), 1) if weight.isdigit() else 1
+    return weights
+
+WEIGHTS = parse_weights(SCHEDULER_WEIGHTS)
+
+def priority_class(priority: str) -> str:
+    if priority in WEIGHTS:
+        return priority
+    if priority:
+        logger.warning(f"Unknown priority class {priority}, using {SCHEDULER_DEFAULT_PRIORITY}")
+    return SCHEDULER_DEFAULT_PRIORITY
+
+def allocate(workflows: list, slots: int) -> list:
+    """Shares slots between the active workflows with deficit round-robin. workflows are the items of the active
+    list (sort_key, priority, queued, deficit, served), their deficit and served are updated in place. A workflow
+    whose deficit is left from its last turn continues that turn first, then the others take turns, least recently
+    started first. Returns the workflow of every slot in service order
+    """
+    active = sorted([workflow for workflow in workflows if int(workflow.get('queued', 0)) > 0],
+                    key=lambda workflow: (int(workflow.get('deficit', 0)) <= 0, int(workflow.get('served', 0)), int(workflow.get('submit_ts', 0))))
+    order = []
+    started = now_ms()
+    while slots > 0 and active:
+        for workflow in list(active):
+            if slots <= 0:
+                break
+            if int(workflow.get('deficit', 0)) <= 0:
+                # A new turn
+                workflow['deficit'] = WEIGHTS.get(workflow.get('priority'), WEIGHTS.get(SCHEDULER_DEFAULT_PRIORITY, 1))
+                workflow['served'] = started
+            remaining = int(workflow['queued']) - order.count(workflow['sort_key'])
+            count = min(int(workflow['deficit']), remaining, slots)
+            order.extend([workflow['sort_key']] * count)
+            slots -= count
+            workflow['deficit'] = 0 if count == remaining else int(workflow['deficit']) - count
+            if count == remaining:
+                active.remove(workflow)
+    return order
+
+class Scheduler:
+    def __init__(self, table: str, log_level: str = 'INFO'):
+        self.ddb = DDB(table=table, log_level=log_level)
+        self.table = table
+        # Active workflows as read by the last next_documents(), before their turns
+        self.workflows = []
+        logger.setLevel(log_level)
+
+    def queue(self, workflow_id: str, input_path: str, documents: list, priority: str = None) -> list:
+        """Writes the queue items of documents of a workflow without adding the workflow to the active list, so that
+        none is claimed before the workflow is activated. Documents already queued are not queued twice. Returns
+        the errors of the documents that could not be queued
+        """
+        if priority:
+            stmt = f"INSERT INTO \"{self.table}\" VALUE {{'part_key': ?, 'sort_key': ?, 'input_path': ?, 'priority': ?}}"
+            parameters = [[{'S': workflow_id}, {'S': f"{QUEUE_PREFIX}{doc}"}, {'S': input_path}, {'S': priority}] for doc in documents]
+        else:
+            # The priority class of the workflow is taken from the active list when the documents are claimed
+            stmt = f"INSERT INTO \"{self.table}\" VALUE {{'part_key': ?, 'sort_key': ?, 'input_path': ?}}"
+            parameters = [[{'S': workflow_id}, {'S': f"{QUEUE_PREFIX}{doc}"}, {'S': input_path}] for doc in documents]
+        errors = self.ddb.batch_execute(statement=stmt, parameters=parameters)
+        return [error for error in errors if error.get('Code') != 'DuplicateItem']
+
+    def activate(self, workflow_id: str, queued: int, priority: str = None) -> bool:
+        """Adds a workflow whose queued documents were written with queue() to the active list. A workflow is only
+        activated once, so that a repeated start does not count its documents twice. Returns whether it was
+        activated by this call
+        """
+        try:
+            priority = priority_class(priority)
+            logger.info(f"Activating workflow: {workflow_id} with {queued} queued documents and priority {priority}")
+            ddb.update_item(TableName=self.table, Key={'part_key': {'S': ACTIVE_KEY}, 'sort_key': {'S': workflow_id}},
+                            UpdateExpression="SET #priority = :priority, submit_ts = :now, #queued = :queued", ConditionExpression="attribute_not_exists(sort_key)",
+                            ExpressionAttributeNames={'#priority': 'priority', '#queued': 'queued'},
+                            ExpressionAttributeValues={':priority': {'S': priority}, ':now': {'N': str(now_ms())}, ':queued': {'N': str(queued)}})
+            return True
+        except ddb.exceptions.ConditionalCheckFailedException:
+            logger.info(f"Workflow: {workflow_id} is already active")
+            return False
+
+    def enqueue(self, workflow_id: str, input_path: str, documents: list, priority: str = None) -> int:
+        """Queues documents of a workflow for Textract and adds the workflow to the active list. Documents
+        already queued are not queued twice. Returns the number of documents queued
+        """
+        try:
+            priority = priority_class(priority)
+            logger.info(f"Queueing {len(documents)} documents of workflow: {workflow_id} with priority {priority}")
+            errors = self.queue(workflow_id=workflow_id, input_path=input_path, documents=documents, priority=priority)
+            queued = len(documents) - len(errors)
+            ddb.update_item(TableName=self.table, Key={'part_key': {'S': ACTIVE_KEY}, 'sort_key': {'S': workflow_id}},
+                            UpdateExpression="SET #priority = :priority, submit_ts = if_not_exists(submit_ts, :now) ADD #queued :queued",
+                            ExpressionAttributeNames={'#priority': 'priority', '#queued': 'queued'},
+                            ExpressionAttributeValues={':priority': {'S': priority}, ':now': {'N': str(now_ms())}, ':queued': {'N': str(queued)}})
+            return queued
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def requeue(self, documents: list):
+        """Puts claimed documents that could not be submitted back in the queue of their workflow
+        """
+        by_workflow = {}
+        for doc in documents:
+            by_workflow.setdefault((doc['workflow_id'], doc['input_path'], doc.get('priority')), []).append(doc['document_name'])
+        for (workflow_id, input_path, priority), names in by_workflow.items():
+            self.enqueue(workflow_id=workflow_id, input_path=input_path, documents=names, priority=priority)
+
+    def active(self) -> list:
+        return self.ddb.query_items(part_key=ACTIVE_KEY)
+
+    def depth(self, workflow_id: str) -> dict:
+        """Priority class and number of documents of a workflow waiting for Textract, None once none are queued
+        """
+        item = self.ddb.get_item(part_key=ACTIVE_KEY, sort_key=workflow_id)
+        return dict(priority=item.get('priority'), queued=int(item.get('queued', 0))) if item else None
+
+    def head(self, workflow_id: str, count: int) -> list:
+        """First count queue items of a workflow, as DynamoDB attribute values
+        """
+        stmt = f"SELECT \"sort_key\", \"input_path\", \"priority\" FROM \"{self.table}\" WHERE part_key=? AND begins_with(sort_key, ?)"
+        return ddb.execute_statement(Statement=stmt, Parameters=[{'S': workflow_id}, {'S': QUEUE_PREFIX}], Limit=count)['Items']
+
+    def claim(self, workflow_id: str, count: int) -> list:
+        """Takes up to count documents off the queue of a workflow, in document name order. Fewer are returned only
+        when the queue is empty
+        """
+        claimed = []
+        while len(claimed) < count:
+            items = self.head(workflow_id=workflow_id, count=count - len(claimed))
+            if not items:
+                break
+            for item in items:
+                # Deleting the queue item is the claim, an invocation that finds it already deleted lost the race
+                # and reads the head of the queue again
+                deleted = ddb.delete_item(TableName=self.table, Key={'part_key': {'S': workflow_id}, 'sort_key': item['sort_key']}, ReturnValues='ALL_OLD')
+                if 'Attributes' in deleted:
+                    claimed.append(dict(workflow_id=workflow_id, input_path=item['input_path']['S'], document_name=item['sort_key']['S'][len(QUEUE_PREFIX):],
+                                        priority=item.get('priority', {}).get('S')))
+        return claimed
+
+    def drained(self, workflow_id: str, queued: dict):
+        """Removes a workflow whose queue is empty from the active list, unless documents were queued again since
+        its queue depth was queued
+        """
+        try:
+            ddb.delete_item(TableName=self.table, Key={'part_key': {'S': ACTIVE_KEY}, 'sort_key': {'S': workflow_id}}, ConditionExpression="#queued = :seen",
+                            ExpressionAttributeNames={'#queued': 'queued'}, ExpressionAttributeValues={':seen': queued})
+        except ddb.exceptions.ConditionalCheckFailedException:
+            logger.info(f"Documents of workflow: {workflow_id} were queued again")
+
+    def next_documents(self, slots: int) -> list:
+        """Claims the documents to submit to Textract in slots free submission slots, shared between the workflows
+        with deficit round-robin. Returns the claimed documents (workflow_id, input_path, document_name, priority)
+        in service order. The turns are only charged by settle(), for the documents actually submitted
+        """
+        try:
+            self.workflows = self.active()
+            order = allocate(workflows=[dict(workflow) for workflow in self.workflows], slots=slots)
+            claimed = {}
+            for workflow in self.workflows:
+                workflow_id = workflow['sort_key']
+                requested = order.count(workflow_id)
+                if not requested:
+                    continue
+                claimed[workflow_id] = self.claim(workflow_id=workflow_id, count=requested)
+                for doc in claimed[workflow_id]:
+                    doc['priority'] = doc['priority'] or workflow.get('priority')
+                try:
+                    ddb_response = ddb.update_item(TableName=self.table, Key={'part_key': {'S': ACTIVE_KEY}, 'sort_key': {'S': workflow_id}},
+                                                   UpdateExpression="ADD #queued :claimed", ConditionExpression="attribute_exists(sort_key)",
+                                                   ExpressionAttributeNames={'#queued': 'queued'}, ExpressionAttributeValues={':claimed': {'N': str(-len(claimed[workflow_id]))}},
+                                                   ReturnValues='UPDATED_NEW')
+                except ddb.exceptions.ConditionalCheckFailedException:
+                    # Another invocation drained the queue and removed the workflow meanwhile
+                    continue
+                queued = ddb_response['Attributes']['queued']
+                # Fewer documents than requested means the queue is empty whatever the count says
+                if len(claimed[workflow_id]) < requested or (int(queued['N']) <= 0 and not self.head(workflow_id=workflow_id, count=1)):
+                    self.drained(workflow_id=workflow_id, queued=queued)
+            documents = [claimed[workflow_id].pop(0) for workflow_id in order if claimed.get(workflow_id)]
+
+            depths = {workflow['sort_key']: dict(priority=workflow.get('priority'), queued=int(workflow.get('queued', 0)), deficit=int(workflow.get('deficit', 0)),
+                                                 claimed=order.count(workflow['sort_key'])) for workflow in self.workflows}
+            logger.info(json.dumps(dict(scheduler=depths)))
+            by_priority = {}
+            for depth in depths.values():
+                by_priority[depth['priority']] = by_priority.get(depth['priority'], 0) + depth['queued']
+            for priority, queued in by_priority.items():
+                put_metric(name='QueuedDocuments', value=queued, dimensions={'Priority': str(priority)})
+            return documents
+        except Exception as e:
+            logger.error(e)
+            raise e
+
+    def settle(self, submitted: int):
+        """Charges the turns of the workflows for the first submitted documents of the last next_documents(), the
+        others were queued again. Deficit round-robin is deterministic, so the turns are those of submitted slots
+        """
+        workflows = [dict(workflow) for workflow in self.workflows]
+        allocate(workflows=workflows, slots=submitted)
+        for before, workflow in zip(self.workflows, workflows):
+            if (before.get('deficit'), before.get('served')) == (workflow.get('deficit'), workflow.get('served')):
+                continue
+            try:
+                ddb.update_item(TableName=self.table, Key={'part_key': {'S': ACTIVE_KEY}, 'sort_key': {'S': workflow['sort_key']}},
+                                UpdateExpression="SET #deficit = :deficit, #served = :served", ConditionExpression="attribute_exists(sort_key)",
+                                ExpressionAttributeNames={'#deficit': 'deficit', '#served': 'served'},
+                                ExpressionAttributeValues={':deficit': {'N': str(int(workflow['deficit']))}, ':served': {'N': str(int(workflow['served']))}})
+            except ddb.exceptions.ConditionalCheckFailedException:
+                # Drained meanwhile
+                pass
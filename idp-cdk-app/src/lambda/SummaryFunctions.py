@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+De-identification summary of a workflow, materialized once at public/output/<workflow_id>/summary.json when
+redaction finishes so the detail API reads one small object instead of listing the workflow output and parsing
+the Manifest on every call. The summary also holds the header of the workflow detail (workflow_header), so the
+detail of a processed workflow is served from it alone.
+"""
+
+import decimal
+import json
+import logging
+import os
+from S3Functions import S3
+from CheckpointFunctions import timeline
+
+logger = logging.getLogger(__name__)
+
+def summary_key(workflow_id: str) -> str:
+    return f"public/output/{workflow_id}/summary.json"
+
+ENCODING_ATTRIBUTES = ['encoding_profile', 'source_bytes', 'redacted_bytes', 'encode_ms']
+
+def plain(value):
+    """DynamoDB numbers of a deserialized item as int or float
+    """
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, dict):
+        return {name: plain(item) for name, item in value.items()}
+    return value
+
+def workflow_header(workflow: dict, documents: list = None) -> dict:
+    """Header of the workflow detail from the deserialized workflow item: the item without its keys, callback
+    token and step timings, with the timeline of documents (its document items) when given
+    """
+    header = {name: value for name, value in workflow.items() if name not in ('part_key', 'sort_key', 'workflow_token') and not name.startswith('step_')}
+    header['workflow_id'] = workflow['part_key']
+    if documents is not None:
+        # Stage start, end and p50/p95 document latencies, see CheckpointFunctions
+        header['timeline'] = timeline(workflow=workflow, documents=documents)
+    return plain(header)
+
+def build_summary(s3: S3, workflow_id: str, documents: dict = None, failed_jobs: list = None) -> dict:
+    """Returns the redacted documents with the paths of their PHI entities and the parsed PHI detection Manifest.
+    documents are the document items of the workflow (see Checkpoints), their encoding statistics are added to
+    the redacted documents. failed_jobs are the PHI detection jobs that failed, whose documents were not redacted
+    """
+    summary = {}
+    redacted_docs = s3.list_objects(prefix=f"public/output/{workflow_id}/", search=["/redacted-doc/"])
+    manifest_content = s3.get_object_content(key=f"public/output/{workflow_id}/Manifest")
+
+    if redacted_docs and len(redacted_docs) >0:
+        summary["redacted_documents"] = [ {"document": os.path.basename(k),"doc_path":k.replace("public/",""), "phi_json": f"{os.path.dirname(k).replace('/redacted-doc','').replace('public/','')}/{os.path.splitext(os.path.basename(k))[0]}.comp-med"} for k in redacted_docs]
+    documents = documents if documents else {}
+    for redacted in summary.get("redacted_documents", []):
+        item = documents.get(redacted["document"], {})
+        redacted.update({name: int(item[name]) if name != 'encoding_profile' else item[name] for name in ENCODING_ATTRIBUTES if name in item})
+    if manifest_content:
+        summary["phi_manifest"] = json.loads(manifest_content)
+    if failed_jobs:
+        summary["failed_jobs"] = failed_jobs
+    return summary
+
+def get_summary(s3: S3, workflow_id: str) -> dict:
+    """Returns the materialized summary, None for workflows processed before summaries were written
+    """
+    try:
+        return json.loads(s3.get_object_content(key=summary_key(workflow_id)))
+    except Exception as e:
+        logger.info(f"No summary for workflow {workflow_id}: {e}")
+        return None
@@ -0,0 +1,389 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import botocore.exceptions
+import json
+import logging
+import os
+import uuid
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+from S3Functions import S3
+from DDBFunctions import DDB
+from CacheFunctions import DocumentCache
+from CheckpointFunctions import Checkpoints
+from PhiRuleFunctions import PHI_RULES_MODE
+from SchedulerFunctions import Scheduler
+from ClientFunctions import LazyClient
+from RetryFunctions import retrying_client
+
+# Disable Boto3 retries since the message will be processed
+# via notification channel
+retry_config = Config(
+   retries = {
+      'max_attempts': 0,
+      'mode': 'standard'
+   }
+)
+
+deserializer = TypeDeserializer()
+sfn = LazyClient('stepfunctions')
+textract = LazyClient('textract', config=retry_config)
+ddb = retrying_client('dynamodb')
+s3 = retrying_client('s3')
+lambda_client = LazyClient('lambda')
+logger = logging.getLogger(__name__)
+
+FEATURE_TYPES = ['TABLES','FORMS']
+# Processing profiles of a workflow: the Textract feature types its documents are analyzed with. Redaction only
+# needs the LINE text and geometry, ocr uses text detection, which is faster and cheaper than forms and tables
+# analysis and produces smaller JSON. Workflows without a profile use TEXTRACT_PROFILE
+TEXTRACT_PROFILES = {'analysis': FEATURE_TYPES, 'ocr': []}
+TEXTRACT_PROFILE = os.environ.get('TEXTRACT_PROFILE', 'analysis')
+# PDFs of more than TEXTRACT_SPLIT_PAGES pages are analyzed in parts of TEXTRACT_PART_PAGES pages, 0 disables splitting
+TEXTRACT_SPLIT_PAGES = int(os.environ.get('TEXTRACT_SPLIT_PAGES', '0'))
+TEXTRACT_PART_PAGES = int(os.environ.get('TEXTRACT_PART_PAGES', '100'))
+
+def textract_features(profile: str) -> list:
+    """Feature types of a processing profile, those of TEXTRACT_PROFILE for an unknown one
+    """
+    if profile and profile not in TEXTRACT_PROFILES:
+        logger.warning(f"Unknown Textract profile {profile}, using {TEXTRACT_PROFILE}")
+    return TEXTRACT_PROFILES.get(profile, TEXTRACT_PROFILES.get(TEXTRACT_PROFILE, FEATURE_TYPES))
+
+def cache_features(features: list) -> str:
+    """Features part of the cache entry key, so that text detection and analysis outputs are cached apart
+    """
+    return ",".join(features) if features else "TEXT"
+
+def materialize_cached(doc: dict, entry: dict, env_vars: dict) -> str:
+    """Copies the cached artifacts of a document into the layout the Textract post-processing would have
+    produced for the workflow and writes the temp processing file, so the document counts as processed.
+    When the Comprehend Medical output is cached too, or the rule based PHI entities cover the document and
+    PHI_RULES_MODE is skip, it is staged under phi-cached/ instead of writing the PHI input text, so that the
+    document skips the PHI detection job. Returns the output directory id.
+    """
+    workflow_id = doc['workflow_id']
+    document = doc['document_name']
+    job_id = f"cached-{uuid.uuid4().hex}"
+    bucket = S3(bucket=env_vars['IDP_INPUT_BKT'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+
+    bucket.copy_object(source_object=entry['textract_json'], destination_object=f"public/output/{workflow_id}/{job_id}/{document}.json")
+    if entry.get('report'):
+        bucket.copy_object(source_object=entry['report'], destination_object=f"public/output/{workflow_id}/{job_id}/{document}-report.xlsx")
+    if entry.get('phi_rules'):
+        bucket.copy_object(source_object=entry['phi_rules'], destination_object=f"public/output/{workflow_id}/{job_id}/{document}.phi-rules")
+    if entry.get('comp_med'):
+        bucket.copy_object(source_object=entry['comp_med'], destination_object=f"public/phi-cached/{workflow_id}/{job_id}/{document}.txt.out")
+    elif entry.get('phi_covered') and PHI_RULES_MODE == 'skip':
+        bucket.copy_object(source_object=entry['phi_rules'], destination_object=f"public/phi-cached/{workflow_id}/{job_id}/{document}.txt.out")
+    else:
+        bucket.copy_object(source_object=entry['phi_text'], destination_object=f"public/phi-input/{workflow_id}/{job_id}/{document}.txt")
+
+    file_to_process = {document: {"S": f"succeeded:{job_id}"}}
+    s3.put_object(Body=json.dumps(file_to_process), Bucket=env_vars['IDP_INPUT_BKT'], Key=f"public/temp/{workflow_id}/{document}.json")
+    checkpoints = Checkpoints(table=env_vars['IDP_TABLE'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+    checkpoints.record(workflow_id=workflow_id, document=document, stage='ocr', job_id=job_id)
+    checkpoints.record(workflow_id=workflow_id, document=document, stage='text')
+    logger.debug(f"Cached artifacts of {document} copied to public/output/{workflow_id}/{job_id}")
+    return job_id
+
+def complete_workflow(workflow_id: str, bucket: str, root_prefix: str, env_vars: dict):
+    """Sends the task success to the state machine once every document of the workflow has a temp processing
+    file. Returns None while documents remain to be processed.
+    """
+    s3_bucket = S3(bucket=bucket, log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+    processed_files = s3_bucket.list_objects(prefix=f"{root_prefix}/temp/{workflow_id}")
+    files = s3_bucket.list_objects(prefix=f"{root_prefix}/input/{workflow_id}")
+
+    if len(processed_files) < len(files):
+        return None
+
+    #Post to state machine that workflow is done
+    select = f"SELECT \"workflow_token\" FROM \"{env_vars['IDP_TABLE']}\" WHERE part_key=? AND sort_key=?"
+    ddb_response = ddb.execute_statement(Statement=select, Parameters=[
+                                                    {'S': workflow_id},
+                                                    {'S': f"input/{workflow_id}/"}
+                                                ])
+    deserialized_document = {k: deserializer.deserialize(v) for k, v in ddb_response['Items'][0].items()}
+    if 'workflow_token' not in deserialized_document:
+        # The state machine has not reached the Textract step yet, it will check completion itself
+        logger.info(f"No callback token for workflow {workflow_id} yet")
+        return None
+    sm_token = deserialized_document['workflow_token']
+    try:
+        smresponse = sfn.send_task_success(taskToken=sm_token,
+                                           output=json.dumps({
+                                                                "Payload": {
+                                                                        "workflow_id": workflow_id,
+                                                                        "bucket": bucket,
+                                                                        "tmp_process_dir": f"{root_prefix}/temp/{workflow_id}",
+                                                                        "phi_input_dir": f"{root_prefix}/phi-input/{workflow_id}"
+                                                                    }
+                                                            }))
+    except (sfn.exceptions.TaskTimedOut, sfn.exceptions.TaskDoesNotExist, sfn.exceptions.InvalidToken) as e:
+        # Another invocation already completed the task
+        logger.info(f"Workflow {workflow_id} task already completed: {e}")
+        return None
+    logger.debug(smresponse)
+    return smresponse
+
+def mark_processed(workflow_id: str, document: str, status: str, job_id: str, bucket: str, root_prefix: str, env_vars: dict):
+    """Writes the temp processing file of a document, once it is processed or failed, and sends the task success
+    to the state machine when it was the last document of the workflow
+    """
+    file_to_process = {document: {"S": f"{status}:{job_id}"}}
+    s3.put_object(Body=json.dumps(file_to_process), Bucket=bucket, Key=f"{root_prefix}/temp/{workflow_id}/{document}.json")
+    logger.debug(f"Updated temp processing file {root_prefix}/temp/{workflow_id}/{document}.json")
+    return complete_workflow(workflow_id=workflow_id, bucket=bucket, root_prefix=root_prefix, env_vars=env_vars)
+
+def start_textract_job(document_key: str, workflow_id: str, output_prefix: str, env_vars: dict, features: list = FEATURE_TYPES) -> str:
+    """Starts an async Textract document analysis job with the features given, or a text detection job without
+    features, whose completion is notified on the SNS topic
+    """
+    try:
+        job_args = dict(DocumentLocation={
+                            'S3Object': {
+                                'Bucket': env_vars['IDP_INPUT_BKT'],
+                                'Name': document_key,
+                            }
+                        },
+                        JobTag=workflow_id,
+                        NotificationChannel={
+                            'SNSTopicArn': env_vars['SNS_TOPIC'],
+                            'RoleArn': env_vars['SNS_ROLE']
+                        },
+                        OutputConfig={
+                            'S3Bucket': env_vars['IDP_INPUT_BKT'],
+                            'S3Prefix': output_prefix
+                        })
+        if features:
+            txrct_response = textract.start_document_analysis(FeatureTypes=features, **job_args)
+        else:
+            txrct_response = textract.start_document_text_detection(**job_args)
+        logger.debug(json.dumps(txrct_response))
+        return txrct_response['JobId']
+    except botocore.exceptions.ClientError as error:
+        if (error.response['Error']['Code'] == 'LimitExceededException'
+            or error.response['Error']['Code'] == 'ThrottlingException'
+            or error.response['Error']['Code'] == 'ProvisionedThroughputExceededException'
+            ):
+            logger.warn('API call limit exceeded; backing off...')
+            raise error
+        else:
+            logger.error(error)
+            return None
+
+def split_document(doc: dict, local_path: str, env_vars: dict) -> list:
+    """Splits a PDF of more than TEXTRACT_SPLIT_PAGES pages into parts of TEXTRACT_PART_PAGES pages under
+    public/parts/<workflow_id>/<document>/ so the parts can be analyzed by parallel Textract jobs. The parts
+    are described in parts.json next to them, which the SNS handler uses to know when all of them completed.
+    Returns the keys of the parts to start a job for, None when the document is not split.
+
+    A document queued again after the jobs of some of its parts were started (see get_msg_submit) is not split
+    again, only its parts without a started/ or done/ marker are returned.
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    workflow_id = doc['workflow_id']
+    document = doc['document_name']
+    parts_prefix = f"public/parts/{workflow_id}/{document}"
+    bucket = S3(bucket=env_vars['IDP_INPUT_BKT'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+    existing = bucket.list_objects(prefix=f"{parts_prefix}/")
+    if f"{parts_prefix}/parts.json" in existing:
+        manifest = json.loads(bucket.get_object_content(key=f"{parts_prefix}/parts.json"))
+        markers = {os.path.basename(key)[:-len('.json')] for key in existing if key.startswith((f"{parts_prefix}/started/", f"{parts_prefix}/done/"))}
+        remaining = [part['key'] for part in manifest['parts'] if os.path.basename(part['key']) not in markers]
+        logger.info(f"{document} was already split, {len(remaining)} of {len(manifest['parts'])} parts left to start")
+        return remaining
+
+    reader = PdfReader(local_path)
+    num_pages = len(reader.pages)
+    if num_pages <= TEXTRACT_SPLIT_PAGES:
+        return None
+
+    logger.info(f"Splitting {document} of {num_pages} pages into parts of {TEXTRACT_PART_PAGES} pages")
+
+    parts = []
+    for idx, first_page in enumerate(range(0, num_pages, TEXTRACT_PART_PAGES)):
+        writer = PdfWriter()
+        for page in reader.pages[first_page:first_page+TEXTRACT_PART_PAGES]:
+            writer.add_page(page)
+        part_path = f"/tmp/part-{idx:03d}.pdf"
+        with open(part_path, 'wb') as part_file:
+            writer.write(part_file)
+        part_key = f"{parts_prefix}/part-{idx:03d}.pdf"
+        bucket.upload_file(source_file=part_path, destination_object=part_key)
+        os.remove(part_path)
+        parts.append(dict(key=part_key, first_page=first_page+1))
+
+    bucket.put_object(key=f"{parts_prefix}/parts.json", body=json.dumps(dict(document=document, pages=num_pages, parts=parts)))
+    return [part['key'] for part in parts]
+
+def start_part(part_key: str, job_id: str, env_vars: dict):
+    """Records the Textract job started for a document part under started/ next to the parts
+    """
+    bucket = S3(bucket=env_vars['IDP_INPUT_BKT'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+    bucket.put_object(key=f"{os.path.dirname(part_key)}/started/{os.path.basename(part_key)}.json", body=json.dumps(dict(job_id=job_id)))
+
+def complete_part(part_key: str, job_id: str, status: str, env_vars: dict) -> list:
+    """Records the Textract job of a document part under done/ next to the parts. Returns the parts of the
+    document, each with the job_id and status of its job, once every part completed, None until then. Of the
+    concurrent completions of the last parts, only the one whose conditional insert of the parts/<document> item
+    of the workflow succeeds gets the parts, so that the document is merged and marked processed once.
+    """
+    bucket = S3(bucket=env_vars['IDP_INPUT_BKT'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+    parts_prefix = os.path.dirname(part_key)
+    bucket.put_object(key=f"{parts_prefix}/done/{os.path.basename(part_key)}.json", body=json.dumps(dict(job_id=job_id, status=status)))
+
+    manifest = json.loads(bucket.get_object_content(key=f"{parts_prefix}/parts.json"))
+    done = bucket.list_objects(prefix=f"{parts_prefix}/done/")
+    if len(done) < len(manifest['parts']):
+        return None
+
+    workflow_id = parts_prefix.split('/')[2]
+    try:
+        ddb.execute_statement(Statement=f"INSERT INTO \"{env_vars['IDP_TABLE']}\" VALUE {{'part_key': ?, 'sort_key': ?}}",
+                              Parameters=[{'S': workflow_id}, {'S': f"parts/{manifest['document']}"}])
+    except ddb.exceptions.DuplicateItemException:
+        logger.info(f"Parts of {manifest['document']} already completed by another invocation")
+        return None
+
+    parts = []
+    for part in manifest['parts']:
+        part.update(json.loads(bucket.get_object_content(key=f"{parts_prefix}/done/{os.path.basename(part['key'])}.json")))
+        parts.append(part)
+    return parts
+
+def complete_document(workflow_id: str, document: str, parts: list, env_vars: dict, textract_profile: str = 'analysis') -> str:
+    """Invokes the Textract post-processing of a split document once all its parts completed, which writes its
+    temp processing file. The document fails if any of its parts failed, the temp processing file is then written
+    here. Returns the document status.
+    """
+    failed = [part for part in parts if part['status'] != 'succeeded']
+    status = 'failed' if failed else 'succeeded'
+    job_id = parts[0]['job_id']
+
+    if not failed:
+        logger.debug(f"Invoking post processing for {len(parts)} parts of {document} asynchronously")
+        lambda_payload = {
+                            "workflow_id": workflow_id,
+                            "output_path": f"public/output/{workflow_id}/{job_id}",
+                            "doc_name": document,
+                            "parts_output_prefix": f"public/parts-output/{workflow_id}",
+                            "part_jobs": [dict(job_id=part['job_id'], first_page=part['first_page']) for part in parts],
+                            "textract_profile": textract_profile
+                        }
+        lambda_client.invoke(FunctionName=env_vars['LAMBDA_POST_PROCESS'],
+                             InvocationType='Event',
+                             Payload=json.dumps(lambda_payload))
+        Checkpoints(table=env_vars['IDP_TABLE'], log_level=env_vars.get('LOG_LEVEL', 'INFO')).record(workflow_id=workflow_id, document=document, stage='ocr', job_id=job_id)
+    else:
+        logger.error(f"{len(failed)} of {len(parts)} parts of {document} failed")
+        file_to_process = {document: {"S": f"{status}:{job_id}"}}
+        s3.put_object(Body=json.dumps(file_to_process), Bucket=env_vars['IDP_INPUT_BKT'], Key=f"public/temp/{workflow_id}/{document}.json")
+    return status
+
+def get_msg_submit(event, env_vars, num_msgs):
+    """Starts an async Textract job for each of the next num_msgs documents of the workflow queues, shared between
+    the workflows by the scheduler (see SchedulerFunctions). Documents whose content is already in the cache are
+    materialized from it instead, and large PDFs are split into page ranges analyzed by one job each. Since only
+    job notifications keep the submission going, submitting continues until at least one job was started or the
+    queues are drained. Documents not submitted because of an error (e.g. Textract throttling) are queued again.
+    """
+    try:
+        logger.setLevel(env_vars.get('LOG_LEVEL', 'INFO'))
+        workflows = DDB(table=env_vars['IDP_TABLE'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+        bucket = S3(bucket=env_vars['IDP_INPUT_BKT'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+        checkpoints = Checkpoints(table=env_vars['IDP_TABLE'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+        scheduler = Scheduler(table=env_vars['IDP_TABLE'], log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+        jobs=[]
+        cached_workflows = set()
+        # Feature types and cache of every workflow, from the processing profile of the workflow item
+        features, caches = {}, {}
+
+        while not jobs:
+            logger.debug("Getting the next documents from the workflow queues")
+            documents = scheduler.next_documents(slots=num_msgs)
+            logger.debug(json.dumps(documents))
+            if not documents:
+                break
+
+            submitted = 0
+            try:
+                for doc in documents:
+                    workflow_id = doc['workflow_id']
+                    if workflow_id not in features:
+                        workflow = workflows.get_item(part_key=workflow_id, sort_key=f"input/{workflow_id}/")
+                        features[workflow_id] = textract_features(workflow.get('textract_profile') if workflow else None)
+                        caches[workflow_id] = DocumentCache(table=env_vars['IDP_TABLE'], features=cache_features(features[workflow_id]), log_level=env_vars.get('LOG_LEVEL', 'INFO'))
+                    submit_document(doc=doc, jobs=jobs, cached_workflows=cached_workflows, cache=caches[workflow_id], bucket=bucket, checkpoints=checkpoints,
+                                    env_vars=env_vars, features=features[workflow_id])
+                    submitted += 1
+            except Exception:
+                scheduler.requeue(documents[submitted:])
+                raise
+            finally:
+                scheduler.settle(submitted=submitted)
+
+        for workflow_id in cached_workflows:
+            complete_workflow(workflow_id=workflow_id, bucket=env_vars['IDP_INPUT_BKT'], root_prefix="public", env_vars=env_vars)
+
+        return jobs
+    except Exception as error:
+        raise error
+
+def submit_document(doc: dict, jobs: list, cached_workflows: set, cache: DocumentCache, bucket: S3, checkpoints: Checkpoints, env_vars: dict,
+                    features: list = FEATURE_TYPES):
+    """Starts the Textract job (or the jobs of the parts) of a document claimed from its workflow queue with the
+    feature types of its workflow, adds the job ids to jobs, or materializes the document from the cache and adds
+    its workflow to cached_workflows
+    """
+    document_key = f"public/{doc['input_path']}{doc['document_name']}"
+    checkpoints.start(workflow_id=doc['workflow_id'], document=doc['document_name'], stage='ocr')
+
+    # PDFs are only downloaded when they may have to be split
+    local_path = None
+    if TEXTRACT_SPLIT_PAGES and doc['document_name'].lower().endswith('.pdf'):
+        local_path = f"/tmp/{os.path.basename(doc['document_name'])}"
+        bucket.download_file(source_object=document_key, destination_file=local_path)
+
+    try:
+        if cache.enabled:
+            digest = cache.digest_file(path=local_path) if local_path else cache.digest(bucket=env_vars['IDP_INPUT_BKT'], key=document_key)
+            cache.record_document(workflow_id=doc['workflow_id'], document=doc['document_name'], digest=digest)
+            entry = cache.lookup(digest=digest, stage='textract')
+            if entry and entry.get('textract_json'):
+                try:
+                    materialize_cached(doc=doc, entry=entry, env_vars=env_vars)
+                    cached_workflows.add(doc['workflow_id'])
+                    return
+                except Exception as e:
+                    # Cached artifacts may have been deleted with their workflow, process the document again
+                    logger.warning(f"Unable to use cached artifacts for {doc['document_name']}: {e}")
+
+        part_keys = split_document(doc=doc, local_path=local_path, env_vars=env_vars) if local_path else None
+    finally:
+        if local_path and os.path.isfile(local_path):
+            os.remove(local_path)
+
+    if part_keys is not None:
+        logger.debug(f"Starting Async Textract jobs for workflow: {doc['workflow_id']}, document: {doc['document_name']}, parts: {len(part_keys)}")
+        for part_key in part_keys:
+            job_id = start_textract_job(document_key=part_key, workflow_id=doc['workflow_id'], output_prefix=f"public/parts-output/{doc['workflow_id']}", env_vars=env_vars,
+                                        features=features)
+            if job_id:
+                start_part(part_key=part_key, job_id=job_id, env_vars=env_vars)
+                jobs.append(job_id)
+            else:
+                # No notification will come for this part, record it as failed so the document completes
+                parts = complete_part(part_key=part_key, job_id=None, status='failed', env_vars=env_vars)
+                if parts:
+                    complete_document(workflow_id=doc['workflow_id'], document=doc['document_name'], parts=parts, env_vars=env_vars)
+    else:
+        logger.debug(f"Starting Async Textract job for workflow: {doc['workflow_id']}, document: {doc['document_name']}")
+        job_id = start_textract_job(document_key=document_key, workflow_id=doc['workflow_id'], output_prefix=f"public/output/{doc['workflow_id']}", env_vars=env_vars,
+                                    features=features)
+        if job_id:
+            jobs.append(job_id)
+    logger.debug(f"Textract {'analysis' if features else 'text detection'} job submitted for {doc['document_name']}")
@@ -0,0 +1,55 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+On-failure destination of the functions the pipeline invokes asynchronously. Lambda sends it the record of an
+invocation that failed every attempt (error, timeout or crash), with the event of the invocation as requestPayload:
+    streamed redaction (idp-phi-redact-doc with stream)   the documents count as processed for the workflow, like
+                                                           the documents finish_streamed marks after a failed
+                                                           redaction, and are redacted by the redaction Map
+    Textract post-processing (idp-process-textract-output)  the document counts as failed. The post-processing
+                                                           raises on errors and leaves the marking to this
+                                                           function, so a retry that succeeds counts once
+Without it the workflow would wait for these documents forever on its Textract callback task.
+"""
+
+import os
+import json
+import logging
+from TextractFunctions import mark_processed
+from MetricsFunctions import put_metric
+from ProfileFunctions import profiled
+from RetryFunctions import time_budget
+
+logger = logging.getLogger(__name__)
+
+def streamed_redaction_failed(payload: dict):
+    for doc in payload['redact_data']:
+        logger.warning(f"Streamed redaction of {doc['doc']} failed, leaving it to the redaction Map")
+        mark_processed(workflow_id=payload['workflow_id'], document=os.path.basename(doc['doc']), status='succeeded', job_id=doc['job_id'],
+                       bucket=payload['bucket'], root_prefix=doc['doc'].split('/')[0], env_vars=dict(os.environ))
+
+def post_processing_failed(payload: dict):
+    dirs = payload['output_path'].split('/')
+    logger.warning(f"Post-processing of {payload['doc_name']} failed, marking it failed")
+    mark_processed(workflow_id=payload['workflow_id'], document=payload['doc_name'], status='failed', job_id=dirs[-1],
+                   bucket=os.environ.get('IDP_BKT'), root_prefix=dirs[0], env_vars=dict(os.environ))
+
+@profiled
+@time_budget
+def lambda_handler(event, context):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(json.dumps(event))
+
+    payload = event.get('requestPayload') or {}
+    condition = event.get('requestContext', {}).get('condition')
+    function = event.get('requestContext', {}).get('functionArn', '').split(':function:')[-1].split(':')[0]
+    put_metric(name='AsyncInvokeFailed', dimensions={'Function': function or 'unknown'})
+    if payload.get('stream') and payload.get('redact_data'):
+        streamed_redaction_failed(payload)
+    elif payload.get('output_path') and payload.get('doc_name'):
+        post_processing_failed(payload)
+    else:
+        logger.error(f"No failure handling for the event of {function} ({condition})")
+    return dict(Success=True)
@@ -1,24 +1,187 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 import json
 import logging
 import decimal
+import base64
+import datetime
+import hashlib
+import gzip
+import time
 from S3Functions import S3
+from DDBFunctions import DDB
+from SummaryFunctions import build_summary, get_summary, workflow_header
+from SchedulerFunctions import Scheduler
 from boto3.dynamodb.types import TypeDeserializer
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
 
-ddb = boto3.client('dynamodb')
+ddb = retrying_client('dynamodb')
 deserializer = TypeDeserializer()
 logger = logging.getLogger(__name__)
 
+LIST_INDEX = 'submit_day-submit_ts-index'
+# The listing never returns the docs map, the detail of a workflow is fetched by its workflow id
+LIST_ATTRIBUTES = ['part_key', 'sort_key', 'submit_ts', 'status', 'de_identification_status', 'total_files', 'de_identify', 'retain_orig_docs']
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', '100'))
+LIST_MAX_DAYS = 366
+
+# Warm container cache of the detail responses of workflows in a final state, (workflow_id, query) -> (expiry, ETag,
+# serialized body), holding at most DETAIL_CACHE_SIZE responses
+DETAIL_CACHE_TTL = int(os.environ.get('DETAIL_CACHE_TTL', '300'))
+DETAIL_CACHE_SIZE = int(os.environ.get('DETAIL_CACHE_SIZE', '256'))
+FINAL_DEID_STATUSES = ['processed', 'not_requested', 'failed']
+detail_cache = {}
+# Detail lists are returned in pages of DOC_PAGE_SIZE, next page cursor name -> list name
+DOC_PAGE_SIZE = int(os.environ.get('DOC_PAGE_SIZE', '500'))
+PAGED_LISTS = {'nextDocumentsKey': 'documents', 'nextRedactedKey': 'redacted_documents'}
+# Detail bodies of at least GZIP_MIN_BYTES are gzip compressed for clients that accept it
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', '8192'))
+
+class InvalidCursor(ValueError):
+    pass
+
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, decimal.Decimal):
-            return str(o)
+            return int(o) if o == o.to_integral_value() else float(o)
         return super(DecimalEncoder, self).default(o)
 
+def get_days(start: int, end: int) -> list:
+    """Returns the UTC days (submit_day values) overlapping the submit_ts range [start, end] in epoch milliseconds
+    """
+    first = datetime.datetime.utcfromtimestamp(start/1000).date()
+    last = datetime.datetime.utcfromtimestamp(end/1000).date()
+    num_days = min((last - first).days + 1, LIST_MAX_DAYS)
+    return [(first + datetime.timedelta(days=idx)).strftime('%Y-%m-%d') for idx in range(num_days)]
+
+def list_workflows(table: str, start: int, end: int, limit: int, cursor: str = None):
+    """Lists the workflows submitted between start and end from the submit_day-submit_ts-index, one day bucket
+    after the other, so the cost depends on the number of workflows returned and not on the table size. Returns
+    at most limit workflows and an opaque cursor to continue from, None once the range is exhausted. Raises
+    InvalidCursor for a cursor that is malformed or does not belong to the range.
+    """
+    days = get_days(start, end)
+    next_token = None
+    if cursor:
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            days = days[days.index(position['day']):]
+            next_token = position.get('token')
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidCursor(f"Invalid cursor {cursor}") from e
+
+    projection = ", ".join([f'"{name}"' for name in LIST_ATTRIBUTES])
+    stmt = f"SELECT {projection} FROM \"{table}\".\"{LIST_INDEX}\" WHERE submit_day=? AND submit_ts BETWEEN ? AND ?"
+    workflows = []
+    for day in days:
+        while True:
+            params = dict(Statement=stmt, Parameters=[{'S': day}, {'N': str(start)}, {'N': str(end)}], Limit=limit - len(workflows))
+            if next_token:
+                params['NextToken'] = next_token
+            ddbresponse = ddb.execute_statement(**params)
+            workflows.extend([{k: deserializer.deserialize(v) for k, v in item.items()} for item in ddbresponse['Items']])
+            next_token = ddbresponse.get('NextToken')
+            if len(workflows) >= limit:
+                # Continue with the rest of this day, or with the next day
+                if next_token:
+                    position = dict(day=day, token=next_token)
+                elif day != days[-1]:
+                    position = dict(day=days[days.index(day)+1])
+                else:
+                    return workflows, None
+                return workflows, base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+            if not next_token:
+                break
+    return workflows, None
+
+def document_entry(item: dict) -> dict:
+    return {"document": item['sort_key'][len("doc/"):], "status": item.get('doc_status', 'ready'), "jobid": item.get('job_id', '')}
+
+def get_workflow_detail(idpTable: str, bucket: str, workflow_id: str, log_level: str, with_timeline: bool = False) -> dict:
+    """Returns the header of a workflow detail. A processed workflow is served from its summary alone, which holds
+    the header (see SummaryFunctions). Otherwise the header is the workflow item with its queue depth, and the
+    timeline with with_timeline, which needs every document item. The documents are read a page at a time by
+    get_detail_page, except for workflows submitted before documents got their own items
+    """
+    s3 = S3(bucket=bucket, log_level=log_level)
+    # Written by idp-write-wf-summary when redaction finished
+    summary = get_summary(s3=s3, workflow_id=workflow_id)
+    if summary and 'header' in summary:
+        des_doc = summary.pop('header')
+        des_doc.update(summary)
+        return des_doc
+
+    stmt = f"SELECT * FROM \"{idpTable}\" WHERE part_key=? AND sort_key=?"
+    part_key = f"input/{workflow_id}/"
+    ddbresponse = ddb.execute_statement(Statement=stmt, Parameters=[                                                            
+                                                        {'S': workflow_id},
+                                                        {'S': part_key}
+                                                    ])
+
+    workflow = {k: deserializer.deserialize(v) for k, v in ddbresponse['Items'][0].items()}
+    doc_items = None
+    if with_timeline and 'docs' not in workflow:
+        doc_items = DDB(table=idpTable, log_level=log_level).query_items(part_key=workflow_id, sort_key_prefix="doc/")
+    des_doc = workflow_header(workflow=workflow, documents=doc_items if with_timeline else None)
+
+    # if des_doc["retain_orig_docs"]:
+    #     documents   = [{"document": k, "doc_path": f"output/{workflow_id}/{v.split(':')[1]}/orig-doc/{k}", "status": v.split(':')[0], "jobid": v.split(':')[1]} for k,v in des_doc['docs'].items()]           
+    #     des_doc["documents"] = documents
+    # else:
+    
+    if 'docs' in des_doc:
+        # Workflows submitted before documents got their own items
+        des_doc["documents"] = [{"document": k, "status": v.split(':')[0], "jobid": v.split(':')[1]} for k,v in des_doc['docs'].items()]           
+        des_doc.pop('docs')   
+    # Priority class and documents still waiting for Textract, see SchedulerFunctions
+    des_doc["queue"] = Scheduler(table=idpTable, log_level=log_level).depth(workflow_id=workflow_id)
+
+    if des_doc["de_identification_status"] == "processed":
+        # Workflows processed before the summary held the header, or before summaries were written
+        if summary is None:
+            summary = build_summary(s3=s3, workflow_id=workflow_id)
+        des_doc.update(summary)
+    return des_doc
+
+def paginate(items: list, cursor: str, limit: int):
+    """Returns the page of items starting at the opaque cursor and the cursor of the next page, None on the last page
+    """
+    offset = int(base64.urlsafe_b64decode(cursor.encode()).decode()) if cursor else 0
+    page = items[offset:offset+limit]
+    next_offset = offset + limit
+    return page, base64.urlsafe_b64encode(str(next_offset).encode()).decode() if next_offset < len(items) else None
+
+def get_detail_page(des_doc: dict, param: dict, ddb_tbl: DDB) -> dict:
+    """Returns one page of the documents and redacted_documents lists of a workflow detail, and only the requested
+    sections of the PHI Manifest (manifest=Summary by default, manifest=all for every section). Each list has its
+    own cursor parameter, the cursor of the next page is returned as a top level <list>Key next to data. A request
+    with cursors only gets the pages of the lists it continues, the header comes with the first page. Document
+    pages are read from the document items with the DynamoDB NextToken as cursor
+    """
+    limit = int(param.get('limit', DOC_PAGE_SIZE))
+    cursors = {list_name: param.get(f"{list_name}_cursor") for list_name in PAGED_LISTS.values()}
+    continued = any(cursors.values())
+    page = {} if continued else {name: value for name, value in des_doc.items() if name not in PAGED_LISTS.values()}
+    for name, list_name in PAGED_LISTS.items():
+        if continued and not cursors[list_name]:
+            continue
+        if list_name == 'documents' and list_name not in des_doc:
+            doc_items, page[name] = ddb_tbl.query_page(part_key=des_doc['workflow_id'], sort_key_prefix="doc/", limit=limit, next_token=cursors[list_name])
+            page[list_name] = [document_entry(item) for item in doc_items]
+        elif list_name in des_doc:
+            page[list_name], page[name] = paginate(des_doc[list_name], cursors[list_name], limit)
+
+    if "phi_manifest" in page:
+        sections = param.get('manifest', 'Summary')
+        if sections != 'all':
+            page["phi_manifest"] = {k: v for k, v in page["phi_manifest"].items() if k in sections.split(",")}
+    return page
+
+@profiled
+@time_budget
 def lambda_handler(event, context):
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
@@ -28,18 +191,16 @@ def lambda_handler(event, context):
 
     param = event['queryStringParameters']    
     if param['fetch'] == 'all':
-        start = param['startdt']
-        end = param['enddt']
-        stmt = f"SELECT * FROM \"{idpTable}\" WHERE submit_ts >= {start} AND submit_ts <= {end}"
-
-        try:            
-            ddbresponse = ddb.execute_statement(Statement=stmt)
-            logger.debug(json.dumps(ddbresponse))
-            # Deserialize the DynamoDB Item Response by Un-wiring it
-            all_docs = []
-            for doc in ddbresponse['Items']:
-                deserialized_document = {k: deserializer.deserialize(v) for k, v in doc.items()}
-                all_docs.append(deserialized_document)
+        try:
+            start = int(param['startdt'])
+            end = int(param['enddt'])
+            limit = int(param.get('limit', LIST_PAGE_SIZE))
+        except (KeyError, ValueError) as e:
+            logger.warning(f"Bad workflow listing range: {e}")
+            return {"statusCode": 400, "body": {"message": f"Invalid startdt, enddt or limit: {e}"}}
+
+        try:
+            all_docs, next_key = list_workflows(idpTable, start, end, limit, cursor=param.get('cursor'))
 
             payload = {
                 "statusCode": 200, 
@@ -48,55 +209,59 @@ def lambda_handler(event, context):
                 }
             }
 
-            if 'NextToken' in ddbresponse:
-                logger.debug(f"Next Token found...{ddbresponse['NextToken']}")    
-                payload['body']['nextKey'] = f"{ddbresponse['NextToken']}"
+            if next_key:
+                logger.debug(f"Next Key found...{next_key}")    
+                payload['body']['nextKey'] = next_key
             
-            print(payload)
+            logger.debug(json.dumps(payload, cls=DecimalEncoder))
             return payload
+        except InvalidCursor as e:
+            logger.warning(e)
+            return {"statusCode": 400, "body": {"message": str(e)}}
         except Exception as e:
             logger.error(e)
             return event
     else:
-        s3 = S3(bucket=bucket, log_level=log_level)        
-        stmt = f"SELECT * FROM \"{idpTable}\" WHERE part_key=? AND sort_key=?"
         workflow_id = param['fetch']
-        part_key = f"input/{param['fetch']}/"
-        ddbresponse = ddb.execute_statement(Statement=stmt, Parameters=[                                                            
-                                                            {'S': workflow_id},
-                                                            {'S': part_key}
-                                                        ])
-
-        deserialized_document = {k: deserializer.deserialize(v) for k, v in ddbresponse['Items'][0].items()}
-        des_doc = deserialized_document
-        des_doc['workflow_id'] = des_doc.pop('part_key')
-        des_doc.pop('sort_key')
-        des_doc.pop('workflow_token')     
-
-        # if des_doc["retain_orig_docs"]:
-        #     documents   = [{"document": k, "doc_path": f"output/{workflow_id}/{v.split(':')[1]}/orig-doc/{k}", "status": v.split(':')[0], "jobid": v.split(':')[1]} for k,v in des_doc['docs'].items()]           
-        #     des_doc["documents"] = documents
-        # else:
-        
-        documents   = [{"document": k, "status": v.split(':')[0], "jobid": v.split(':')[1]} for k,v in des_doc['docs'].items()]           
-        des_doc["documents"] = documents
-        des_doc.pop('docs')   
-
-        if des_doc["de_identification_status"] == "processed":
-            redacted_docs = s3.list_objects(prefix=f"public/output/{workflow_id}/", search=["/redacted-doc/"])
-            manifest_content = s3.get_object_content(key=f"public/output/{workflow_id}/Manifest")            
+        cache_key = (workflow_id, tuple(sorted(param.items())))
+        cached = detail_cache.get(cache_key)
+        if cached and cached[0] > time.time():
+            logger.debug(f"Serving workflow {workflow_id} from the detail cache")
+            etag, content = cached[1], cached[2]
+        else:
+            des_doc = get_workflow_detail(idpTable, bucket, workflow_id, log_level, with_timeline=param.get('timeline') == 'true')
+            body = {"data": get_detail_page(des_doc, param, DDB(table=idpTable, log_level=log_level))}
+            for name in PAGED_LISTS.keys():
+                next_key = body["data"].pop(name, None)
+                if next_key:
+                    body[name] = next_key
+            content = json.dumps(body, cls=DecimalEncoder)
+            logger.debug(content)
+            etag = '"' + hashlib.md5(content.encode()).hexdigest() + '"'
+            # Only workflows that reached a final state are cached, in-progress ones change between refreshes
+            if des_doc["status"] == "complete" and des_doc["de_identification_status"] in FINAL_DEID_STATUSES:
+                detail_cache.pop(cache_key, None)
+                while len(detail_cache) >= DETAIL_CACHE_SIZE:
+                    detail_cache.pop(next(iter(detail_cache)))
+                detail_cache[cache_key] = (time.time() + DETAIL_CACHE_TTL, etag, content)
 
-            if redacted_docs and len(redacted_docs) >0:   
-                des_doc["redacted_documents"] = [ {"document": os.path.basename(k),"doc_path":k.replace("public/",""), "phi_json": f"{os.path.dirname(k).replace('/redacted-doc','').replace('public/','')}/{os.path.splitext(os.path.basename(k))[0]}.comp-med"} for k in redacted_docs]
-            if manifest_content:
-                des_doc["phi_manifest"] = json.loads(manifest_content)
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Content-Type": "application/json"}
+        request_headers = event.get('headers') or {}
+        if request_headers.get('if-none-match') == etag:
+            return {"statusCode": 304, "headers": headers}
 
-        logger.debug(json.dumps(des_doc, cls=DecimalEncoder))
+        if len(content) >= GZIP_MIN_BYTES and 'gzip' in request_headers.get('accept-encoding', ''):
+            headers["Content-Encoding"] = "gzip"
+            return {
+                "statusCode": 200,
+                "headers": headers,
+                "isBase64Encoded": True,
+                "body": base64.b64encode(gzip.compress(content.encode(), compresslevel=6)).decode()
+            }
 
         payload = {
             "statusCode": 200, 
-            "body": {                    
-                "data": des_doc
-            }
+            "headers": headers,
+            "body": content
         }
         return payload
@@ -1,15 +1,44 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 import json
+import hashlib
+import math
 import logging
+import re
+import time
+from S3Functions import S3
+from CheckpointFunctions import Checkpoints, now_ms
+from ProfileFunctions import profiled
+from RetryFunctions import remaining_ms, retrying_client, time_budget
 
-comp_med = boto3.client('comprehendmedical')
+comp_med = retrying_client('comprehendmedical')
 logger = logging.getLogger(__name__)
 role = os.environ.get('IAM_ROLE')
-ddb = boto3.client('dynamodb')
+ddb = retrying_client('dynamodb')
+
+# A workflow's PHI input is split into shards so that very large workflows are not capped by a single
+# Amazon Comprehend Medical job, and so that one bad shard does not fail every document. A new shard is
+# started whenever adding the next file would exceed PHI_SHARD_MAX_FILES files or PHI_SHARD_MAX_BYTES bytes.
+# The number of shards is capped at PHI_MAX_SHARDS (concurrent batch job quota), shards grow beyond the
+# per-shard limits when the cap is reached.
+#
+# The launch of a shard whose job could not be started (throttled past the retries of RetryFunctions, e.g. by the
+# concurrent job quota) is attempted again after PHI_LAUNCH_RETRY_S seconds, in up to PHI_LAUNCH_ROUNDS rounds.
+# A shard still not launched fails the workflow: its documents would not be redacted. The jobs already launched
+# are stopped, a resumed workflow starts the detection again.
+#
+# StartPHIDetectionJob starts a new job on every call. The launch of a shard passes a ClientRequestToken derived
+# from the state machine execution, the shard index and the shard input prefix, so that the retries of a call, the
+# launch rounds and retried invocations of the function return the job already started instead of starting another.
+# A resumed workflow runs a new execution and starts new jobs.
+PHI_LAUNCH_ROUNDS = int(os.environ.get('PHI_LAUNCH_ROUNDS', '3'))
+PHI_LAUNCH_RETRY_S = float(os.environ.get('PHI_LAUNCH_RETRY_S', '5'))
+PHI_SHARD_MAX_FILES = int(os.environ.get('PHI_SHARD_MAX_FILES', '5000'))
+PHI_SHARD_MAX_BYTES = int(os.environ.get('PHI_SHARD_MAX_BYTES', str(500*1024*1024)))
+PHI_MAX_SHARDS = int(os.environ.get('PHI_MAX_SHARDS', '10'))
+SHARD_DIR = re.compile(r'^shard-\d{3}/')
 
 def update_error_state(env_vars,event):
     logger.debug('Updating de-identification status to failed')
@@ -20,9 +49,110 @@ def update_error_state(env_vars,event):
                                                     {'S': f"input/{event['workflow_id']}/"}
                                                 ])
 
+def gen_shards(file_sizes: dict) -> list:
+    """Splits the PHI input files into contiguous shards of roughly equal size. Files are kept in key order
+    so that the files of a Textract job directory stay together.
+    """
+    keys = sorted(file_sizes.keys())
+    total_bytes = sum(file_sizes.values())
+    num_shards = max(math.ceil(len(keys) / PHI_SHARD_MAX_FILES), math.ceil(total_bytes / PHI_SHARD_MAX_BYTES), 1)
+    num_shards = min(num_shards, PHI_MAX_SHARDS, max(len(keys), 1))
+    max_files = math.ceil(len(keys) / num_shards)
+    max_bytes = math.ceil(total_bytes / num_shards)
+
+    shards, shard, shard_bytes = [], [], 0
+    for key in keys:
+        # Shards are balanced on the averages, a shard closed early on one of them must not push the last shard
+        # over the job limits, it takes another shard instead
+        balanced = len(shards) < num_shards - 1 and (len(shard) >= max_files or shard_bytes + file_sizes[key] > max_bytes)
+        full = len(shards) < PHI_MAX_SHARDS - 1 and (len(shard) >= PHI_SHARD_MAX_FILES or shard_bytes + file_sizes[key] > PHI_SHARD_MAX_BYTES)
+        if shard and (balanced or full):
+            shards.append(shard)
+            shard, shard_bytes = [], 0
+        shard.append(key)
+        shard_bytes += file_sizes[key]
+    if shard:
+        shards.append(shard)
+    logger.debug(f"Generated {len(shards)} shards for {len(keys)} files, {total_bytes} bytes")
+    return shards
+
+def locate_inputs(phi_input_dir: str, file_sizes: dict) -> tuple:
+    """Maps the PHI input files listed under phi_input_dir, some of them possibly moved into shard directories
+    by an earlier run of a resumed or re-run workflow, back to their keys before staging. Returns the sizes and
+    the current key of every file by its unstaged key, and the extra copies left by a move that was interrupted
+    between its copy and its delete.
+    """
+    root = f"{phi_input_dir.rstrip('/')}/"
+    sizes, staged, duplicates = {}, {}, []
+    for key in sorted(file_sizes.keys()):
+        unstaged = root + SHARD_DIR.sub('', key[len(root):], count=1)
+        if unstaged in staged:
+            duplicates.append(key)
+            continue
+        sizes[unstaged], staged[unstaged] = file_sizes[key], key
+    return sizes, staged, duplicates
+
+def stage_shards(s3: S3, phi_input_dir: str, shards: list, staged: dict = None) -> list:
+    """Moves the files of each shard under <phi_input_dir>/shard-NNN/ and returns the shard input prefixes.
+    A single shard is kept in place. staged holds the current key of files already moved by an earlier run
+    (see locate_inputs), they move only when this run puts them into another shard.
+    """
+    root = f"{phi_input_dir.rstrip('/')}/"
+    staged = staged if staged else {}
+    moves, prefixes = {}, []
+    for idx, shard in enumerate(shards):
+        shard_prefix = f"{root}shard-{idx:03d}/" if len(shards) > 1 else root
+        prefixes.append(shard_prefix)
+        for key in shard:
+            source, destination = staged.get(key, key), f"{shard_prefix}{key[len(root):]}"
+            if source != destination:
+                moves[source] = destination
+    if moves:
+        s3.move_keys(moves=moves)
+    return prefixes
+
+def request_token(execution: str, idx: int, shard_prefix: str) -> str:
+    """ClientRequestToken of the PHI detection job of a shard, at most 64 characters of [a-zA-Z0-9-]
+    """
+    return hashlib.sha256(f"{execution}/{idx:03d}/{shard_prefix}".encode('utf-8')).hexdigest()
+
+def launch_shard(bucket: str, workflow_id: str, phi_output_dir: str, shard_prefixes: list, idx: int, execution: str) -> str:
+    """Starts the PHI detection job of the shard idx, returns its job id
+    """
+    shard_prefix = shard_prefixes[idx]
+    logger.info(f"Starting PHI detection job for shard {idx} : {shard_prefix}")
+    # Documentation: https://docs.aws.amazon.com/comprehend-medical/latest/dev/textanalysis-phi.html
+    # See: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehendmedical.html#ComprehendMedical.Client.start_phi_detection_job
+    response = comp_med.start_phi_detection_job(
+                    InputDataConfig={
+                        'S3Bucket': bucket,
+                        'S3Key': shard_prefix
+                    },
+                    OutputDataConfig={
+                        'S3Bucket': bucket,
+                        'S3Key': f"{phi_output_dir}/shard-{idx:03d}" if len(shard_prefixes) > 1 else phi_output_dir
+                    },
+                    DataAccessRoleArn=role,
+                    JobName=f'phi-job-{workflow_id}' if len(shard_prefixes) == 1 else f'phi-job-{workflow_id}-{idx:03d}',
+                    LanguageCode='en',
+                    ClientRequestToken=request_token(execution=execution, idx=idx, shard_prefix=shard_prefix)
+                )
+    logger.debug(response)
+    return response['JobId']
+
+def stop_jobs(phi_job_ids: list):
+    for job_id in phi_job_ids:
+        try:
+            comp_med.stop_phi_detection_job(JobId=job_id)
+        except Exception as e:
+            logger.warning(f"Unable to stop PHI detection job {job_id}: {e}")
+
+@profiled
+@time_budget
 def lambda_handler(event, context):
 
-    log_level = os.environ.get('LOG_LEVEL', 'INFO')    
+    started = now_ms()
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
 
@@ -34,34 +164,51 @@ def lambda_handler(event, context):
     phi_input_dir = event["phi_input_dir"]
     bucket = event["bucket"]
     phi_output_dir = f'public/phi-output/{workflow_id}'
-    phi_job_id = None
+    # Invocations without the execution name (outside the state machine) fall back to the workflow id
+    execution = event.get("execution") or workflow_id
+
+    s3 = S3(bucket=bucket, log_level=log_level)
 
     try:
-        logger.info("Starting PHI detection job")
-        """
-        Documentation: https://docs.aws.amazon.com/comprehend-medical/latest/dev/textanalysis-phi.html
-        See: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/comprehendmedical.html#ComprehendMedical.Client.start_phi_detection_job
-        """
-        response = comp_med.start_phi_detection_job(
-                        InputDataConfig={
-                            'S3Bucket': bucket,
-                            'S3Key': phi_input_dir
-                        },
-                        OutputDataConfig={
-                            'S3Bucket': bucket,
-                            'S3Key': phi_output_dir
-                        },
-                        DataAccessRoleArn=role,
-                        JobName=f'phi-job-{workflow_id}',
-                        LanguageCode='en'
-                    )
-        logger.debug(response)
-        phi_job_id = response['JobId']
+        logger.info("Sharding PHI detection input")
+        file_sizes, staged, duplicates = locate_inputs(phi_input_dir=phi_input_dir, file_sizes=s3.list_object_sizes(prefix=f"{phi_input_dir.rstrip('/')}/"))
+        for idx in range(0, len(duplicates), 1000):
+            s3.delete_objects(objects=duplicates[idx:idx+1000])
+        shard_prefixes = stage_shards(s3=s3, phi_input_dir=phi_input_dir, shards=gen_shards(file_sizes=file_sizes), staged=staged)
     except Exception as e:
-        logger.error("Error occured in launching PHI detection job")
+        logger.error("Error occured in sharding PHI detection input")
         logger.error(e)
         update_error_state(env_vars=env_vars,event=event)
+        return dict(workflow_id=workflow_id, bucket=bucket, phi_job_id=None, phi_job_ids=[], phi_output_dir=phi_output_dir, error="Unable to shard PHI detection input")
+
+    launched = {}
+    pending = list(enumerate(shard_prefixes))
+    for launch_round in range(1, PHI_LAUNCH_ROUNDS + 1):
+        failed = []
+        for idx, shard_prefix in pending:
+            try:
+                launched[idx] = launch_shard(bucket=bucket, workflow_id=workflow_id, phi_output_dir=phi_output_dir, shard_prefixes=shard_prefixes, idx=idx, execution=execution)
+            except Exception as e:
+                # A shard that fails to launch does not stop the remaining shards
+                logger.error(f"Error occured in launching PHI detection job for shard {shard_prefix} (round {launch_round})")
+                logger.error(e)
+                failed.append((idx, shard_prefix))
+        pending = failed
+        if not pending or launch_round == PHI_LAUNCH_ROUNDS or remaining_ms() < PHI_LAUNCH_RETRY_S * 1000 * 2:
+            break
+        time.sleep(PHI_LAUNCH_RETRY_S)
+
+    phi_job_ids = [launched[idx] for idx in sorted(launched)]
+    phi_job_id = phi_job_ids[0] if phi_job_ids else None
+    if pending:
+        unlaunched = [shard_prefix for idx, shard_prefix in pending]
+        stop_jobs(phi_job_ids)
+        update_error_state(env_vars=env_vars,event=event)
+        return dict(workflow_id=workflow_id, bucket=bucket, phi_job_id=phi_job_id, phi_job_ids=phi_job_ids, phi_output_dir=phi_output_dir,
+                    error=f"Unable to launch PHI detection jobs of {len(unlaunched)} of {len(shard_prefixes)} shards: {unlaunched}")
+
+    Checkpoints(table=env_vars['IDP_TABLE'], log_level=log_level).record_step(workflow_id=workflow_id, step='phi_init', started=started)
+    # No shard means every document got its PHI entities from the cache
+    return dict(workflow_id=workflow_id, bucket=bucket, phi_job_id=phi_job_id, phi_job_ids=phi_job_ids, phi_output_dir=phi_output_dir)
 
-    return dict(workflow_id=workflow_id, bucket=bucket, phi_job_id=phi_job_id, phi_output_dir=phi_output_dir)    
 
-    
\ No newline at end of file
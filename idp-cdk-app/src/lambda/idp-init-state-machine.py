@@ -3,75 +3,176 @@
 
 import json
 import urllib.parse
-import boto3
-import json
+import datetime
 import logging
 import os
+from DDBFunctions import DDB
+from SchedulerFunctions import Scheduler
+from ClientFunctions import LazyClient
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
 
-s3 = boto3.client('s3')
-ddb = boto3.client('dynamodb')
-sqs = boto3.client('sqs')
-sfn = boto3.client('stepfunctions')
+s3 = retrying_client('s3')
+ddb = retrying_client('dynamodb')
+sfn = LazyClient('stepfunctions')
 
 logger = logging.getLogger(__name__)
 
-def lambda_handler(event, context):
-    log_level = os.environ.get('LOG_LEVEL', 'INFO')    
-    logger.setLevel(log_level)
-    logger.info(json.dumps(event))
-    
-    idpTable = os.environ.get('IDP_TABLE')
-    sqsUrl = os.environ.get('IDP_QUEUE')
-    sfnArn = os.environ.get('STATE_MACHINE')
+# Starts a workflow for every submission manifest of an S3 event. A manifest is the positional DynamoDB JSON list
+# written by the web app: workflow_id, input_path, status, the map of documents, submit_ts, total_files, de_identify,
+# retain_orig_docs, de_identification_status, then optionally the encoding profile of the redacted documents (see
+# EncodingFunctions), the priority class of the workflow (see SchedulerFunctions) and the Textract processing
+# profile (see TextractFunctions).
+#
+# Manifests of bulk submissions list tens of thousands of documents, they are parsed incrementally with ijson and
+# the document items are written in batches of MANIFEST_BATCH_SIZE as they are read, so that only the document
+# names are held in memory. Without ijson the manifest is loaded whole.
+#
+# Starting a workflow is idempotent, see start_workflow. The execution is only started once the whole manifest is
+# read, the fields of the workflow item that its states need (de_identify, priority, textract_profile) follow the
+# documents in the manifest.
+MANIFEST_BATCH_SIZE = int(os.environ.get('MANIFEST_BATCH_SIZE', '500'))
+DOCS_POSITION = 3
+# Attribute of the workflow item of every position of the manifest, the documents get items of their own
+WORKFLOW_FIELDS = ['part_key', 'sort_key', 'status', None, 'submit_ts', 'total_files', 'de_identify', 'retain_orig_docs',
+                   'de_identification_status', 'encoding_profile', 'priority', 'textract_profile']
 
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    # root_prefix = event['Records'][0]['s3']['object']['key'].split("/")[0]
+def read_manifest(body):
+    """Yields (position, value) of every field of a manifest, and (DOCS_POSITION, name) of every document in
+    place of the map of documents
+    """
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)        
-        content = response['Body']
-        jsonObject = json.loads(content.read())
-        logger.debug(json.dumps(jsonObject))
+        import ijson
+    except ImportError:
+        logger.warning("ijson is not available, loading the whole manifest")
+        for position, value in enumerate(json.load(body)):
+            if position == DOCS_POSITION:
+                for name in value['M'].keys():
+                    yield position, name
+            else:
+                yield position, value
+        return
+
+    position, builder = -1, None
+    for prefix, event, value in ijson.parse(body):
+        if prefix == 'item' and event == 'start_map':
+            position += 1
+            builder = ijson.ObjectBuilder() if position != DOCS_POSITION else None
+        if position == DOCS_POSITION:
+            if prefix == 'item.M' and event == 'map_key':
+                yield position, value
+        elif builder is not None:
+            builder.event(event, value)
+            if prefix == 'item' and event == 'end_map':
+                yield position, builder.value
+                builder = None
+
+def start_workflow(bucket: str, key: str, idpTable: str, sfnArn: str, log_level: str):
+    """Starts the workflow of a manifest. Starting it again, when S3 delivers the event twice or the handler is
+    retried after a failure, completes what the first start did not and never duplicates it: the items are
+    inserted with conditions, the workflow is activated once and the execution name is the workflow_id
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    ddb_tbl = DDB(table=idpTable, log_level=log_level)
+    scheduler = Scheduler(table=idpTable, log_level=log_level)
+
+    fields, batch = {}, []
+    counts = dict(documents=0)
+    doc_insert = f"INSERT INTO \"{idpTable}\" VALUE {{'part_key': ?, 'sort_key': ?, 'doc_status': ?}}"
+    def write_documents():
+        # The documents are not kept in the workflow item, each gets its own doc/<name> item under the workflow,
+        # and waits for Textract in the queue of the workflow. The workflow is only activated once the manifest is
+        # read, so that no other workflow claims its documents before its execution exists
+        logger.debug(f"Writing {len(batch)} document items")
+        errors = ddb_tbl.batch_execute(statement=doc_insert, parameters=[[fields[0], {'S': f"doc/{doc}"}, {'S': 'ready'}] for doc in batch])
+        errors = [error for error in errors if error.get('Code') != 'DuplicateItem']
+        errors += scheduler.queue(workflow_id=fields[0]['S'], input_path=fields[1]['S'], documents=batch)
+        if errors:
+            raise Exception(f"Unable to write {len(errors)} of {len(batch)} documents: {errors[0]}")
+        counts['documents'] += len(batch)
+        batch.clear()
+
+    started = False
+    for position, value in read_manifest(response['Body']):
+        if position != DOCS_POSITION:
+            fields[position] = value
+            continue
+        if not batch and not counts['documents']:
+            # The workflow item is written last, finding it means the manifest was read by a start before
+            started = ddb_tbl.get_item(part_key=fields[0]['S'], sort_key=fields[1]['S']) is not None
+        if started:
+            counts['documents'] += 1
+            continue
+        batch.append(value)
+        if len(batch) >= MANIFEST_BATCH_SIZE:
+            write_documents()
+    if batch:
+        write_documents()
+
+    workflow_id=fields[0]['S']
+    input_path=fields[1]['S']
 
-        # Log data to Dynamodb
-        stmt = f"INSERT INTO \"{idpTable}\" VALUE {{'part_key' : ?, 'sort_key' : ?, 'status': ?, 'docs': ?, 'submit_ts': ?, 'total_files': ?, 'de_identify': ?, 'retain_orig_docs': ?, 'de_identification_status': ?}}"
+    # Log data to Dynamodb
+    # submit_day (UTC day of submit_ts) partitions the workflow listing index, see idp-get-workflows
+    if not started:
+        names = [name for position, name in enumerate(WORKFLOW_FIELDS) if name and position in fields]
+        values = ", ".join([f"'{name}': ?" for name in names])
+        stmt = f"INSERT INTO \"{idpTable}\" VALUE {{{values}, 'submit_day': ?}}"
         logger.debug(stmt)
-        ddresponse = ddb.execute_statement(Statement=stmt, Parameters=jsonObject);
-        logger.debug(json.dumps(ddresponse))
-
-        workflow_id=jsonObject[0]['S']
-        input_path=jsonObject[1]['S']
-        docs=jsonObject[3]['M']
-
-        #Send messages per doc to SQS
-        logger.debug("Sending messages to SQS")
-        for doc in docs.keys():
-            msg = dict(workflow_id= workflow_id, input_path= input_path, document_name= doc)
-            logger.debug(json.dumps(msg))
-            sqsresponse = sqs.send_message(QueueUrl=sqsUrl, MessageBody=json.dumps(msg))            
-            logger.debug(sqsresponse)
-
-            # logger.debug(f"Creating temp processing file {root_prefix}/temp/{workflow_id}/{doc}.json")
-            # obj = {doc: {"S": "ready"}}
-            # s3.put_object(Body=json.dumps(obj),Bucket=bucket,Key=f'{root_prefix}/temp/{workflow_id}/{doc}.json')
-            
-        # Step function payload
-        sfnPayload = dict(workflow_id=workflow_id, bucket=bucket)
-        
-        # Start Step function state machine
-        logger.debug("Starting Step function state machine")
-        logger.debug(sfnPayload)
+        submit_day = datetime.datetime.utcfromtimestamp(int(fields[4]['N'])/1000).strftime('%Y-%m-%d')
+        try:
+            ddresponse = ddb.execute_statement(Statement=stmt, Parameters=[fields[WORKFLOW_FIELDS.index(name)] for name in names] + [{'S': submit_day}])
+            logger.debug(json.dumps(ddresponse))
+        except ddb.exceptions.DuplicateItemException:
+            logger.info(f"Workflow {workflow_id} was already written")
+
+    # Documents wait for Textract in the queue of the workflow, shared with the other workflows by priority. No
+    # document is claimed before the workflow is activated, so every document of the manifest is queued unless a
+    # start before activated it already (activate is then a no-op) or its queue has drained since
+    queued = counts['documents'] if not started or scheduler.head(workflow_id=workflow_id, count=1) else 0
+    if queued:
+        scheduler.activate(workflow_id=workflow_id, queued=queued, priority=fields[10]['S'] if 10 in fields else None)
+
+    # Step function payload
+    sfnPayload = dict(workflow_id=workflow_id, bucket=bucket)
+
+    # Start Step function state machine
+    logger.debug("Starting Step function state machine")
+    logger.debug(sfnPayload)
+    try:
         sfnResponse = sfn.start_execution(
                             stateMachineArn=sfnArn,
                             name=f'idp-workflow-{workflow_id}',
                             input=json.dumps(sfnPayload)
                         )
         logger.debug(sfnResponse)
-        logger.debug("Done...")
+    except sfn.exceptions.ExecutionAlreadyExists:
+        logger.info(f"Workflow {workflow_id} was already started")
+        return
+    logger.info(f"Started workflow {workflow_id} with {counts['documents']} documents")
+
+@profiled
+@time_budget
+def lambda_handler(event, context):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')    
+    logger.setLevel(log_level)
+    logger.info(json.dumps(event))
+    
+    idpTable = os.environ.get('IDP_TABLE')
+    sfnArn = os.environ.get('STATE_MACHINE')
+
+    # Every record of the event is a manifest, one that fails does not keep the others from starting
+    failed = []
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+        try:
+            start_workflow(bucket=bucket, key=key, idpTable=idpTable, sfnArn=sfnArn, log_level=log_level)
+        except Exception as e:
+            logger.error(f"Error starting workflow of {key}: {e}")
+            failed.append(key)
 
-        return dict(Success=True)
-    except Exception as e:        
-        logger.error('Error: {}'.format(e))
-        raise e
-              
\ No newline at end of file
+    if failed:
+        raise Exception(f"Unable to start the workflows of {len(failed)} of {len(event['Records'])} manifests: {failed}")
+    logger.debug("Done...")
+    return dict(Success=True)
@@ -1,15 +1,21 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 import json
 import logging
 import time
+from CheckpointFunctions import Checkpoints, now_ms
+from MetricsFunctions import put_metric
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
 
-comp_med = boto3.client('comprehendmedical')
+comp_med = retrying_client('comprehendmedical')
 logger = logging.getLogger(__name__)
-ddb = boto3.client('dynamodb')
+ddb = retrying_client('dynamodb')
+
+IN_PROGRESS_STATES = ['SUBMITTED', 'IN_PROGRESS', 'STOP_REQUESTED']
+SUCCESS_STATES = ['COMPLETED', 'PARTIAL_SUCCESS']
 
 def update_error_state(env_vars,event):
     logger.debug('Updating de-identification status to failed')
@@ -20,16 +26,49 @@ def update_error_state(env_vars,event):
                                                     {'S': f"input/{event['workflow_id']}/"}
                                                 ])
 
+def record_failed_jobs(env_vars, event, failed_jobs: list):
+    """Records the PHI detection jobs that failed or were stopped on the workflow item, the summary of the workflow
+    reports them
+    """
+    logger.debug(f"Recording failed PHI detection jobs {failed_jobs}")
+    wf_update = f"UPDATE \"{env_vars['IDP_TABLE']}\" SET failed_jobs=? WHERE part_key=? AND sort_key=?"
+    ddb.execute_statement(Statement=wf_update, Parameters=[
+                                                    {'L': [{'S': job_id} for job_id in failed_jobs]},
+                                                    {'S': event['workflow_id']},
+                                                    {'S': f"input/{event['workflow_id']}/"}
+                                                ])
+    put_metric(name='PhiJobsFailed', value=len(failed_jobs))
+
+def get_workflow_status(job_statuses: dict) -> str:
+    """Rolls the status of every PHI detection shard job up into a single workflow status. The workflow only
+    fails when every shard failed or was stopped, shards that failed are reported in failed_jobs
+    """
+    statuses = list(job_statuses.values())
+    if not statuses:
+        # Every document got its PHI entities from the cache, no job was started
+        return 'COMPLETED'
+    if any(status in IN_PROGRESS_STATES for status in statuses):
+        return 'IN_PROGRESS'
+    if any(status in SUCCESS_STATES for status in statuses):
+        return 'COMPLETED'
+    return 'FAILED'
+
+@profiled
+@time_budget
 def lambda_handler(event, context):
-    log_level = os.environ.get('LOG_LEVEL', 'INFO')    
+    started = now_ms()
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
 
     workflow_id = event["workflow_id"]
     phi_job_id = event["phi_job_id"]
+    phi_job_ids = event.get("phi_job_ids")
+    phi_job_ids = [phi_job_id] if phi_job_ids is None else phi_job_ids
     phi_output_dir = event["phi_output_dir"]
     bucket = event["bucket"]
     status = None
+    job_statuses = {}
 
     env_vars = {}
     for name, value in os.environ.items():
@@ -39,12 +78,16 @@ def lambda_handler(event, context):
 
     try:
         while time.time() < max_time:
-            logger.info("Checking PHI detection job status")        
-            response = comp_med.describe_phi_detection_job(JobId=phi_job_id)
-            status = response['ComprehendMedicalAsyncJobProperties']['JobStatus']
+            logger.info("Checking PHI detection job status")
+            for job_id in phi_job_ids:
+                if job_statuses.get(job_id) in IN_PROGRESS_STATES or job_id not in job_statuses:
+                    response = comp_med.describe_phi_detection_job(JobId=job_id)
+                    job_statuses[job_id] = response['ComprehendMedicalAsyncJobProperties']['JobStatus']
+            logger.debug(job_statuses)
+            status = get_workflow_status(job_statuses=job_statuses)
 
-            if status == "COMPLETED" or status == 'FAILED' or status == 'STOPPED':
-                if status == 'FAILED' or status == 'STOPPED':
+            if status == "COMPLETED" or status == 'FAILED':
+                if status == 'FAILED':
                     update_error_state(env_vars=env_vars,event=event)
                 break
 
@@ -53,8 +96,16 @@ def lambda_handler(event, context):
         logger.error("Error occured in launching PHI detection job")
         logger.error(e)
         update_error_state(env_vars=env_vars,event=event)
-        return dict(workflow_id=workflow_id, status='FAILED', bucket=bucket, phi_job_id=phi_job_id, phi_output_dir=phi_output_dir)
+        return dict(workflow_id=workflow_id, status='FAILED', bucket=bucket, phi_job_id=phi_job_id, phi_job_ids=phi_job_ids, phi_output_dir=phi_output_dir)
+
+    failed_jobs = [job_id for job_id, job_status in job_statuses.items() if job_status in ['FAILED', 'STOPPED']]
+    if failed_jobs and status in ['COMPLETED', 'FAILED']:
+        if status == 'COMPLETED':
+            logger.warning(f"PHI detection jobs {failed_jobs} failed, documents in these shards will not be redacted")
+        record_failed_jobs(env_vars=env_vars, event=event, failed_jobs=failed_jobs)
+
+    # Invoked again while the jobs are in progress, the step spans from the first check to the last
+    Checkpoints(table=env_vars['IDP_TABLE'], log_level=log_level).record_step(workflow_id=workflow_id, step='phi_check', started=started)
+    return dict(workflow_id=workflow_id, status=status, bucket=bucket, phi_job_id=phi_job_id, phi_job_ids=phi_job_ids, phi_output_dir=phi_output_dir, failed_jobs=failed_jobs)
 
-    return dict(workflow_id=workflow_id, status=status, bucket=bucket, phi_job_id=phi_job_id, phi_output_dir=phi_output_dir)    
 
-    
\ No newline at end of file
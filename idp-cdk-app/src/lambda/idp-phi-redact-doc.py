@@ -3,16 +3,48 @@
 
 import os
 import json
-import pdfplumber
+import math
 import logging
 import filetype
 import string
 from S3Functions import S3
+from CacheFunctions import DocumentCache
+from CheckpointFunctions import Checkpoints, now_ms
+from RasterFunctions import choose_dpi, get_rasterizer, page_pixels
+from MemoryFunctions import estimate_peak_mb, max_page_pixels, memory_budget_mb, peak_memory_mb, reset_peak_memory
+from EncodingFunctions import ENCODING_PROFILE, encode
+from MetricsFunctions import put_metric
+from PhiRuleFunctions import merge_entities
+from PipelineFunctions import start_redaction
+from TextractFunctions import mark_processed
+from ProfileFunctions import profiled
+from RetryFunctions import time_budget
 from PIL import Image , ImageDraw, ImageSequence
 from textractoverlayer.t_overlay import DocumentDimensions, get_bounding_boxes
 from textractcaller.t_call import Textract_Types
 
 logger = logging.getLogger(__name__)
+# Page size used to get the redaction boxes as ratios of the page before rasterizing
+RATIO_SCALE = 100000
+# Documents estimated to exceed the memory of this function are returned as deferred, for the larger redaction
+# function variant, instead of being attempted. The larger variant does not defer, it lowers the DPI to fit
+REDACT_DEFER_OVERSIZED = os.environ.get('REDACT_DEFER_OVERSIZED', 'false').lower() == 'true'
+
+class MemoryBudgetExceeded(Exception):
+    def __init__(self, estimate_mb: float, budget_mb: int):
+        super().__init__(f"Estimated peak memory {estimate_mb}MB exceeds the {budget_mb}MB of the function")
+        self.estimate_mb = estimate_mb
+        self.budget_mb = budget_mb
+
+def check_memory(estimate_mb: float) -> bool:
+    """Raises MemoryBudgetExceeded when a document should be deferred, returns whether it fits otherwise
+    """
+    budget_mb = memory_budget_mb()
+    if not budget_mb or estimate_mb <= budget_mb:
+        return True
+    if REDACT_DEFER_OVERSIZED:
+        raise MemoryBudgetExceeded(estimate_mb=estimate_mb, budget_mb=budget_mb)
+    return False
 
 def detect_file_type(doc_path: str) -> str:
     """Function gets the mime type of the file 
@@ -37,32 +69,81 @@ def redacted_file_name(file_path: str) -> str:
     logger.debug(f"Local path for redacted file: {local_redacted_path}")
     return local_redacted_path
 
-def get_pil_img(file_path: str) -> tuple[str, list[Image.Image]]:
+def find_redactions(textract_json: dict, document_dimension: list, entities: list) -> list:
+    """Returns the bounding boxes of the Textract lines containing (or contained in) a PHI entity
+    """
+    logger.debug("Setting overlay")
+    overlay=[Textract_Types.LINE]
+    logger.debug("Getting bounding boxes")
+    bounding_box_list = get_bounding_boxes(textract_json=textract_json, document_dimensions=document_dimension, overlay_features=overlay)
+
+    redactions = []
+    #collect the bounding boxes for the custom entities
+    for entity in entities:            
+        for bbox in bounding_box_list:
+            if entity.lower() in bbox.text.lower():                    
+                redactions.append(bbox)
+            elif bbox.text.lower() in entity.lower():
+                redactions.append(bbox)
+    return redactions
+
+def get_pil_img(file_path: str, textract_json: dict = None, entities: list = None, textract_bytes: int = 0) -> tuple[str, list[Image.Image], int, float]:
+    """Function gets a list of Pillow images from PDF/PNG/JPG files. PDF pages are rasterized at the DPI that
+    keeps the smallest box to redact legible (see RasterFunctions) and fits the memory of the function (see
+    MemoryFunctions), returns the mime type, images, DPI and estimated peak memory
+    """
     try:
         file_mime = detect_file_type(file_path)
         images = []
+        dpi = None
+        estimate_mb = None
         if file_mime == "application/pdf":
             # gets an array of Pillow images from PDF file
-            logger.debug("Converting PDF file to Pillow Images")
-            # images = pdf2image.convert_from_path(file_path)
-            with pdfplumber.open(file_path) as pdf:
-                images = [page.to_image(resolution=150).original for page in pdf.pages]                              
+            rasterizer = get_rasterizer()
+            page_sizes = rasterizer.page_sizes(file_path)
+            boxes = []
+            if textract_json and entities:
+                # Boxes as ratios of the page size, scaled up so that the rounding of the overlayer is negligible
+                boxes = [(box.page_number, (box.xmax - box.xmin) / RATIO_SCALE, (box.ymax - box.ymin) / RATIO_SCALE)
+                            for box in find_redactions(textract_json=textract_json, document_dimension=[DocumentDimensions(doc_width=RATIO_SCALE, doc_height=RATIO_SCALE)] * len(page_sizes), entities=entities)]
+            dpi = choose_dpi(page_sizes=page_sizes, boxes=boxes)
+            estimate_mb = estimate_peak_mb(page_pixels=[page_pixels(size, dpi) for size in page_sizes], textract_bytes=textract_bytes)
+            if not check_memory(estimate_mb):
+                dpi = choose_dpi(page_sizes=page_sizes, boxes=boxes, max_pixels=max_page_pixels(budget_mb=memory_budget_mb(), pages=len(page_sizes), textract_bytes=textract_bytes))
+                estimate_mb = estimate_peak_mb(page_pixels=[page_pixels(size, dpi) for size in page_sizes], textract_bytes=textract_bytes)
+                logger.warning(f"Lowered the DPI to {dpi} to fit into {memory_budget_mb()}MB")
+            logger.debug(f"Converting PDF file to Pillow Images with {rasterizer.name} at {dpi} DPI")
+            images = rasterizer.render(file_path, dpi=dpi, page_sizes=page_sizes)
         elif file_mime in ['image/jpeg', 'image/png', 'image/tiff']:
             logger.debug(f"Converting {file_mime} Image file to Pillow Images")
             im = Image.open(file_path)
+            # Opening only reads the header, the frames are decoded once the estimate is known to fit
+            estimate_mb = estimate_peak_mb(page_pixels=[im.size] * getattr(im, 'n_frames', 1), mode=im.mode, textract_bytes=textract_bytes)
+            check_memory(estimate_mb)
             images = [img for img in ImageSequence.Iterator(im)]
         logger.debug(f"File type: {file_mime}, Total Pages: {len(images)}")
-        return file_mime, images
+        return file_mime, images, dpi, estimate_mb
+    except MemoryBudgetExceeded as e:
+        raise e
     except Exception as e:
         logger.error("Failed to convert file to Pillow images")
         logger.error(e)
         raise e
 
-def redact_doc(temp_file: str, textract_json: dict, comprehend_json: dict) -> str:
-    """Function that redacts PDF/PNG/JPG files given Amazon Comprehend PHI entities and Textract OCR JSON    
+def redact_doc(temp_file: str, textract_json: dict, comprehend_json: dict, encoding_profile: str = None, textract_bytes: int = 0) -> tuple:
+    """Function that redacts PDF/PNG/JPG files given Amazon Comprehend PHI entities and Textract OCR JSON and
+    saves them with an encoding profile (see EncodingFunctions), returns the mime type, redacted file path and
+    encoding statistics with the estimated peak memory
     """
     try:        
-        file_mime, images = get_pil_img(file_path=temp_file)
+        entities = []
+        for entity in comprehend_json['Entities']:            
+            entities.append(entity['Text'])
+
+        logger.debug("PHI Entities found...")    
+        logger.debug(entities)
+
+        file_mime, images, dpi, estimate_mb = get_pil_img(file_path=temp_file, textract_json=textract_json, entities=entities, textract_bytes=textract_bytes)
         logger.debug(f"Getting local redacted file name from path {temp_file}")
         local_path = redacted_file_name(file_path=temp_file)
 
@@ -71,26 +152,7 @@ def redact_doc(temp_file: str, textract_json: dict, comprehend_json: dict) -> st
 
         logger.debug("Getting document dimensions")
         document_dimension = [DocumentDimensions(doc_width=img_sample.size[0], doc_height=img_sample.size[1]) for img_sample in images]
-        logger.debug("Setting overlay")
-        overlay=[Textract_Types.LINE]
-        logger.debug("Getting bounding boxes")
-        bounding_box_list = get_bounding_boxes(textract_json=textract_json, document_dimensions=document_dimension, overlay_features=overlay)
-        
-        entities = []
-        for entity in comprehend_json['Entities']:            
-            entities.append(entity['Text'])
-
-        logger.debug("PHI Entities found...")    
-        logger.debug(entities)
-
-        redactions = []
-        #collect the bounding boxes for the custom entities
-        for entity in entities:            
-            for bbox in bounding_box_list:
-                if entity.lower() in bbox.text.lower():                    
-                    redactions.append(bbox)
-                elif bbox.text.lower() in entity.lower():
-                    redactions.append(bbox)
+        redactions = find_redactions(textract_json=textract_json, document_dimension=document_dimension, entities=entities)
         logger.debug(redactions)
 
         for idx,img in enumerate(images):
@@ -100,14 +162,12 @@ def redact_doc(temp_file: str, textract_json: dict, comprehend_json: dict) -> st
                 if box.page_number == page_num:                    
                     draw.rectangle(xy=[box.xmin, box.ymin, box.xmax, box.ymax], fill="Black")
 
-        if len(images) == 1:
-            images[0].save(local_path)
-            logger.info(f"Redaction complete. Redacted file saved as {local_path}")
-            return file_mime, local_path
-        else:
-            images[0].save(local_path, save_all=True,append_images=images[1:])
-            logger.info(f"Redaction complete. Redacted file saved as {local_path}")
-            return file_mime, local_path
+        encoding = encode(images=images, path=local_path, mime=file_mime, spec=encoding_profile, dpi=dpi)
+        encoding['memory_estimate_mb'] = math.ceil(estimate_mb) if estimate_mb else None
+        logger.info(f"Redaction complete. Redacted file saved as {local_path}")
+        return file_mime, local_path, encoding
+    except MemoryBudgetExceeded as e:
+        raise e
     except Exception as e:
         logger.error(e)
         raise e
@@ -132,7 +192,10 @@ def clean_up(local_paths: list[str], s3_keys: list[str], s3_retain_docs: bool, s
 
     return True
 
+@profiled
+@time_budget
 def lambda_handler(event, context):
+    started = now_ms()
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
     logger.debug(json.dumps(event))
@@ -140,14 +203,45 @@ def lambda_handler(event, context):
     retain_docs = event["retain_docs"]
     doc_prefixes = event["redact_data"]
     bucket = event["bucket"]
+    workflow_id = event["workflow_id"]
+    # Workflows submitted without a profile use ENCODING_PROFILE
+    encoding_profile = event.get("encoding_profile") or ENCODING_PROFILE
 
     s3 = S3(bucket=bucket, log_level=log_level)
+    cache = DocumentCache(table=os.environ.get('IDP_TABLE'), log_level=log_level)
+    checkpoints = Checkpoints(table=os.environ.get('IDP_TABLE'), log_level=log_level)
 
+    deferred = []
     for doc in doc_prefixes:
         logger.debug(doc)
+        temp_file = None
+        doc_started = now_ms()
         try:
+            reset_peak_memory()
+            document = doc['doc']
+            filename = os.path.basename(document)
+            redacted_prefix = os.path.dirname(document).replace('/orig-doc','/redacted-doc')
+            # Streamed documents are redacted from the workflow input, see PipelineFunctions
+            s3_redacted_key = doc.get('redacted_doc', f"{redacted_prefix}/{filename}")
+
+            # Documents with the same content were already redacted by an earlier workflow
+            digest = cache.document_digest(workflow_id=workflow_id, document=filename)
+            entry = cache.lookup(digest=digest, stage='redaction')
+            # Redacted documents are only reused when they were encoded with the same profile
+            if entry and entry.get('redacted_doc') and entry.get('encoding_profile') == encoding_profile:
+                try:
+                    s3.copy_object(source_object=entry['redacted_doc'], destination_object=s3_redacted_key)
+                    clean_up(local_paths=[], s3_keys=[document], s3_retain_docs=retain_docs, s3=s3)
+                    checkpoints.record(workflow_id=workflow_id, document=filename, stage='redacted', started=doc_started)
+                    logger.info(f"Redacted document {filename} copied from cache")
+                    continue
+                except Exception as e:
+                    logger.warning(f"Unable to use cached redacted document for {filename}: {e}")
+
             # Read Textract response JSON
             textract_op_content = s3.get_object_content(key=doc['txtract'])
+            # The Textract JSON alone can exceed the memory of the function once parsed
+            check_memory(estimate_peak_mb(page_pixels=[], textract_bytes=len(textract_op_content)))
             textract_op = json.loads(textract_op_content)
             logger.info("Loaded Textract JSON")
             logger.debug(textract_op)
@@ -155,29 +249,62 @@ def lambda_handler(event, context):
             comp_med_content = s3.get_object_content(key=doc['comp_med'])
             comp_med = json.loads(comp_med_content)
             logger.info("Loaded Comprehend Medical JSON")
+            if doc.get('phi_rules'):
+                comp_med['Entities'] = merge_entities(comp_med, json.loads(s3.get_object_content(key=doc['phi_rules'])))
+                logger.info("Merged rule based PHI entities")
             logger.debug(comp_med)
 
-            document = doc['doc']
-            filename = os.path.basename(document)
             temp_file = f'/tmp/{filename}'
             logger.info("Downloading document to /tmp/")
             s3.download_file(source_object=document, destination_file=temp_file)
 
             logger.info("Redacting document in /tmp/")
-            file_mime, redacted_file = redact_doc(temp_file= temp_file, textract_json=textract_op, comprehend_json=comp_med)
-
-            redacted_prefix = os.path.dirname(document).replace('/orig-doc','/redacted-doc')
-            s3_redacted_key = f"{redacted_prefix}/{filename}"
+            file_mime, redacted_file, encoding = redact_doc(temp_file= temp_file, textract_json=textract_op, comprehend_json=comp_med, encoding_profile=encoding_profile, textract_bytes=len(textract_op_content))
+            encoding['memory_peak_mb'] = peak_memory_mb()
+            # Estimated and observed peak memory side by side, to calibrate the factors of MemoryFunctions
+            logger.info(json.dumps(dict(document=filename, memory_estimate_mb=encoding['memory_estimate_mb'], memory_peak_mb=encoding['memory_peak_mb'], memory_budget_mb=memory_budget_mb())))
+            if encoding['memory_estimate_mb'] and encoding['memory_peak_mb']:
+                put_metric(name='RedactMemoryEstimateRatio', value=round(encoding['memory_peak_mb'] / encoding['memory_estimate_mb'], 3), unit='None', dimensions={'FunctionMemory': str(memory_budget_mb())})
+            encoding['memory_peak_mb'] = math.ceil(encoding['memory_peak_mb']) if encoding['memory_peak_mb'] else None
 
             if redacted_file and os.path.exists(redacted_file):
                 logger.debug(f"Redaction complete. Saving {redacted_file} to S3")
                 s3.upload_file(source_file=redacted_file, destination_object=s3_redacted_key, ExtraArgs={'ContentType': file_mime})
+                cache.put(digest, redacted_doc=s3_redacted_key, encoding_profile=encoding_profile)
+                encoding['source_bytes'] = os.path.getsize(temp_file)
+                checkpoints.record(workflow_id=workflow_id, document=filename, stage='redacted', started=doc_started, **encoding)
+                put_metric(name='RedactedBytes', value=encoding['redacted_bytes'], unit='Bytes', dimensions={'EncodingProfile': encoding['encoding_profile']})
+                put_metric(name='RedactedSizeRatio', value=round(encoding['redacted_bytes'] / max(encoding['source_bytes'], 1), 3), unit='None', dimensions={'EncodingProfile': encoding['encoding_profile']})
+                put_metric(name='EncodeTime', value=encoding['encode_ms'], unit='Milliseconds', dimensions={'EncodingProfile': encoding['encoding_profile']})
                 if clean_up(local_paths=[temp_file, redacted_file],s3_keys=[document], s3_retain_docs=retain_docs, s3=s3):
                     logger.info("Cleanup complete...")
             else:
                 logger.error(f"Redaction un-successful for file {document}. See logs for more details.")
+        except MemoryBudgetExceeded as e:
+            logger.warning(f"Deferring {doc['doc']} to the larger redaction function: {e}")
+            put_metric(name='RedactDeferred', dimensions={'FunctionMemory': str(e.budget_mb)})
+            deferred.append(doc)
+            if temp_file and os.path.isfile(temp_file):
+                os.remove(temp_file)
         except Exception as e:
             logger.error(f"Error occured in redacting {doc['doc']}")
             logger.error(e)
 
-    return dict(status="done")
\ No newline at end of file
+    if event.get('stream'):
+        finish_streamed(event=event, deferred=deferred)
+    checkpoints.record_step(workflow_id=workflow_id, step='redact', started=started)
+    return dict(status="done", deferred=deferred)
+
+def finish_streamed(event: dict, deferred: list):
+    """Hands the deferred streamed documents to the larger redaction function and marks the others processed for
+    the workflow, redacted or not. A document whose redaction failed is redacted again by the redaction Map of the
+    workflow, which skips the redacted ones
+    """
+    if deferred and os.environ.get('LAMBDA_REDACT_LARGE'):
+        start_redaction(function_name=os.environ['LAMBDA_REDACT_LARGE'], payload=dict(event, redact_data=deferred))
+    else:
+        deferred = []
+    for doc in event['redact_data']:
+        if doc not in deferred:
+            mark_processed(workflow_id=event['workflow_id'], document=os.path.basename(doc['doc']), status='succeeded', job_id=doc['job_id'],
+                           bucket=event['bucket'], root_prefix=doc['doc'].split('/')[0], env_vars=dict(os.environ))
\ No newline at end of file
@@ -5,13 +5,15 @@ import os
 import json
 import logging
 from S3Functions import S3
+from MetricsFunctions import put_metric
+from OutputFunctions import document_artifacts, missing_artifacts
+from ProfileFunctions import profiled
+from RetryFunctions import time_budget
 
 logger = logging.getLogger(__name__)
 
-def get_key(pattern: str, files: list) -> str:
-    val = [x for x in files if pattern in x]
-    return val[0]
-
+@profiled
+@time_budget
 def lambda_handler(event, context):
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
@@ -19,20 +21,28 @@ def lambda_handler(event, context):
 
     workflow_id = event["workflow_id"]
     retain_docs = event["retain_docs"]
+    encoding_profile = event.get("encoding_profile")
     doc_prefixes = event["doc_prefixes"]
     bucket = event["bucket"]
 
     s3 = S3(bucket=bucket, log_level=log_level)
-    redact_data = []
-    for prefix in doc_prefixes:
-        try:
-            # Get the Comprehend Medical output and Textract JSON output path
-            files = s3.list_objects(prefix=prefix, search=[".comp-med", ".json", "/orig-doc/"]) 
-            process_dict = dict(comp_med=get_key(pattern='.comp-med',files=files), txtract=get_key(pattern='.json',files=files), doc=get_key(pattern='/orig-doc/',files=files))            
-
-            redact_data.append(process_dict)
-        except Exception as e:
-            logger.error("Error occured...")
-            logger.error(e)
-
-    return dict(workflow_id=workflow_id, bucket=bucket, retain_docs=retain_docs, redact_data=redact_data)
+    redact_data, missing = [], []
+    for item in doc_prefixes:
+        # The PHI post-processing hands over the artifact keys of the documents, or only their prefixes when the
+        # keys would not fit into the Map payload, the job directory of the document is then listed
+        if isinstance(item, dict):
+            prefix = item['prefix']
+            found = {artifact: key for artifact, key in item.items() if artifact != 'prefix'}
+        else:
+            prefix = item
+            found = document_artifacts(job_prefix=prefix, keys=[key for key, size in s3.iter_object_sizes(prefix=prefix)])
+        absent = missing_artifacts(found)
+        if absent:
+            logger.error(f"Document {prefix} cannot be redacted, missing {absent}")
+            missing.append(dict(prefix=prefix, missing=absent))
+            continue
+        redact_data.append(found)
+
+    if missing:
+        put_metric(name='MissingArtifacts', value=len(missing), dimensions={'Operation': 'PrepRedaction'})
+    return dict(workflow_id=workflow_id, bucket=bucket, retain_docs=retain_docs, encoding_profile=encoding_profile, redact_data=redact_data, missing=missing)
@@ -3,48 +3,143 @@
 
 import os
 import json
-import boto3
+import math
+import heapq
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from S3Functions import S3
+from CacheFunctions import DocumentCache
+from CheckpointFunctions import Checkpoints, now_ms
+from MemoryFunctions import plan_peak_mb
+from OutputFunctions import document_artifacts, index_by_job
 from boto3.dynamodb.types import TypeDeserializer
+from ClientFunctions import connection_stats
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
 
-ddb = boto3.client('dynamodb')
+ddb = retrying_client('dynamodb')
 deserializer = TypeDeserializer()
 logger = logging.getLogger(__name__)
 MAX_FILES_TO_REDACT=10
 
-def gen_list_for_map(documents: list) -> list:
+# Redaction cost model. A document costs one unit per page plus one unit per REDACT_BYTES_PER_PAGE bytes of
+# source file, and its peak memory is estimated from its page count and Textract JSON size (see MemoryFunctions).
+# A Map branch is filled up to REDACT_BRANCH_COST units, and a document that would not fit into REDACT_MEMORY_MB
+# is given a branch of its own, where the redaction function defers it to its larger memory variant.
+REDACT_BYTES_PER_PAGE = int(os.environ.get('REDACT_BYTES_PER_PAGE', str(200*1024)))
+REDACT_BRANCH_COST = float(os.environ.get('REDACT_BRANCH_COST', '200'))
+REDACT_MEMORY_MB = int(os.environ.get('REDACT_MEMORY_MB', '256'))
+# Map items carry the artifact keys of their documents up to this size, Step Functions payloads are limited to 256KB
+REDACT_MAP_PAYLOAD_BYTES = int(os.environ.get('REDACT_MAP_PAYLOAD_BYTES', str(128*1024)))
+
+def get_doc_costs(s3: S3, index: dict, documents: list, doc_items: list = None) -> dict:
     """
-    This function creates a list of dicts to be used in Step Functions Map (https://docs.aws.amazon.com/step-functions/latest/dg/amazon-states-language-map-state.html). 
-    Each dict within the list will contain upto 10 documents which means each step function chain under Map, will process upto 10 documents at a time. 
-    With Step Functions Map you can have upto 40 parallel executions without throttling which means you can process upto 400 documents in-parallel 
-    (10 each x 40 chains). You can fine tune the number 10 (MAX_FILES_TO_REDACT) based on the total volume of documents you intend to process at once 
-    and the size of documents. If you have larger documents, it is recommended that you use smaller number of files per chain since the redaction Lambda
-    can be resource intensive.
+    Returns the redaction cost and estimated memory (MB) of each document prefix. Source file sizes come from the
+    index of the workflow output by job directory (see OutputFunctions.index_by_job). Page counts and JSON sizes
+    come from the text checkpoint of the document items (doc_items), and from the metadata of the merged Textract
+    JSON for documents without them (served from the cache, or processed before the checkpoint recorded them).
+    JSON written before compression has no size in its metadata and is stored as is.
     """
-    try:
-        docs_to_redact=None
-        if len(documents) <= 10:
-            docs_to_redact = [documents]
+    recorded = {f"{item['output_path']}/": item for item in (doc_items or []) if item.get('output_path') and item.get('pages')}
+
+    def doc_cost(prefix: str) -> tuple:
+        object_sizes = index.get(prefix, {})
+        doc_bytes = sum([size for key, size in object_sizes.items() if '/orig-doc/' in key])
+        json_keys = [key for key in object_sizes.keys() if key.endswith('.json')]
+        if prefix in recorded:
+            metadata = {'pages': recorded[prefix]['pages'], 'json-bytes': recorded[prefix].get('json_bytes', 0)}
         else:
-            ctr = 1
-            docs_to_redact = []
-            docs = []
-            for idx, doc in enumerate(documents):
-                ctr = ctr + 1
+            metadata = s3.get_object_metadata(key=json_keys[0]) if json_keys else {}
+        pages = int(metadata.get('pages', 0))
+        if not pages:
+            pages = max(1, math.ceil(doc_bytes / REDACT_BYTES_PER_PAGE))
+        textract_bytes = int(metadata.get('json-bytes') or object_sizes[json_keys[0]]) if json_keys else 0
+        return pages + doc_bytes / REDACT_BYTES_PER_PAGE, plan_peak_mb(pages=pages, textract_bytes=textract_bytes)
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        costs = dict(zip(documents, executor.map(doc_cost, documents)))
+    logger.debug(costs)
+    return costs
+
+def map_items(map_list: list, index: dict) -> list:
+    """
+    Replaces the document prefixes of the Map chains with the prefix and artifact keys of the documents, so that
+    the redaction branches do not list the workflow output. Chains keep their prefixes when the artifacts would
+    not fit into REDACT_MAP_PAYLOAD_BYTES, each branch then lists the job directories of its own documents.
+    """
+    items = [[dict(prefix=doc, **document_artifacts(job_prefix=doc, keys=index.get(doc, {}).keys())) for doc in chain] for chain in map_list]
+    if len(json.dumps(items)) > REDACT_MAP_PAYLOAD_BYTES:
+        logger.info(f"Artifacts of {sum([len(chain) for chain in map_list])} documents exceed {REDACT_MAP_PAYLOAD_BYTES} bytes, passing prefixes")
+        return map_list
+    return items
+
+def gen_list_for_map(documents: list, doc_costs: dict = None) -> list:
+    """
+    This function creates a list of lists to be used in Step Functions Map (https://docs.aws.amazon.com/step-functions/latest/dg/amazon-states-language-map-state.html). 
+    Each list is processed by one step function chain under Map. Documents are packed with the longest-processing-time-first heuristic: 
+    documents are sorted by cost (see get_doc_costs) and each one goes into the chain with the smallest total cost so far, so that all the 
+    chains finish at roughly the same time. The number of chains is the larger of the total cost divided by REDACT_BRANCH_COST and the number of 
+    documents divided by MAX_FILES_TO_REDACT. Documents estimated to need more than REDACT_MEMORY_MB to redact are given a chain of their own so 
+    that they cannot fail the other documents of a batch. Without costs every document costs the same.
+    With Step Functions Map you can have upto 40 parallel executions without throttling. Lower REDACT_BRANCH_COST if you intend to process larger 
+    documents since the redaction Lambda can be resource intensive.
+    """
+    try:
+        if not documents:
+            return None
+        doc_costs = doc_costs if doc_costs else {doc: (1, 0) for doc in documents}
+        oversized = [doc for doc in documents if doc_costs[doc][1] > REDACT_MEMORY_MB]
+        packable = sorted([doc for doc in documents if doc not in oversized], key=lambda doc: doc_costs[doc][0], reverse=True)
+
+        docs_to_redact = [[doc] for doc in oversized]
+        if packable:
+            total_cost = sum([doc_costs[doc][0] for doc in packable])
+            num_chains = max(math.ceil(total_cost / REDACT_BRANCH_COST), math.ceil(len(packable) / MAX_FILES_TO_REDACT), 1)
+            num_chains = min(num_chains, len(packable))
+            chains = [(0, idx, []) for idx in range(num_chains)]
+            heapq.heapify(chains)
+            for doc in packable:
+                cost, idx, docs = heapq.heappop(chains)
                 docs.append(doc)
-                if  ctr == MAX_FILES_TO_REDACT:
-                    ctr = 1
-                    docs_to_redact.append(docs)
-                    docs = []
-                if idx+1 == len(documents):
-                    docs_to_redact.append(docs)
-        
+                heapq.heappush(chains, (cost + doc_costs[doc][0], idx, docs))
+            docs_to_redact.extend([docs for cost, idx, docs in sorted(chains, reverse=True)])
+
         return docs_to_redact
     except Exception as e:
         logger.error(e)
         raise e
 
+def merge_manifests(manifests: list, cached_files: int = 0) -> dict:
+    """
+    Merges the Amazon Comprehend Medical Manifest files of the PHI detection shard jobs of a workflow. Numeric
+    Summary fields (file counts, bytes, characters) are added up, the Status is kept when all shards agree and
+    is PARTIAL_SUCCESS otherwise. File lists are concatenated and the Summary of every shard is kept under Shards.
+    Documents whose PHI entities came from the cache are counted as successful input files.
+    """
+    merged = {"Summary": {}, "Shards": []}
+    statuses = set()
+    for manifest in manifests:
+        summary = manifest.get("Summary", {})
+        merged["Shards"].append(summary)
+        for key, value in summary.items():
+            if key == "Status":
+                statuses.add(value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged["Summary"][key] = merged["Summary"].get(key, 0) + value
+            else:
+                merged["Summary"].setdefault(key, value)
+        for key, value in manifest.items():
+            if key != "Summary" and isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+    if cached_files:
+        statuses = statuses if statuses else {"COMPLETED"}
+        for key in ["InputFileCount", "SuccessfulFilesCount", "CachedFilesCount"]:
+            merged["Summary"][key] = merged["Summary"].get(key, 0) + cached_files
+        merged["Summary"].setdefault("UnprocessedFilesCount", 0)
+    merged["Summary"]["Status"] = statuses.pop() if len(statuses) == 1 else "PARTIAL_SUCCESS"
+    merged["Summary"]["ShardCount"] = len(manifests)
+    return merged
+
 def update_error_state(env_vars,event):
     logger.debug('Updating de-identification status to failed')
     wf_update = f"UPDATE \"{env_vars['IDP_TABLE']}\" SET de_identification_status=? WHERE part_key=? AND sort_key=?"
@@ -54,7 +149,10 @@ def update_error_state(env_vars,event):
                                                     {'S': f"input/{event['workflow_id']}/"}
                                                 ])
 
+@profiled
+@time_budget
 def lambda_handler(event, context):
+    started = now_ms()
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
@@ -70,12 +168,14 @@ def lambda_handler(event, context):
     s3 = S3(bucket=bucket, log_level=log_level)
     
     try:
-        logger.info("Getting all the output prefixes from workflow output")
-        documents = s3.list_prefixes(prefix=f"public/output/{workflow_id}")        
-
         logger.info("Copying PHI entity outputs and original documents to workflow output prefix")
         file_list = s3.list_objects(prefix=phi_output_dir, filters=["ComprehendMedicalS3WriteTestFile", "Manifest"])
-        for file in file_list:
+        # Outputs of documents served from the cache, staged with the same naming convention by idp-init-textract
+        cached_list = s3.list_objects(prefix=f"public/phi-cached/{workflow_id}/")
+        cache = DocumentCache(table=env_vars['IDP_TABLE'], log_level=log_level)
+        checkpoints = Checkpoints(table=env_vars['IDP_TABLE'], log_level=log_level)
+        phi_docs = {}
+        for file in file_list + cached_list:
             fragments = file.split('/')[-2:]
             phi_output = os.path.basename(file).split('.')[0]+".comp-med"
             
@@ -90,13 +190,26 @@ def lambda_handler(event, context):
             s3.move_object(source_object=file, destination_object=f"{workflow_output}/{phi_output}")
             #Move the original document
             s3.move_object(source_object=f"public/input/{workflow_id}/{document_name}", destination_object=f"{workflow_output}/orig-doc/{document_name}")
+            if file not in cached_list:
+                cache.put(cache.document_digest(workflow_id=workflow_id, document=document_name), comp_med=f"{workflow_output}/{phi_output}")
+            phi_docs[f"{workflow_output}/"] = document_name
 
         logger.info("Copying PHI entity Manifest file to target workflow prefix")
-        manifest_file = s3.list_objects(prefix=phi_output_dir, filters=["/failed/","/success/"], search=["Manifest"])[0]
-        s3.move_object(source_object=manifest_file, destination_object=f"public/output/{workflow_id}/Manifest")
+        manifest_files = s3.list_objects(prefix=phi_output_dir, filters=["/failed/","/success/"], search=["Manifest"])
+        if not manifest_files and not cached_list:
+            # Resumed workflow with every document already past PHI detection, keep the Manifest of the earlier run
+            logger.info("No new PHI detection output to merge into the Manifest")
+        elif len(manifest_files) == 1 and not cached_list:
+            s3.move_object(source_object=manifest_files[0], destination_object=f"public/output/{workflow_id}/Manifest")
+        else:
+            # One Manifest per PHI detection shard job, merge them into a single workflow Manifest
+            manifests = [json.loads(s3.get_object_content(key=manifest_file)) for manifest_file in manifest_files]
+            s3.put_object(key=f"public/output/{workflow_id}/Manifest", body=json.dumps(merge_manifests(manifests=manifests, cached_files=len(cached_list))))
+            if manifest_files:
+                s3.delete_objects(objects=manifest_files)
                 
-        logger.debug(f"Getting retain_orig_docs status from database")
-        stmt = f"SELECT \"retain_orig_docs\" FROM \"{env_vars['IDP_TABLE']}\" WHERE part_key=? AND sort_key=?"
+        logger.debug(f"Getting retain_orig_docs status and encoding profile from database")
+        stmt = f"SELECT \"retain_orig_docs\", \"encoding_profile\" FROM \"{env_vars['IDP_TABLE']}\" WHERE part_key=? AND sort_key=?"
         logger.debug(stmt)
         ddb_response = ddb.execute_statement(Statement=stmt, Parameters=[
                                                             {'S': workflow_id},
@@ -107,11 +220,37 @@ def lambda_handler(event, context):
         logger.debug(deserialized_document)
         retain_docs = deserialized_document['retain_orig_docs']
         logger.debug(retain_docs)
+        # None for workflows submitted without a profile, the redaction function then uses its default
+        encoding_profile = deserialized_document.get('encoding_profile')
                 
-        map_list = gen_list_for_map(documents=documents)
+        # One listing of the workflow output, after the moves above, serves the rest of the post-processing
+        workflow_prefix = f"public/output/{workflow_id}/"
+        index = index_by_job(s3.iter_object_sizes(prefix=workflow_prefix), workflow_prefix)
+        # Documents redacted by an earlier run of a resumed workflow, or while streaming (see PipelineFunctions)
+        redacted_docs = {prefix for prefix, object_sizes in index.items() if any(key.startswith(f"{prefix}redacted-doc/") for key in object_sizes)}
+        for prefix, document_name in phi_docs.items():
+            if prefix not in redacted_docs:
+                # Streamed documents recorded their PHI detection when it happened
+                checkpoints.record(workflow_id=workflow_id, document=document_name, stage='phi')
+
+        # Redacted documents are not redacted again. Streamed documents kept their original for the move above
+        documents = [doc for doc in sorted(index.keys()) if doc not in redacted_docs]
+        if not retain_docs and redacted_docs:
+            originals = [key for prefix in redacted_docs for key in index.get(prefix, {}) if key.startswith(f"{prefix}orig-doc/")]
+            for idx in range(0, len(originals), 1000):
+                s3.delete_objects(objects=originals[idx:idx+1000])
+        if not documents and redacted_docs:
+            checkpoints.record_step(workflow_id=workflow_id, step='phi_output', started=started)
+            return dict(workflow_id=workflow_id, input_prefix= f"input/{workflow_id}/",bucket=bucket, retain_docs=retain_docs, encoding_profile=encoding_profile, doc_list=[])
+
+        logger.info("Estimating redaction cost of documents")
+        doc_costs = get_doc_costs(s3=s3, index=index, documents=documents, doc_items=checkpoints.get_documents(workflow_id=workflow_id).values())
+        logger.debug(f"Connection statistics: {json.dumps(connection_stats())}")
+        map_list = gen_list_for_map(documents=documents, doc_costs=doc_costs)
         logger.debug(map_list)
         if map_list:
-            return dict(workflow_id=workflow_id, input_prefix= f"input/{workflow_id}/",bucket=bucket, retain_docs=retain_docs, doc_list=map_list)
+            checkpoints.record_step(workflow_id=workflow_id, step='phi_output', started=started)
+            return dict(workflow_id=workflow_id, input_prefix= f"input/{workflow_id}/",bucket=bucket, retain_docs=retain_docs, encoding_profile=encoding_profile, doc_list=map_items(map_list, index))
         else:
             update_error_state(env_vars=env_vars,event=event)
             return dict(error="Error occured while copying PHI output file. map_list is None")
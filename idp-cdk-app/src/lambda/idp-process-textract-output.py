@@ -1,24 +1,54 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 import json
 import logging
-from trp import Document
-from textractprettyprinter.t_pretty_print import Textract_Pretty_Print, get_string
-from textractcaller import get_full_json_from_output_config
-from textractcaller.t_call import OutputConfig
-import xlsxwriter
-
-s3 = boto3.client('s3')
-s3_resource = boto3.resource('s3')
+from CacheFunctions import DocumentCache
+from CheckpointFunctions import Checkpoints, now_ms
+from DDBFunctions import DDB
+from MetricsFunctions import put_metric
+from PhiRuleFunctions import PHI_RULES_MODE, covered, detect
+from PipelineFunctions import PIPELINE_MODE, detect_phi, start_redaction
+from S3Functions import S3
+from TextractFunctions import mark_processed as mark_document
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
+
+s3 = retrying_client('s3')
 logger = logging.getLogger(__name__)
 bucket = os.environ.get('IDP_BKT')
 
 
+def merge_textract_parts(parts):
+    """
+    Merges the Textract JSON of the page ranges of a split document into one response as if the whole document
+    had been analyzed by a single job. parts is a list of (first_page, response) in page order. Page numbers are
+    offset by the first page of the part, and block Ids of all but the first part are prefixed with the part
+    index since Ids are only unique within a job.
+    """
+    merged = None
+    for idx, (first_page, part) in enumerate(parts):
+        for block in part.get('Blocks', []):
+            if 'Page' in block:
+                block['Page'] += first_page - 1
+            if idx:
+                block['Id'] = f"{idx:03d}-{block['Id']}"
+                for relationship in block.get('Relationships', []):
+                    relationship['Ids'] = [f"{idx:03d}-{block_id}" for block_id in relationship['Ids']]
+        if merged is None:
+            merged = part
+            continue
+        merged['Blocks'].extend(part.get('Blocks', []))
+        merged['DocumentMetadata']['Pages'] += part.get('DocumentMetadata', {}).get('Pages', 0)
+        if part.get('Warnings'):
+            merged.setdefault('Warnings', []).extend(part['Warnings'])
+    return merged
+
 # Find Textract Async ouputs and merge them together into 1 json
 def get_textract_json(event):    
+    from textractcaller import get_full_json_from_output_config
+    from textractcaller.t_call import OutputConfig
     prefix = event['output_path']
     doc_name = event["doc_name"]
     dirs = event['output_path'].split("/")
@@ -28,8 +58,15 @@ def get_textract_json(event):
     result={}
     try:
         logger.debug(f"Merging Amazon Textract output JSON")
-        op_config = OutputConfig(s3_bucket=bucket, s3_prefix=s3Prefix)
-        result = get_full_json_from_output_config(output_config=op_config, job_id=job_id, s3_client=s3)        
+        if event.get('part_jobs'):
+            # Split document, merge the outputs of the Textract jobs of its page ranges
+            op_config = OutputConfig(s3_bucket=bucket, s3_prefix=event['parts_output_prefix'])
+            parts = [(part['first_page'], get_full_json_from_output_config(output_config=op_config, job_id=part['job_id'], s3_client=s3))
+                        for part in event['part_jobs']]
+            result = merge_textract_parts(parts)
+        else:
+            op_config = OutputConfig(s3_bucket=bucket, s3_prefix=s3Prefix)
+            result = get_full_json_from_output_config(output_config=op_config, job_id=job_id, s3_client=s3)        
 
         if(result):
             logger.debug(f"Merging json Done...")
@@ -39,10 +76,16 @@ def get_textract_json(event):
             For example, for document my_doc.pdf the corresponding JSON file will be named my_doc.pdf.json
             """            
             logger.debug(f"Writing JSON to S3")
-            s3.put_object(
-                    Body=json.dumps(result),
-                    Bucket=bucket,
-                    Key=f'{prefix}/{doc_name}.json'
+            # The page count and uncompressed size are kept as object metadata so the redaction planner can size
+            # documents with a HEAD request. The merged JSON is read back whole by the redaction, it is stored compressed
+            body = json.dumps(result)
+            # Recorded with the text checkpoint for the redaction planner (see idp-process-phi-output.py)
+            event['json_bytes'] = len(body)
+            S3(bucket=bucket, log_level=os.environ.get('LOG_LEVEL', 'INFO')).put_object(
+                    key=f'{prefix}/{doc_name}.json',
+                    body=body,
+                    Metadata={'pages': str(result.get('DocumentMetadata', {}).get('Pages', 0)), 'json-bytes': str(len(body))},
+                    compress=True
                 )
         else:
             logger.debug("Unable to process Textract Output JSON...")
@@ -51,7 +94,8 @@ def get_textract_json(event):
         logger.error(e)
         raise e
 
-def get_textract_features(textract_j):
+def get_textract_features(textract_j, forms_tables=True):
+    from trp import Document
     doc = Document(textract_j)
     lines, forms, tables = [], [], []     
     for page in doc.pages:
@@ -60,6 +104,10 @@ def get_textract_features(textract_j):
         for line in page.lines:
             lines.append([line.text, line.confidence])
 
+        # Text detection output (ocr processing profile) has no tables and forms
+        if not forms_tables:
+            continue
+
         # tables
         logger.debug("Writing Tables...")
         for table in page.tables:
@@ -79,11 +127,12 @@ def get_textract_features(textract_j):
     return lines, forms, tables
 
 def gen_excel(textract_j, event):    
+    import xlsxwriter
     # idp_table = os.environ.get('IDP_TABLE')
     prefix = event['output_path']
     doc_name = event["doc_name"]
     try:
-        lines, forms, tables = get_textract_features(textract_j)    
+        lines, forms, tables = get_textract_features(textract_j, forms_tables=event.get('textract_profile') != 'ocr')
         #Generate an Excel report for LINES, FORMS, and TABLES
         logger.debug("Writing Excel report /tmp/output_report.xlsx...")
         workbook = xlsxwriter.Workbook('/tmp/output_report.xlsx')
@@ -144,7 +193,7 @@ def gen_excel(textract_j, event):
         For example, for document my_doc.pdf the corresponding Excel file will be named my_doc.pdf-report.xlsx
         """
         logger.debug(f"Writing Excel report {doc_name}-report.xlsx to S3...")
-        s3_resource.meta.client.upload_file('/tmp/output_report.xlsx', bucket, f'{prefix}/{doc_name}-report.xlsx')
+        s3.upload_file('/tmp/output_report.xlsx', bucket, f'{prefix}/{doc_name}-report.xlsx')
         logger.debug("Upload Excel report to S3 complete...")
         return {"Payload": "done"}
     except Exception as e:
@@ -152,6 +201,7 @@ def gen_excel(textract_j, event):
         raise e
     
 def gen_plain_text(textract_j, event):
+    from textractprettyprinter.t_pretty_print import Textract_Pretty_Print, get_string
     dirs = event['output_path'].split("/")
     root_dir = dirs[0]
     job_id = dirs[-1]
@@ -160,6 +210,13 @@ def gen_plain_text(textract_j, event):
 
     logger.debug("Generating text file...")
     text = get_string(textract_json=textract_j, output_type=[Textract_Pretty_Print.LINES])    
+    rules = detect_rule_phi(text, event)
+    if rules.get('phi_covered'):
+        logger.info(f"PHI of {doc_name} fully detected by rules, skipping Amazon Comprehend Medical")
+    if PIPELINE_MODE == 'streaming' and stage_streamed_phi(text, rules, event):
+        rules['streamed'] = True
+    if rules.get('phi_covered') or rules.get('streamed'):
+        return text, rules
 
     logger.debug(f"Writing plaintext file to S3...")
     try:
@@ -185,15 +242,107 @@ def gen_plain_text(textract_j, event):
         logger.error(e)
         raise e
 
+    return text, rules
+
+def detect_rule_phi(text, event):
+    """
+    Runs the rule based PHI detection (see PhiRuleFunctions) on the PHI input text and writes the entities next to
+    the Textract JSON as <document_name>.phi-rules, for the redaction to merge with the Comprehend Medical output.
+    In skip mode the entities of a document the rules fully cover are staged under phi-cached/ as its Comprehend
+    Medical output instead, like a cached output, and its PHI input text is not written. Returns the cache pointers
+    of the entities (phi_rules, phi_covered)
+    """
+    if PHI_RULES_MODE == 'off':
+        return {}
+    dirs = event['output_path'].split("/")
+    doc_name = event["doc_name"]
+    entities = detect(text)
+    output = json.dumps(dict(Entities=entities))
+    phi_rules = f"{event['output_path']}/{doc_name}.phi-rules"
+    s3.put_object(Body=output, Bucket=bucket, Key=phi_rules)
+    put_metric(name='PhiRuleEntities', value=len(entities))
+
+    phi_covered = PHI_RULES_MODE == 'skip' and covered(text, entities)
+    if phi_covered:
+        s3.put_object(Body=output, Bucket=bucket, Key=f"{dirs[0]}/phi-cached/{event['workflow_id']}/{dirs[-1]}/{doc_name}.txt.out")
+        put_metric(name='PhiDetectionSkipped')
+    return dict(phi_rules=phi_rules, phi_covered=phi_covered)
+
+def stage_streamed_phi(text, rules, event):
+    """
+    Streaming pipeline mode (see PipelineFunctions): detects the PHI of a document of a de-identification workflow
+    with the synchronous DetectPHI API and stages it under phi-cached/, unless the rules already staged it. Returns
+    whether the document is streamed, documents of other workflows or whose PHI could not be detected go the
+    staged path
+    """
+    dirs = event['output_path'].split("/")
+    doc_name = event["doc_name"]
+    wf_id = event["workflow_id"]
+    workflow = DDB(table=os.environ.get('IDP_TABLE'), log_level=os.environ.get('LOG_LEVEL', 'INFO')).get_item(part_key=wf_id, sort_key=f"input/{wf_id}/")
+    if not workflow or not workflow.get('de_identify'):
+        return False
+    event['workflow'] = dict(encoding_profile=workflow.get('encoding_profile'))
+    started = now_ms()
+    if not rules.get('phi_covered'):
+        try:
+            phi_output = detect_phi(text)
+        except Exception as e:
+            logger.warning(f"Unable to detect PHI of {doc_name} synchronously, using the PHI detection job: {e}")
+            return False
+        s3.put_object(Body=json.dumps(phi_output), Bucket=bucket, Key=f"{dirs[0]}/phi-cached/{wf_id}/{dirs[-1]}/{doc_name}.txt.out")
+    Checkpoints(table=os.environ.get('IDP_TABLE'), log_level=os.environ.get('LOG_LEVEL', 'INFO')).record(workflow_id=wf_id, document=doc_name, stage='phi', started=started)
     return True
 
+def redact_streamed(rules, event):
+    """
+    Starts the redaction of a streamed document. The original document stays in the workflow input until the PHI
+    post-processing moves it, the redaction marks the document processed
+    """
+    prefix = event['output_path']
+    dirs = prefix.split("/")
+    doc_name = event["doc_name"]
+    wf_id = event["workflow_id"]
+    doc = dict(comp_med=f"{dirs[0]}/phi-cached/{wf_id}/{dirs[-1]}/{doc_name}.txt.out", txtract=f"{prefix}/{doc_name}.json",
+               doc=f"{dirs[0]}/input/{wf_id}/{doc_name}", redacted_doc=f"{prefix}/redacted-doc/{doc_name}", job_id=dirs[-1])
+    if rules.get('phi_rules'):
+        doc['phi_rules'] = rules['phi_rules']
+    start_redaction(function_name=os.environ['LAMBDA_REDACT'], payload=dict(bucket=bucket, workflow_id=wf_id, retain_docs=True, stream=True,
+                                                                            encoding_profile=event['workflow']['encoding_profile'], redact_data=[doc]))
+
+def cache_artifacts(text, rules, event):
+    """
+    Records the Textract artifacts of the document in the content addressed cache. The PHI input text is copied
+    under public/cache/ since the text under phi-input/ is moved around when the PHI detection job is sharded.
+    """
+    prefix = event['output_path']
+    doc_name = event["doc_name"]
+    cache = DocumentCache(table=os.environ.get('IDP_TABLE'), log_level=os.environ.get('LOG_LEVEL', 'INFO'))
+    digest = cache.document_digest(workflow_id=event["workflow_id"], document=doc_name)
+    if digest:
+        phi_text = f'{prefix.split("/")[0]}/cache/{digest}/{doc_name}.txt'
+        s3.put_object(Body=text, Bucket=bucket, Key=phi_text)
+        cache.put(digest, textract_json=f'{prefix}/{doc_name}.json', report=f'{prefix}/{doc_name}-report.xlsx', phi_text=phi_text,
+                  **{name: value for name, value in rules.items() if name != 'streamed'})
+
+def mark_processed(event, status):
+    """
+    Writes the temp processing file of the document once its PHI input text is written (or the document failed)
+    and sends the task success to the state machine when it was the last document of the workflow.
+    """
+    dirs = event['output_path'].split("/")
+    mark_document(workflow_id=event["workflow_id"], document=event["doc_name"], status=status, job_id=dirs[-1], bucket=bucket, root_prefix=dirs[0], env_vars=dict(os.environ))
+
+@profiled
+@time_budget
 def lambda_handler(event, context):
+    started = now_ms()
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
 
     path = event['output_path']    
     final_response = {}
+    status = 'failed'
     
     try:
         logger.debug(f"Merging JSON in {path}...")
@@ -204,13 +353,25 @@ def lambda_handler(event, context):
             final_response['message'] = f"Textract JSON processing failed for {path}"
         else:            
             # write plaintext file
-            gen_plain_text(textract_j, event)
+            text, rules = gen_plain_text(textract_j, event)
 
             # lines, forms, tables = get_textract_features(textract_j)            
             final_response = gen_excel(textract_j, event)
+            Checkpoints(table=os.environ.get('IDP_TABLE'), log_level=log_level).record(workflow_id=event["workflow_id"], document=event["doc_name"], stage='text', started=started,
+                                                                                  output_path=path, pages=textract_j.get('DocumentMetadata', {}).get('Pages', 0),
+                                                                                  json_bytes=event.get('json_bytes', 0))
+            cache_artifacts(text, rules, event)
+            status = 'succeeded'
+            if rules.get('streamed'):
+                redact_streamed(rules, event)
+                logger.debug(f"Textract Output JSON processed and redaction started {path}...")
+                return final_response
         logger.debug(f"Textract Output JSON processed and report created {path}...")   
     except Exception as e:
         logger.error(e)
+        # Lambda retries the invocation, the on-failure destination (idp-async-failure) marks the document failed
+        # once every attempt failed
         raise e
 
-    return final_response
\ No newline at end of file
+    mark_processed(event, status)
+    return final_response
@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Resumes a failed or stopped workflow from the per-document stage checkpoints, invoke with {"workflow_id": "<id>"}.
+The state machine is started again and the stages that completed for a document are not repeated:
+    - documents still under input/ without Textract output are queued for Textract again
+    - documents still under input/ with Textract output get their temp processing file back so they count as
+      processed, their PHI input text is kept so the PHI detection job picks them up
+    - documents whose PHI entities were already moved to the workflow output have their PHI input text removed,
+      they are only redacted if they have no redacted document yet (see idp-process-phi-output)
+"""
+
+import os
+import json
+import time
+import logging
+from S3Functions import S3
+from DDBFunctions import DDB
+from CheckpointFunctions import Checkpoints
+from SchedulerFunctions import Scheduler
+from ClientFunctions import LazyClient
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
+
+sfn = LazyClient('stepfunctions')
+ddb = retrying_client('dynamodb')
+logger = logging.getLogger(__name__)
+
+@profiled
+@time_budget
+def lambda_handler(event, context):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(json.dumps(event))
+
+    workflow_id = event["workflow_id"]
+    idp_table = os.environ.get('IDP_TABLE')
+    bucket = os.environ.get('IDP_BKT')
+
+    s3 = S3(bucket=bucket, log_level=log_level)
+    checkpoints = Checkpoints(table=idp_table, log_level=log_level)
+
+    try:
+        ddb_tbl = DDB(table=idp_table, log_level=log_level)
+        workflow = ddb_tbl.get_item(part_key=workflow_id, sort_key=f"input/{workflow_id}/")
+        if not workflow:
+            return dict(error=f"Workflow {workflow_id} not found")
+
+        documents = checkpoints.get_documents(workflow_id=workflow_id)
+        input_docs = {os.path.basename(key) for key in s3.list_objects(prefix=f"public/input/{workflow_id}/")}
+        phi_inputs = s3.list_objects(prefix=f"public/phi-input/{workflow_id}/")
+
+        logger.info("Removing temp processing files and PHI outputs of the failed run")
+        s3.delete_prefix(prefix=f"public/temp/{workflow_id}/")
+        s3.delete_prefix(prefix=f"public/phi-output/{workflow_id}/")
+        # Split documents that are queued again are split again, their part completion markers must not carry over
+        s3.delete_prefix(prefix=f"public/parts/{workflow_id}/")
+        for item in ddb_tbl.query_items(part_key=workflow_id, sort_key_prefix="parts/"):
+            ddb.delete_item(TableName=idp_table, Key={'part_key': {'S': workflow_id}, 'sort_key': {'S': item['sort_key']}})
+
+        to_ocr = sorted([doc for doc in input_docs if not checkpoints.completed(documents.get(doc), 'text')])
+        ocr_done = sorted([doc for doc in input_docs if doc not in to_ocr])
+        phi_done = [doc for doc in documents.keys() if doc not in input_docs and checkpoints.completed(documents[doc], 'phi')]
+
+        for doc in ocr_done:
+            file_to_process = {doc: {"S": f"succeeded:{documents[doc].get('job_id')}"}}
+            s3.put_object(key=f"public/temp/{workflow_id}/{doc}.json", body=json.dumps(file_to_process))
+
+        # PHI input text of documents that are queued again is generated again by the Textract post-processing
+        stale_phi_inputs = [key for key in phi_inputs if os.path.basename(key)[:-len(".txt")] in set(phi_done + to_ocr)]
+        for idx in range(0, len(stale_phi_inputs), 1000):
+            s3.delete_objects(objects=stale_phi_inputs[idx:idx+1000])
+
+        logger.info(f"Queueing {len(to_ocr)} documents for Textract")
+        Scheduler(table=idp_table, log_level=log_level).enqueue(workflow_id=workflow_id, input_path=f"input/{workflow_id}/", documents=to_ocr,
+                                                               priority=workflow.get('priority'))
+
+        logger.info("Resetting workflow status")
+        wf_update = f"UPDATE \"{idp_table}\" SET status=? SET de_identification_status=? REMOVE workflow_token WHERE part_key=? AND sort_key=?"
+        ddb.execute_statement(Statement=wf_update, Parameters=[
+                                                        {'S': 'processing'},
+                                                        {'S': 'processing' if workflow.get('de_identify') else 'not_requested'},
+                                                        {'S': workflow_id},
+                                                        {'S': f"input/{workflow_id}/"}
+                                                    ])
+
+        # Execution names are unique per state machine, the first run used idp-workflow-<workflow_id>
+        sfnResponse = sfn.start_execution(
+                            stateMachineArn=os.environ.get('STATE_MACHINE'),
+                            name=f'idp-workflow-{workflow_id}-resume-{int(time.time())}',
+                            input=json.dumps(dict(workflow_id=workflow_id, bucket=bucket))
+                        )
+        logger.debug(sfnResponse)
+
+        return dict(workflow_id=workflow_id, textract=to_ocr, phi_detection=ocr_done, redaction_only=phi_done)
+    except Exception as e:
+        logger.error('Error: {}'.format(e))
+        raise e
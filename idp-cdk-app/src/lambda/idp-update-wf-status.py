@@ -1,20 +1,24 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
 import os
 import json
 import logging
 from boto3.dynamodb.types import TypeDeserializer
 from S3Functions import S3
+from DDBFunctions import DDB
+from CheckpointFunctions import Checkpoints, now_ms
+from ProfileFunctions import profiled
+from RetryFunctions import retrying_client, time_budget
 
-# s3 = boto3.client('s3')
-# s3r = boto3.resource('s3')
-ddb = boto3.client('dynamodb')
+ddb = retrying_client('dynamodb')
 logger = logging.getLogger(__name__)
 deserializer = TypeDeserializer()
 
+@profiled
+@time_budget
 def lambda_handler(event, context):
+    started = now_ms()
     log_level = os.environ.get('LOG_LEVEL', 'INFO')    
     logger.setLevel(log_level)
     logger.info(json.dumps(event))
@@ -41,12 +45,28 @@ def lambda_handler(event, context):
             processed_docs = {**processed_docs, **obj}
             logger.debug(processed_docs)
 
+        # Counts cover documents that are not re-processed when a workflow is resumed as well
+        ddb_table = DDB(table=env_vars['IDP_TABLE'], log_level=log_level)
+        doc_statuses = {item['sort_key'][len("doc/"):]: item.get('doc_status', 'ready') for item in ddb_table.query_items(part_key=workflow_id, sort_key_prefix="doc/")}
+
+        logger.info(f"Updating status of {len(processed_docs)} documents...")
+        doc_update = f"UPDATE \"{env_vars['IDP_TABLE']}\" SET doc_status=? SET job_id=? WHERE part_key=? AND sort_key=?"
+        errors = ddb_table.batch_execute(statement=doc_update, parameters=[
+                                    [{'S': value['S'].split(':')[0]}, {'S': value['S'].split(':')[1]}, {'S': workflow_id}, {'S': f"doc/{doc}"}]
+                                    for doc, value in processed_docs.items()
+                                ])
+        if errors:
+            # The temp files are deleted below, the document statuses would be lost with them
+            raise Exception(f"Unable to update the status of {len(errors)} of {len(processed_docs)} documents: {errors[0]}")
+        doc_statuses.update({doc: value['S'].split(':')[0] for doc, value in processed_docs.items()})
+
         logger.info("Updating workflow status...")
-        update = f"UPDATE \"{env_vars['IDP_TABLE']}\" SET docs=? SET status=? set phi_input=? WHERE part_key=? AND sort_key=? RETURNING ALL NEW *"
+        update = f"UPDATE \"{env_vars['IDP_TABLE']}\" SET status=? SET phi_input=? SET succeeded_count=? SET failed_count=? WHERE part_key=? AND sort_key=? RETURNING ALL NEW *"
         ddbresponse = ddb.execute_statement(Statement=update, Parameters=[
-                                                                {'M': processed_docs},
                                                                 {'S': "complete"},
                                                                 {'S': phi_input_dir},
+                                                                {'N': str(len([doc for doc, status in doc_statuses.items() if status == 'succeeded']))},
+                                                                {'N': str(len([doc for doc, status in doc_statuses.items() if status not in ('succeeded', 'ready')]))},
                                                                 {'S': workflow_id},
                                                                 {'S': f"input/{workflow_id}/"}
                                                             ])
@@ -59,9 +79,13 @@ def lambda_handler(event, context):
         logger.debug(json.dumps(ddbresponse))
 
         logger.info("Deleting temp files")
-        s3.delete_objects(objects=processed_files)
+        for idx in range(0, len(processed_files), 1000):
+            s3.delete_objects(objects=processed_files[idx:idx+1000])
+        Checkpoints(table=env_vars['IDP_TABLE'], log_level=log_level).record_step(workflow_id=workflow_id, step='update_status', started=started)
         
     except Exception as e:
+        # Calls are already retried (RetryFunctions), fail the task instead of going on without the workflow status
         logger.error(e)
+        raise e
 
     return dict(workflow_id=workflow_id, bucket=bucket, phi_input_dir=phi_input_dir, de_identify=de_identify)
\ No newline at end of file
@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import logging
+from S3Functions import S3
+from SummaryFunctions import build_summary, summary_key, workflow_header
+from CheckpointFunctions import Checkpoints
+from DDBFunctions import DDB
+from ProfileFunctions import profiled
+from RetryFunctions import time_budget
+
+logger = logging.getLogger(__name__)
+
+@profiled
+@time_budget
+def lambda_handler(event, context):
+    log_level = os.environ.get('LOG_LEVEL', 'INFO')
+    logger.setLevel(log_level)
+    logger.info(json.dumps(event))
+
+    workflow_id = event["workflow_id"]
+    bucket = event["bucket"]
+    s3 = S3(bucket=bucket, log_level=log_level)
+
+    try:
+        logger.info(f"Writing de-identification summary of workflow {workflow_id}")
+        documents = Checkpoints(table=os.environ.get('IDP_TABLE'), log_level=log_level).get_documents(workflow_id=workflow_id)
+        # PHI detection jobs that failed, recorded by idp-phi-job-status-check
+        workflow = DDB(table=os.environ.get('IDP_TABLE'), log_level=log_level).get_item(part_key=workflow_id, sort_key=f"input/{workflow_id}/") or {}
+        summary = build_summary(s3=s3, workflow_id=workflow_id, documents=documents, failed_jobs=workflow.get('failed_jobs'))
+        if workflow:
+            # Written as the last step of the redaction, the state machine sets the status right after
+            summary['header'] = dict(workflow_header(workflow=workflow, documents=list(documents.values())), de_identification_status='processed', queue=None)
+        s3.put_object(key=summary_key(workflow_id), body=json.dumps(summary))
+        return dict(workflow_id=workflow_id, summary=summary_key(workflow_id))
+    except Exception as e:
+        # The detail API falls back to listing the workflow output when there is no summary
+        logger.error(e)
+        return dict(workflow_id=workflow_id, error=str(e))
@@ -0,0 +1,47 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Unit tests of the Lambda code in src/lambda, run from idp-cdk-app with
+
+    python -m pytest -q test/lambda
+
+AWS calls go to the in-memory fakes of tools/fakes.py (the aws fixture), handler modules with hyphenated file
+names are loaded with load_handler.
+"""
+
+import importlib.util
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+LAMBDA_DIR = os.path.join(APP_DIR, 'src', 'lambda')
+sys.path[:0] = [LAMBDA_DIR, os.path.join(APP_DIR, 'tools')]
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import ClientFunctions
+import fakes
+
+_handlers = {}
+
+def load_handler(name: str):
+    """Module of the handler src/lambda/<name>.py, e.g. load_handler('idp-get-workflows')
+    """
+    if name not in _handlers:
+        spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(LAMBDA_DIR, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _handlers[name] = module
+    return _handlers[name]
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Fake S3 and DynamoDB behind every client of the Lambda code for the duration of a test
+    """
+    stats = fakes.CallStats()
+    clients = dict(s3=fakes.FakeS3(stats), dynamodb=fakes.FakeDynamoDB(stats))
+    monkeypatch.setattr(ClientFunctions, 'get_client', lambda service, resource=False, config=None: clients[service])
+    return SimpleNamespace(stats=stats, **clients)
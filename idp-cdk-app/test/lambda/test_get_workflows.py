@@ -0,0 +1,69 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import json
+
+import pytest
+
+from conftest import load_handler
+
+get_workflows = load_handler('idp-get-workflows')
+DAY_MS = 24 * 3600 * 1000
+# 2023-11-14T00:00:00Z
+START = 1699920000000
+
+def test_paginate():
+    items = list(range(7))
+    page, cursor = get_workflows.paginate(items, None, 3)
+    pages = [page]
+    while cursor:
+        page, cursor = get_workflows.paginate(items, cursor, 3)
+        pages.append(page)
+    assert pages == [[0, 1, 2], [3, 4, 5], [6]]
+    assert get_workflows.paginate([], None, 3) == ([], None)
+
+class ListIndex:
+    """submit_day-submit_ts-index of the workflows submitted at timestamps, pages of Limit items with the offset
+    of the next one as NextToken
+    """
+    def __init__(self, timestamps: list):
+        self.items = [{'part_key': {'S': f"wf-{idx}"}, 'sort_key': {'S': f"input/wf-{idx}/"}, 'submit_ts': {'N': str(submit_ts)},
+                       'submit_day': {'S': get_workflows.get_days(submit_ts, submit_ts)[0]}} for idx, submit_ts in enumerate(timestamps)]
+
+    def execute_statement(self, Statement, Parameters, Limit, NextToken=None):
+        day, start, end = Parameters[0]['S'], int(Parameters[1]['N']), int(Parameters[2]['N'])
+        matches = [item for item in self.items if item['submit_day']['S'] == day and start <= int(item['submit_ts']['N']) <= end]
+        offset = int(NextToken) if NextToken else 0
+        response = dict(Items=matches[offset:offset + Limit])
+        if offset + Limit < len(matches):
+            response['NextToken'] = str(offset + Limit)
+        return response
+
+def list_all(start: int, end: int, limit: int) -> list:
+    pages, cursor = [], None
+    while True:
+        workflows, cursor = get_workflows.list_workflows('table', start, end, limit, cursor=cursor)
+        pages.append(sorted(workflow['part_key'] for workflow in workflows))
+        if not cursor:
+            return pages
+
+def test_list_workflows_pages_across_days(monkeypatch):
+    monkeypatch.setattr(get_workflows, 'ddb', ListIndex([START + 1, START + 2, START + DAY_MS + 1, START + 3 * DAY_MS + 1, START + 3 * DAY_MS + 2]))
+    pages = list_all(START, START + 4 * DAY_MS - 1, 2)
+    assert sum(pages, []) == sorted(f"wf-{idx}" for idx in range(5))
+    assert all(len(page) <= 2 for page in pages)
+
+def test_list_workflows_range_filters(monkeypatch):
+    monkeypatch.setattr(get_workflows, 'ddb', ListIndex([START + 1, START + 1000, START + DAY_MS + 1]))
+    assert list_all(START, START + 500, 10) == [['wf-0']]
+
+@pytest.mark.parametrize('cursor', ['not base64 !', base64.urlsafe_b64encode(b'[1]').decode(),
+                                    base64.urlsafe_b64encode(json.dumps({'token': 'x'}).encode()).decode(),
+                                    base64.urlsafe_b64encode(json.dumps({'day': '1999-01-01'}).encode()).decode()])
+def test_list_workflows_rejects_bad_cursors(monkeypatch, cursor):
+    monkeypatch.setattr(get_workflows, 'ddb', ListIndex([]))
+    with pytest.raises(get_workflows.InvalidCursor):
+        get_workflows.list_workflows('table', START, START + DAY_MS, 10, cursor=cursor)
+    response = get_workflows.lambda_handler({'queryStringParameters': {'fetch': 'all', 'startdt': str(START), 'enddt': str(START + DAY_MS), 'cursor': cursor}}, None)
+    assert response['statusCode'] == 400
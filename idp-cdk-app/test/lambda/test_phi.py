@@ -0,0 +1,151 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+
+from conftest import load_handler
+from PhiRuleFunctions import covered, detect
+from PipelineFunctions import segments
+
+init_phi = load_handler('idp-init-phi-detection')
+process_phi = load_handler('idp-process-phi-output')
+
+def test_gen_shards_keeps_key_order_and_limits(monkeypatch):
+    monkeypatch.setattr(init_phi, 'PHI_SHARD_MAX_FILES', 3)
+    file_sizes = {f"phi-input/wf/job-{idx % 4}/doc-{idx:02d}.txt": 10 for idx in range(10)}
+    shards = init_phi.gen_shards(file_sizes)
+    assert len(shards) >= 4
+    assert [key for shard in shards for key in shard] == sorted(file_sizes)
+    assert all(len(shard) <= 3 for shard in shards)
+
+def test_gen_shards_by_bytes_and_max_shards(monkeypatch):
+    monkeypatch.setattr(init_phi, 'PHI_SHARD_MAX_BYTES', 100)
+    monkeypatch.setattr(init_phi, 'PHI_MAX_SHARDS', 2)
+    shards = init_phi.gen_shards({f"doc-{idx}.txt": 60 for idx in range(6)})
+    assert len(shards) == 2
+    assert sum(len(shard) for shard in shards) == 6
+
+def test_gen_shards_single_shard():
+    assert init_phi.gen_shards({'a.txt': 1, 'b.txt': 2}) == [['a.txt', 'b.txt']]
+    assert init_phi.gen_shards({}) == []
+
+def stage_inputs(aws, phi_input_dir: str) -> list:
+    # Sharding steps of the handler
+    listed = aws.s3.list_objects_v2(Bucket='bucket', Prefix=phi_input_dir)
+    file_sizes, staged, duplicates = init_phi.locate_inputs(phi_input_dir, {obj['Key']: obj['Size'] for obj in listed.get('Contents', [])})
+    if duplicates:
+        aws.s3.delete_objects(Bucket='bucket', Delete={'Objects': [{'Key': key} for key in duplicates]})
+    return init_phi.stage_shards(init_phi.S3(bucket='bucket'), phi_input_dir, init_phi.gen_shards(file_sizes), staged)
+
+def stored_keys(aws, prefix: str) -> list:
+    return sorted(obj['Key'] for obj in aws.s3.list_objects_v2(Bucket='bucket', Prefix=prefix).get('Contents', []))
+
+def test_stage_shards_resumes_without_nesting(aws, monkeypatch):
+    monkeypatch.setattr(init_phi, 'PHI_SHARD_MAX_FILES', 2)
+    for idx in range(6):
+        aws.s3.put_object(Bucket='bucket', Key=f"phi-input/wf/job-{idx}/doc-{idx}.txt", Body=b'text')
+    prefixes = stage_inputs(aws, 'phi-input/wf/')
+    assert prefixes == [f"phi-input/wf/shard-{idx:03d}/" for idx in range(3)]
+    first_run = stored_keys(aws, 'phi-input/wf/')
+    assert first_run[0] == 'phi-input/wf/shard-000/job-0/doc-0.txt'
+
+    # A re-run finds the files staged and leaves them in place
+    copies = aws.stats.calls['s3.CopyObject']
+    assert stage_inputs(aws, 'phi-input/wf/') == prefixes
+    assert stored_keys(aws, 'phi-input/wf/') == first_run
+    assert aws.stats.calls['s3.CopyObject'] == copies
+
+    # A copy left by an interrupted move is dropped, files change shard without nesting shard directories
+    aws.s3.put_object(Bucket='bucket', Key='phi-input/wf/job-5/doc-5.txt', Body=b'text')
+    monkeypatch.setattr(init_phi, 'PHI_SHARD_MAX_FILES', 3)
+    assert stage_inputs(aws, 'phi-input/wf/') == ['phi-input/wf/shard-000/', 'phi-input/wf/shard-001/']
+    keys = stored_keys(aws, 'phi-input/wf/')
+    assert len(keys) == 6
+    assert all(key.count('shard-') == 1 for key in keys)
+    assert keys[3] == 'phi-input/wf/shard-001/job-3/doc-3.txt'
+
+    # A single shard moves its files back in place
+    monkeypatch.setattr(init_phi, 'PHI_SHARD_MAX_FILES', 10)
+    assert stage_inputs(aws, 'phi-input/wf/') == ['phi-input/wf/']
+    assert stored_keys(aws, 'phi-input/wf/') == [f"phi-input/wf/job-{idx}/doc-{idx}.txt" for idx in range(6)]
+
+def test_request_token_per_execution_and_shard():
+    token = init_phi.request_token('idp-workflow-wf', 0, 'phi-input/wf/shard-000/')
+    assert token == init_phi.request_token('idp-workflow-wf', 0, 'phi-input/wf/shard-000/')
+    assert re.fullmatch(r'[a-zA-Z0-9-]{1,64}', token)
+    assert token != init_phi.request_token('idp-workflow-wf', 1, 'phi-input/wf/shard-001/')
+    assert token != init_phi.request_token('idp-workflow-wf-resume-1', 0, 'phi-input/wf/shard-000/')
+
+def test_merge_manifests_adds_counts_and_keeps_lists():
+    manifests = [
+        {"Summary": {"Status": "COMPLETED", "InputFileCount": 2, "SuccessfulFilesCount": 2, "JobId": "a"}, "SuccessfulFilesList": [1, 2]},
+        {"Summary": {"Status": "COMPLETED", "InputFileCount": 3, "SuccessfulFilesCount": 3, "JobId": "b"}, "SuccessfulFilesList": [3]},
+    ]
+    merged = process_phi.merge_manifests(manifests)
+    assert merged["Summary"]["Status"] == "COMPLETED"
+    assert merged["Summary"]["InputFileCount"] == 5
+    assert merged["Summary"]["JobId"] == "a"
+    assert merged["Summary"]["ShardCount"] == 2
+    assert merged["SuccessfulFilesList"] == [1, 2, 3]
+    assert len(merged["Shards"]) == 2
+
+def test_merge_manifests_partial_success_and_cached_files():
+    merged = process_phi.merge_manifests([{"Summary": {"Status": "COMPLETED"}}, {"Summary": {"Status": "FAILED"}}])
+    assert merged["Summary"]["Status"] == "PARTIAL_SUCCESS"
+
+    merged = process_phi.merge_manifests([], cached_files=4)
+    assert merged["Summary"]["Status"] == "COMPLETED"
+    assert merged["Summary"]["InputFileCount"] == 4
+    assert merged["Summary"]["CachedFilesCount"] == 4
+    assert merged["Summary"]["UnprocessedFilesCount"] == 0
+
+def test_gen_list_for_map_balances_costs(monkeypatch):
+    monkeypatch.setattr(process_phi, 'REDACT_BRANCH_COST', 10)
+    costs = {'a': (8, 10), 'b': (7, 10), 'c': (3, 10), 'd': (2, 10)}
+    chains = process_phi.gen_list_for_map(list(costs), costs)
+    assert sorted(doc for chain in chains for doc in chain) == ['a', 'b', 'c', 'd']
+    assert sorted(sum(costs[doc][0] for doc in chain) for chain in chains) == [10, 10]
+
+def test_gen_list_for_map_isolates_oversized(monkeypatch):
+    monkeypatch.setattr(process_phi, 'REDACT_MEMORY_MB', 100)
+    costs = {'big': (1, 500), 'a': (1, 10), 'b': (1, 10)}
+    chains = process_phi.gen_list_for_map(list(costs), costs)
+    assert ['big'] in chains
+    assert sorted(doc for chain in chains if chain != ['big'] for doc in chain) == ['a', 'b']
+
+def test_gen_list_for_map_file_limit_and_empty():
+    chains = process_phi.gen_list_for_map([f"doc-{idx}" for idx in range(25)])
+    assert len(chains) == 3
+    assert all(len(chain) <= process_phi.MAX_FILES_TO_REDACT for chain in chains)
+    assert process_phi.gen_list_for_map([]) is None
+
+def test_detect_rules():
+    text = "Patient SSN 123-45-6789 seen 01/02/2023, call (206) 555-0100 or mail jane@example.com"
+    entities = detect(text)
+    assert [(entity['Rule'], entity['Text']) for entity in entities] == [
+        ('SSN', '123-45-6789'), ('DATE', '01/02/2023'), ('PHONE', '(206) 555-0100'), ('EMAIL', 'jane@example.com')]
+    assert all(text[entity['BeginOffset']:entity['EndOffset']] == entity['Text'] for entity in entities)
+
+def test_detect_skips_invalid_and_overlapping():
+    # 000 is never a valid SSN area number
+    assert detect("SSN 000-12-3456") == []
+    entities = detect("MRN: AB-2023-01-02-99")
+    assert [entity['Rule'] for entity in entities] == ['MRN']
+
+def test_covered():
+    text = "123-45-6789"
+    assert covered(text, detect(text))
+    assert not covered("SSN 123-45-6789", detect("SSN 123-45-6789"))
+    assert covered("", [])
+
+def test_segments_split_at_line_ends():
+    text = "".join(f"line {idx}\n" for idx in range(10))
+    parts = segments(text, max_bytes=20)
+    assert "".join(segment for offset, segment in parts) == text
+    assert all(len(segment.encode('utf-8')) <= 20 and segment.endswith("\n") for offset, segment in parts)
+    assert all(text[offset:offset + len(segment)] == segment for offset, segment in parts)
+
+def test_segments_cut_long_lines_on_characters():
+    text = "é" * 15
+    parts = segments(text, max_bytes=10)
+    assert [len(segment) for offset, segment in parts] == [5, 5, 5]
@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import EncodingFunctions
+import RasterFunctions
+from EncodingFunctions import parse_profile
+from RasterFunctions import choose_dpi, page_pixels
+
+LETTER = (612, 792)
+
+def test_choose_dpi_without_boxes_is_min_dpi(monkeypatch):
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MIN_DPI', 100)
+    assert choose_dpi([LETTER], []) == 100
+
+def test_choose_dpi_raises_for_small_boxes(monkeypatch):
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MIN_DPI', 100)
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MAX_DPI', 300)
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MIN_BOX_PX', 10)
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MAX_PAGE_PIXELS', 100 * 1000 * 1000)
+    # A box 0.05 inches high needs 200 DPI to be 10 pixels high, one more with the rounding of the ratio
+    dpi = choose_dpi([LETTER], [(1, 0.5, 0.05 * 72 / LETTER[1])])
+    assert 200 <= dpi <= 201
+    assert choose_dpi([LETTER], [(1, 0.5, 0.001)]) == 300
+
+def test_choose_dpi_bounded_by_page_pixels(monkeypatch):
+    monkeypatch.setattr(RasterFunctions, 'RASTER_MAX_PAGE_PIXELS', 1000 * 1000)
+    dpi = choose_dpi([LETTER], [(1, 0.5, 0.001)])
+    width, height = page_pixels(LETTER, dpi)
+    assert width * height <= 1000 * 1000
+    assert choose_dpi([LETTER], [(1, 0.5, 0.001)], max_pixels=100 * 100) < dpi
+
+def test_parse_profile(monkeypatch):
+    monkeypatch.setattr(EncodingFunctions, 'ENCODING_PROFILE', 'auto')
+    monkeypatch.setattr(EncodingFunctions, 'ENCODING_JPEG_QUALITY', 75)
+    assert parse_profile('grayscale') == ('grayscale', 75)
+    assert parse_profile('photo:60') == ('photo', 60)
+    assert parse_profile('photo:500') == ('photo', 95)
+    assert parse_profile('photo:0') == ('photo', 1)
+    assert parse_profile('photo:high') == ('photo', 75)
+    assert parse_profile(None) == ('auto', 75)
+    assert parse_profile('unknown:50') == ('auto', 75)
@@ -0,0 +1,13 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import RetryFunctions
+
+def test_backoff_ms_stays_within_bounds(monkeypatch):
+    monkeypatch.setattr(RetryFunctions, 'RETRY_BASE_MS', 50)
+    monkeypatch.setattr(RetryFunctions, 'RETRY_CAP_MS', 1000)
+    delay = RetryFunctions.RETRY_BASE_MS
+    for _ in range(200):
+        previous, delay = delay, RetryFunctions.backoff_ms(delay)
+        assert 50 <= delay <= min(1000, previous * 3)
+    assert RetryFunctions.backoff_ms(10000) <= 1000
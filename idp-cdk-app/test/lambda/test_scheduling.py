@@ -0,0 +1,78 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+from types import SimpleNamespace
+
+from conftest import load_handler
+import SchedulerFunctions
+from SchedulerFunctions import Scheduler, allocate
+
+init_sm = load_handler('idp-init-state-machine')
+
+def workflow(name: str, priority: str, queued: int, **fields) -> dict:
+    return dict(sort_key=name, priority=priority, queued=queued, **fields)
+
+def test_allocate_weights_turns(monkeypatch):
+    monkeypatch.setattr(SchedulerFunctions, 'WEIGHTS', dict(urgent=4, bulk=1))
+    workflows = [workflow('bulk', 'bulk', 10, submit_ts=1), workflow('urgent', 'urgent', 10, submit_ts=2)]
+    order = allocate(workflows, 10)
+    assert order == ['bulk'] + ['urgent'] * 4 + ['bulk'] + ['urgent'] * 4
+    assert order.count('urgent') == 8
+
+def test_allocate_stops_at_queued_and_skips_empty(monkeypatch):
+    monkeypatch.setattr(SchedulerFunctions, 'WEIGHTS', dict(standard=2))
+    workflows = [workflow('a', 'standard', 1), workflow('b', 'standard', 0), workflow('c', 'standard', 5)]
+    order = allocate(workflows, 100)
+    assert sorted(order) == ['a'] + ['c'] * 5
+    assert allocate([], 5) == []
+
+def test_allocate_continues_unfinished_turn(monkeypatch):
+    monkeypatch.setattr(SchedulerFunctions, 'WEIGHTS', dict(urgent=4, standard=2))
+    workflows = [workflow('urgent', 'urgent', 10), workflow('standard', 'standard', 10)]
+    assert allocate(workflows, 2) == ['urgent', 'urgent']
+    assert workflows[0]['deficit'] == 2
+    # The next call finishes the turn of urgent before standard gets one
+    assert allocate(workflows, 4) == ['urgent', 'urgent', 'standard', 'standard']
+
+def test_allocate_unknown_priority_gets_default_weight(monkeypatch):
+    monkeypatch.setattr(SchedulerFunctions, 'WEIGHTS', dict(standard=3))
+    monkeypatch.setattr(SchedulerFunctions, 'SCHEDULER_DEFAULT_PRIORITY', 'standard')
+    assert allocate([workflow('x', 'unknown', 10)], 3) == ['x'] * 3
+
+class Executions:
+    """Step Functions client of start_workflow, execution names are unique"""
+    exceptions = SimpleNamespace(ExecutionAlreadyExists=type('ExecutionAlreadyExists', (Exception,), {}))
+
+    def __init__(self):
+        self.names = []
+
+    def start_execution(self, stateMachineArn, name, input):
+        if name in self.names:
+            raise self.exceptions.ExecutionAlreadyExists(name)
+        self.names.append(name)
+        return dict(executionArn=name)
+
+def start(aws, documents: list):
+    manifest = [{'S': 'wf'}, {'S': 'input/wf/'}, {'S': 'submitted'}, {'M': {doc: {'S': 'ready'} for doc in documents}},
+                {'N': '1700000000000'}, {'N': str(len(documents))}, {'BOOL': True}, {'BOOL': False}, {'S': 'pending'}]
+    aws.s3.put_object(Bucket='bucket', Key='public/workflows/wf.json', Body=json.dumps(manifest))
+    init_sm.start_workflow(bucket='bucket', key='public/workflows/wf.json', idpTable='table', sfnArn='arn', log_level='INFO')
+
+def test_start_workflow_activates_queued_documents_once(aws, monkeypatch):
+    monkeypatch.setattr(init_sm, 'sfn', Executions())
+    monkeypatch.setattr(init_sm, 'MANIFEST_BATCH_SIZE', 2)
+    scheduler = Scheduler(table='table')
+    start(aws, ['a.png', 'b.png', 'c.png'])
+    assert scheduler.depth('wf')['queued'] == 3
+
+    # A start that failed after writing the workflow item activates it when it is retried
+    aws.dynamodb.delete_item(TableName='table', Key={'part_key': {'S': SchedulerFunctions.ACTIVE_KEY}, 'sort_key': {'S': 'wf'}})
+    start(aws, ['a.png', 'b.png', 'c.png'])
+    assert scheduler.depth('wf')['queued'] == 3
+
+    # A start delivered again after the queue drained does not activate the workflow again
+    assert len(scheduler.claim('wf', 10)) == 3
+    scheduler.drained('wf', {'N': '3'})
+    start(aws, ['a.png', 'b.png', 'c.png'])
+    assert scheduler.depth('wf') is None
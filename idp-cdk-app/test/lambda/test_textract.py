@@ -0,0 +1,53 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+from conftest import load_handler
+import TextractFunctions
+
+process_textract = load_handler('idp-process-textract-output')
+ENV = dict(IDP_INPUT_BKT='bucket', IDP_TABLE='table')
+
+def part(pages: int, ids: list) -> dict:
+    blocks = [dict(Id=f"{ids[0]}{page}", BlockType='PAGE', Page=page + 1, Relationships=[dict(Type='CHILD', Ids=ids[1:])]) for page in range(pages)]
+    blocks += [dict(Id=block_id, BlockType='LINE', Page=pages) for block_id in ids[1:]]
+    return dict(DocumentMetadata=dict(Pages=pages), Blocks=blocks)
+
+def test_merge_textract_parts_offsets_pages_and_ids():
+    merged = process_textract.merge_textract_parts([(1, part(2, ['p', 'l'])), (3, part(1, ['p', 'l'])), (4, dict(part(1, ['p']), Warnings=['w']))])
+    assert merged['DocumentMetadata']['Pages'] == 4
+    assert [block['Page'] for block in merged['Blocks'] if block['BlockType'] == 'PAGE'] == [1, 2, 3, 4]
+    ids = [block['Id'] for block in merged['Blocks']]
+    assert len(ids) == len(set(ids))
+    assert '001-p0' in ids and '002-p0' in ids
+    second_page = [block for block in merged['Blocks'] if block['Id'] == '001-p0'][0]
+    assert second_page['Relationships'][0]['Ids'] == ['001-l']
+    assert merged['Warnings'] == ['w']
+
+def test_merge_textract_parts_single_part_unchanged():
+    single = part(3, ['p', 'l'])
+    assert process_textract.merge_textract_parts([(1, single)]) is single
+    assert process_textract.merge_textract_parts([]) is None
+
+def stage_parts(aws, count: int) -> list:
+    prefix = 'public/parts/wf/doc.pdf'
+    keys = [f"{prefix}/part-{idx:03d}.pdf" for idx in range(count)]
+    manifest = dict(document='doc.pdf', parts=[dict(key=key, first_page=idx * 10 + 1) for idx, key in enumerate(keys)])
+    aws.s3.put_object(Bucket='bucket', Key=f"{prefix}/parts.json", Body=json.dumps(manifest))
+    return keys
+
+def test_complete_part_returns_parts_once_all_done(aws):
+    keys = stage_parts(aws, 3)
+    assert TextractFunctions.complete_part(keys[0], 'job-0', 'succeeded', ENV) is None
+    assert TextractFunctions.complete_part(keys[1], 'job-1', 'failed', ENV) is None
+    parts = TextractFunctions.complete_part(keys[2], 'job-2', 'succeeded', ENV)
+    assert [(part['key'], part['job_id'], part['status']) for part in parts] == [
+        (keys[0], 'job-0', 'succeeded'), (keys[1], 'job-1', 'failed'), (keys[2], 'job-2', 'succeeded')]
+
+def test_complete_part_completes_a_document_once(aws):
+    keys = stage_parts(aws, 2)
+    TextractFunctions.complete_part(keys[0], 'job-0', 'succeeded', ENV)
+    assert TextractFunctions.complete_part(keys[1], 'job-1', 'succeeded', ENV) is not None
+    # A redelivered notification of the last part
+    assert TextractFunctions.complete_part(keys[1], 'job-1', 'succeeded', ENV) is None
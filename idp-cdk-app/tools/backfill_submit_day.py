@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+One-off backfill of submit_day on the workflow items written before the workflow listing moved to the
+submit_day-submit_ts-index. The listing only reads that index, so workflows without submit_day are not listed
+until this has run once against the table of the stack, e.g.
+
+    python tools/backfill_submit_day.py --table <IDP_TABLE> --dry-run
+    python tools/backfill_submit_day.py --table <IDP_TABLE>
+
+Workflow items (sort_key input/<workflow_id>/) with a submit_ts and no submit_day get the UTC day of their
+submit_ts, the same value idp-init-state-machine.py writes. Running it again only updates the items still missing
+it, an item written by a workflow started meanwhile is left alone.
+"""
+
+import argparse
+import datetime
+import boto3
+from botocore.exceptions import ClientError
+
+def submit_day(submit_ts: str) -> str:
+    return datetime.datetime.utcfromtimestamp(int(submit_ts)/1000).strftime('%Y-%m-%d')
+
+def backfill(table: str, dry_run: bool = False) -> tuple:
+    """Sets submit_day on the workflow items missing it, returns the (updated, skipped) counts
+    """
+    ddb = boto3.client('dynamodb')
+    paginator = ddb.get_paginator('scan')
+    updated, skipped = 0, 0
+    pages = paginator.paginate(TableName=table,
+                               FilterExpression="begins_with(sort_key, :input) AND attribute_exists(submit_ts) AND attribute_not_exists(submit_day)",
+                               ExpressionAttributeValues={':input': {'S': 'input/'}},
+                               ProjectionExpression="part_key, sort_key, submit_ts")
+    for page in pages:
+        for item in page['Items']:
+            # Only the workflow item itself, input/<workflow_id>/
+            if item['sort_key']['S'] != f"input/{item['part_key']['S']}/":
+                continue
+            day = submit_day(item['submit_ts'].get('N') or item['submit_ts'].get('S'))
+            if dry_run:
+                print(f"{item['part_key']['S']}: submit_day {day}")
+                updated += 1
+                continue
+            try:
+                ddb.update_item(TableName=table, Key={'part_key': item['part_key'], 'sort_key': item['sort_key']},
+                                UpdateExpression="SET submit_day = :day", ConditionExpression="attribute_not_exists(submit_day)",
+                                ExpressionAttributeValues={':day': {'S': day}})
+                updated += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                skipped += 1
+    return updated, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill submit_day on the workflow items of the IDP table')
+    parser.add_argument('--table', required=True, help='IDP DynamoDB table (IDP_TABLE)')
+    parser.add_argument('--dry-run', action='store_true', help='print the items that would be updated')
+    args = parser.parse_args()
+    updated, skipped = backfill(args.table, dry_run=args.dry_run)
+    print(f"{'Would update' if args.dry_run else 'Updated'} {updated} workflow items, {skipped} already had submit_day")
+
+if __name__ == '__main__':
+    main()
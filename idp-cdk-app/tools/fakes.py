@@ -0,0 +1,608 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+In-memory stand-ins for the AWS services called by the Lambda handlers in src/lambda, used by
+pipeline_harness.py to run the whole pipeline in one process. Only the operations and request shapes the
+handlers actually use are implemented. Every call is counted per service and operation, can be given a
+latency (seconds) and a rate quota (calls per second) which raises the throttling error of the service.
+The asynchronous Textract and Comprehend Medical jobs complete after a configurable job latency and are
+limited to a number of concurrent jobs, like the service quotas.
+"""
+
+import collections
+import io
+import json
+import re
+import shutil
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+
+def client_error(code: str, message: str, operation: str, error_class=ClientError) -> ClientError:
+    return error_class({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}}, operation)
+
+class CallStats:
+    """Thread safe counters of the API calls and throttled calls per service and operation
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+
+    def count(self, service: str, operation: str, throttled: bool = False):
+        with self.lock:
+            self.calls[f"{service}.{operation}"] += 1
+            if throttled:
+                self.throttles[f"{service}.{operation}"] += 1
+
+    def total(self, service: str = None) -> int:
+        return sum([count for name, count in self.calls.items() if not service or name.startswith(f"{service}.")])
+
+class RateLimiter:
+    """Token bucket of rate calls per second with a burst of rate calls
+    """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class FakeService:
+    """Base class of the fakes. latency maps an operation (e.g. GetObject) or '*' to seconds, tps maps an
+    operation to the calls per second allowed before the throttle_code error is raised
+    """
+    service = None
+    throttle_code = 'ThrottlingException'
+
+    def __init__(self, stats: CallStats, latency: dict = None, tps: dict = None):
+        self.stats = stats
+        self.latency = latency if latency else {}
+        self.limiters = {operation: RateLimiter(rate) for operation, rate in (tps if tps else {}).items()}
+        self.lock = threading.RLock()
+
+    def _call(self, operation: str):
+        limiter = self.limiters.get(operation)
+        if limiter and not limiter.acquire():
+            self.stats.count(self.service, operation, throttled=True)
+            raise client_error(self.throttle_code, 'Rate exceeded', operation)
+        self.stats.count(self.service, operation)
+        delay = self.latency.get(operation, self.latency.get('*', 0))
+        if delay:
+            time.sleep(delay)
+
+class Paginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('NextContinuationToken'):
+                break
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+class FakeS3(FakeService):
+    """Objects of every bucket in one dict keyed by (bucket, key). put_object listeners are called with the
+    bucket and key of every new object, like S3 event notifications
+    """
+    service = 's3'
+    throttle_code = 'SlowDown'
+
+    def __init__(self, stats: CallStats, latency: dict = None, tps: dict = None):
+        super().__init__(stats, latency, tps)
+        self.objects = {}
+        self.listeners = []
+        self.exceptions = type('Exceptions', (), {'NoSuchKey': type('NoSuchKey', (ClientError,), {})})
+
+    def _put(self, bucket: str, key: str, body: bytes, metadata: dict = None, content_type: str = None, content_encoding: str = None):
+        with self.lock:
+            self.objects[(bucket, key)] = dict(Body=body, Metadata=metadata if metadata else {},
+                                               ContentType=content_type if content_type else 'binary/octet-stream',
+                                               ContentEncoding=content_encoding, LastModified=time.time())
+        for listener in self.listeners:
+            listener(bucket, key)
+
+    def _get(self, bucket: str, key: str, operation: str) -> dict:
+        with self.lock:
+            if (bucket, key) not in self.objects:
+                raise client_error('NoSuchKey', f"The specified key does not exist: {key}", operation, self.exceptions.NoSuchKey)
+            return self.objects[(bucket, key)]
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, ContentType=None, ContentEncoding=None, **kwargs):
+        self._call('PutObject')
+        body = Body.encode('utf-8') if isinstance(Body, str) else Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self._put(Bucket, Key, body, Metadata, ContentType, ContentEncoding)
+        return {'ETag': f'"{uuid.uuid4().hex}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call('GetObject')
+        obj = self._get(Bucket, Key, 'GetObject')
+        response = {'Body': io.BytesIO(obj['Body']), 'ContentLength': len(obj['Body']), 'Metadata': dict(obj['Metadata']), 'ContentType': obj['ContentType']}
+        if obj.get('ContentEncoding'):
+            response['ContentEncoding'] = obj['ContentEncoding']
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject')
+        obj = self._get(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(obj['Body']), 'Metadata': dict(obj['Metadata']), 'ContentType': obj['ContentType']}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call('CopyObject')
+        obj = self._get(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        self._put(Bucket, Key, obj['Body'], obj['Metadata'], obj['ContentType'], obj.get('ContentEncoding'))
+        return {}
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        # The managed transfer reads the size of the source before copying it
+        self.head_object(Bucket=CopySource['Bucket'], Key=CopySource['Key'])
+        return self.copy_object(Bucket=Bucket, Key=Key, CopySource=CopySource)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call('DeleteObjects')
+        if len(Delete['Objects']) > 1000:
+            raise client_error('MalformedXML', 'At most 1000 keys per request', 'DeleteObjects')
+        with self.lock:
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted': [dict(Key=obj['Key']) for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, MaxKeys=1000, **kwargs):
+        self._call('ListObjectsV2')
+        with self.lock:
+            keys = sorted([key for bucket, key in self.objects.keys() if bucket == Bucket and key.startswith(Prefix)])
+            sizes = {key: len(self.objects[(Bucket, key)]['Body']) for key in keys}
+        contents, prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common = key[:len(Prefix) + key[len(Prefix):].index(Delimiter) + 1]
+                if common not in prefixes:
+                    prefixes.append(common)
+            else:
+                contents.append(key)
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = contents[start:start+MaxKeys]
+        response = {'KeyCount': len(page), 'Contents': [{'Key': key, 'Size': sizes[key]} for key in page]}
+        if Delimiter:
+            response['CommonPrefixes'] = [{'Prefix': prefix} for prefix in prefixes]
+        if start + MaxKeys < len(contents):
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        if not page:
+            del response['Contents']
+        return response
+
+    def get_paginator(self, name):
+        return Paginator(getattr(self, name))
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        extra = ExtraArgs if ExtraArgs else {}
+        with open(Filename, 'rb') as local_file:
+            return self.put_object(Bucket=Bucket, Key=Key, Body=local_file.read(), Metadata=extra.get('Metadata'), ContentType=extra.get('ContentType'))
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        # The managed transfer reads the size of the object before downloading it
+        self.head_object(Bucket=Bucket, Key=Key)
+        with open(Filename, 'wb') as local_file:
+            shutil.copyfileobj(self.get_object(Bucket=Bucket, Key=Key)['Body'], local_file)
+
+class FakeDynamoDB(FakeService):
+    """Items of every table keyed by (table, part_key, sort_key), kept as DynamoDB attribute values. Only the
+    PartiQL statements the handlers use are understood: INSERT ... VALUE {...}, UPDATE ... SET/REMOVE ... WHERE
+    part_key=? AND sort_key=? [RETURNING ALL NEW *] and SELECT on the table key or the listing index, next to
+    UpdateItem and DeleteItem with simple condition expressions
+    """
+    service = 'dynamodb'
+    throttle_code = 'ThrottlingException'
+    PAGE_SIZE = 100
+
+    def __init__(self, stats: CallStats, latency: dict = None, tps: dict = None, indexes: dict = None):
+        super().__init__(stats, latency, tps)
+        self.items = {}
+        # index name: (partition attribute, sort attribute)
+        self.indexes = indexes if indexes else {'submit_day-submit_ts-index': ('submit_day', 'submit_ts')}
+        self.exceptions = type('Exceptions', (), {
+            'DuplicateItemException': type('DuplicateItemException', (ClientError,), {}),
+            'ConditionalCheckFailedException': type('ConditionalCheckFailedException', (ClientError,), {}),
+        })
+
+    @staticmethod
+    def _scalar(value: dict):
+        kind, raw = list(value.items())[0]
+        return float(raw) if kind == 'N' else raw
+
+    def _statement(self, statement: str, parameters: list, limit: int = None, next_token: str = None) -> dict:
+        params = list(parameters if parameters else [])
+        verb = statement.split()[0].upper()
+        table = re.search(r'(?:INTO|UPDATE|FROM)\s+"([^"]+)"', statement, re.IGNORECASE).group(1)
+
+        if verb == 'INSERT':
+            names = re.findall(r"'(\w+)'\s*:\s*\?", statement)
+            item = dict(zip(names, params))
+            key = (table, item['part_key']['S'], item['sort_key']['S'])
+            with self.lock:
+                if key in self.items:
+                    raise client_error('DuplicateItem', 'Duplicate primary key exists in table', 'ExecuteStatement', self.exceptions.DuplicateItemException)
+                self.items[key] = item
+            return {'Items': []}
+
+        if verb == 'UPDATE':
+            clauses = statement[statement.index(f'"{table}"') + len(table) + 2:statement.upper().index(' WHERE ')]
+            sets = re.findall(r'SET\s+(\w+)\s*=\s*\?', clauses)
+            removes = re.findall(r'REMOVE\s+(\w+)', clauses)
+            key = (table, params[len(sets)]['S'], params[len(sets) + 1]['S'])
+            with self.lock:
+                if key not in self.items:
+                    raise client_error('ConditionalCheckFailed', 'The conditional request failed', 'ExecuteStatement', self.exceptions.ConditionalCheckFailedException)
+                item = self.items[key]
+                item.update(dict(zip(sets, params[:len(sets)])))
+                for name in removes:
+                    item.pop(name, None)
+                return {'Items': [dict(item)] if 'RETURNING ALL NEW' in statement.upper() else []}
+
+        if verb == 'SELECT':
+            projection = statement[len('SELECT'):statement.upper().index(' FROM ')].strip()
+            names = None if projection == '*' else [name.strip().strip('"') for name in projection.split(',')]
+            index = re.search(r'FROM\s+"[^"]+"\."([^"]+)"', statement, re.IGNORECASE)
+            with self.lock:
+                items = [(key, dict(item)) for key, item in self.items.items() if key[0] == table]
+            if index:
+                part_name, sort_name = self.indexes[index.group(1)]
+                low, high = self._scalar(params[1]), self._scalar(params[2])
+                matched = sorted([item for key, item in items if part_name in item and item[part_name] == params[0]
+                                  and sort_name in item and low <= self._scalar(item[sort_name]) <= high],
+                                 key=lambda item: self._scalar(item[sort_name]))
+            else:
+                where = statement[statement.upper().index(' WHERE '):]
+                matched = [item for key, item in items if key[1] == params[0]['S']]
+                if 'begins_with' in where:
+                    matched = [item for item in matched if item['sort_key']['S'].startswith(params[1]['S'])]
+                elif 'sort_key' in where:
+                    matched = [item for item in matched if item['sort_key']['S'] == params[1]['S']]
+                matched = sorted(matched, key=lambda item: item['sort_key']['S'])
+            start = int(next_token) if next_token else 0
+            size = min(limit, self.PAGE_SIZE) if limit else self.PAGE_SIZE
+            page = matched[start:start+size]
+            if names:
+                page = [{name: item[name] for name in names if name in item} for item in page]
+            response = {'Items': page}
+            if start + size < len(matched):
+                response['NextToken'] = str(start + size)
+            return response
+
+        raise client_error('ValidationException', f"Statement not supported by the fake: {statement}", 'ExecuteStatement')
+
+    def execute_statement(self, Statement, Parameters=None, Limit=None, NextToken=None, **kwargs):
+        self._call('ExecuteStatement')
+        return self._statement(Statement, Parameters, Limit, NextToken)
+
+    def batch_execute_statement(self, Statements, **kwargs):
+        self._call('BatchExecuteStatement')
+        if len(Statements) > 25:
+            raise client_error('ValidationException', 'At most 25 statements per batch', 'BatchExecuteStatement')
+        responses = []
+        for statement in Statements:
+            try:
+                self._statement(statement['Statement'], statement.get('Parameters'))
+                responses.append({})
+            except ClientError as e:
+                responses.append({'Error': {'Code': e.response['Error']['Code'], 'Message': e.response['Error']['Message']}})
+        return {'Responses': responses}
+
+    def _condition(self, item: dict, condition: str, names: dict, values: dict):
+        """attribute_exists(<name>), attribute_not_exists(<name>) and <name> =|<=|>= :value conditions joined by AND
+        """
+        for clause in re.split(r'\s+AND\s+', condition, flags=re.IGNORECASE) if condition else []:
+            exists = re.match(r'attribute_exists\(\s*([#\w]+)\s*\)', clause.strip())
+            missing = re.match(r'attribute_not_exists\(\s*([#\w]+)\s*\)', clause.strip())
+            compare = re.match(r'([#\w]+)\s*(=|<=|>=)\s*(:\w+)', clause.strip())
+            if exists:
+                passed = item is not None and names.get(exists.group(1), exists.group(1)) in item
+            elif missing:
+                passed = item is None or names.get(missing.group(1), missing.group(1)) not in item
+            else:
+                value = item.get(names.get(compare.group(1), compare.group(1))) if item else None
+                expected = self._scalar(values[compare.group(3)])
+                comparisons = {'=': lambda actual: actual == expected, '<=': lambda actual: actual <= expected, '>=': lambda actual: actual >= expected}
+                passed = value is not None and comparisons[compare.group(2)](self._scalar(value))
+            if not passed:
+                raise client_error('ConditionalCheckFailed', 'The conditional request failed', 'UpdateItem', self.exceptions.ConditionalCheckFailedException)
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues=None, **kwargs):
+        """SET (with if_not_exists) and ADD of numbers, as used by the DynamoDB task of the state machine, the step
+        timings and the scheduler
+        """
+        self._call('UpdateItem')
+        names = ExpressionAttributeNames if ExpressionAttributeNames else {}
+        add = re.search(r'(?:^|\s)ADD\s(.*)$', UpdateExpression)
+        set_clause, add_clause = (UpdateExpression[:add.start()], add.group(1)) if add else (UpdateExpression, '')
+        sets = re.findall(r'([#\w]+)\s*=\s*(:\w+)', set_clause)
+        defaults = re.findall(r'([#\w]+)\s*=\s*if_not_exists\(\s*[#\w]+\s*,\s*(:\w+)\s*\)', set_clause)
+        adds = re.findall(r'([#\w]+)\s+(:\w+)', add_clause)
+        key = (TableName, Key['part_key']['S'], Key['sort_key']['S'])
+        with self.lock:
+            self._condition(self.items.get(key), ConditionExpression, names, ExpressionAttributeValues)
+            item = self.items.setdefault(key, dict(Key))
+            updated = {names.get(name, name): ExpressionAttributeValues[value] for name, value in sets}
+            updated.update({names.get(name, name): ExpressionAttributeValues[value] for name, value in defaults if names.get(name, name) not in item})
+            for name, value in adds:
+                name = names.get(name, name)
+                total = self._scalar(item.get(name, {'N': '0'})) + self._scalar(ExpressionAttributeValues[value])
+                updated[name] = {'N': str(int(total) if total == int(total) else total)}
+            item.update(updated)
+            return {'Attributes': dict(updated)} if ReturnValues == 'UPDATED_NEW' else {}
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues=None, **kwargs):
+        self._call('DeleteItem')
+        key = (TableName, Key['part_key']['S'], Key['sort_key']['S'])
+        with self.lock:
+            self._condition(self.items.get(key), ConditionExpression, ExpressionAttributeNames if ExpressionAttributeNames else {},
+                            ExpressionAttributeValues if ExpressionAttributeValues else {})
+            item = self.items.pop(key, None)
+        return {'Attributes': item} if item and ReturnValues == 'ALL_OLD' else {}
+
+class AsyncJobs:
+    """Runs job completions on timers and enforces a concurrent job quota
+    """
+    def __init__(self, max_jobs: int):
+        self.max_jobs = max_jobs
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.timers = []
+
+    def start(self, delay: float, complete) -> bool:
+        with self.lock:
+            if self.max_jobs and self.active >= self.max_jobs:
+                return False
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+        def run():
+            try:
+                complete()
+            finally:
+                with self.lock:
+                    self.active -= 1
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        self.timers.append(timer)
+        timer.start()
+        return True
+
+class FakeTextract(FakeService):
+    """Asynchronous document analysis. A job takes job_seconds plus page_seconds per page, then writes its
+    output under <S3Prefix>/<JobId>/1 and calls notify(message) with the SNS message of the job completion.
+    Blocks are generated from the layout of the document returned by layout(bucket, key) as a list of pages,
+    each a list of lines of {text, left, top, width, height} in page ratios
+    """
+    service = 'textract'
+    throttle_code = 'ProvisionedThroughputExceededException'
+
+    def __init__(self, stats: CallStats, s3: FakeS3, layout, notify, latency: dict = None, tps: dict = None,
+                 job_seconds: float = 2.0, page_seconds: float = 0.1, max_jobs: int = 100):
+        super().__init__(stats, latency, tps)
+        self.s3 = s3
+        self.layout = layout
+        self.notify = notify
+        self.job_seconds = job_seconds
+        self.page_seconds = page_seconds
+        self.jobs = AsyncJobs(max_jobs)
+        self.job_times = []
+
+    @staticmethod
+    def geometry(left: float, top: float, width: float, height: float) -> dict:
+        return {'BoundingBox': {'Width': width, 'Height': height, 'Left': left, 'Top': top},
+                'Polygon': [{'X': left, 'Y': top}, {'X': left + width, 'Y': top}, {'X': left + width, 'Y': top + height}, {'X': left, 'Y': top + height}]}
+
+    def blocks(self, pages: list) -> list:
+        blocks = []
+        for page_number, lines in enumerate(pages, start=1):
+            page = {'BlockType': 'PAGE', 'Id': uuid.uuid4().hex, 'Page': page_number, 'Geometry': self.geometry(0, 0, 1, 1), 'Relationships': [{'Type': 'CHILD', 'Ids': []}]}
+            blocks.append(page)
+            for line in lines:
+                words = line['text'].split()
+                line_block = {'BlockType': 'LINE', 'Id': uuid.uuid4().hex, 'Page': page_number, 'Confidence': 99.0, 'Text': line['text'],
+                              'Geometry': self.geometry(line['left'], line['top'], line['width'], line['height']), 'Relationships': [{'Type': 'CHILD', 'Ids': []}]}
+                page['Relationships'][0]['Ids'].append(line_block['Id'])
+                blocks.append(line_block)
+                offset = 0
+                for word in words:
+                    width = line['width'] * len(word) / max(len(line['text']), 1)
+                    left = line['left'] + line['width'] * offset / max(len(line['text']), 1)
+                    word_block = {'BlockType': 'WORD', 'Id': uuid.uuid4().hex, 'Page': page_number, 'Confidence': 99.0, 'Text': word, 'TextType': 'PRINTED',
+                                  'Geometry': self.geometry(left, line['top'], width, line['height'])}
+                    line_block['Relationships'][0]['Ids'].append(word_block['Id'])
+                    blocks.append(word_block)
+                    offset += len(word) + 1
+        return blocks
+
+    def _start(self, api: str, DocumentLocation, JobTag=None, OutputConfig=None) -> dict:
+        self._call(api)
+        location = DocumentLocation['S3Object']
+        pages = self.layout(location['Bucket'], location['Name'])
+        job_id = uuid.uuid4().hex
+        submitted = time.monotonic()
+        model_version = 'AnalyzeDocumentModelVersion' if api == 'StartDocumentAnalysis' else 'DetectDocumentTextModelVersion'
+
+        def complete():
+            self.s3._put(OutputConfig['S3Bucket'], f"{OutputConfig['S3Prefix'].strip('/')}/{job_id}/1",
+                         json.dumps({'DocumentMetadata': {'Pages': len(pages)}, 'JobStatus': 'SUCCEEDED', 'Blocks': self.blocks(pages),
+                                     model_version: '1.0'}).encode('utf-8'))
+            self.job_times.append(time.monotonic() - submitted)
+            self.notify({'JobId': job_id, 'Status': 'SUCCEEDED', 'API': api, 'JobTag': JobTag, 'Timestamp': int(time.time() * 1000),
+                         'DocumentLocation': {'S3ObjectName': location['Name'], 'S3Bucket': location['Bucket']}})
+
+        if not self.jobs.start(self.job_seconds + self.page_seconds * len(pages), complete):
+            self.stats.count(self.service, api, throttled=True)
+            raise client_error('LimitExceededException', 'Open jobs exceed maximum concurrent job limit', api)
+        return {'JobId': job_id}
+
+    def start_document_analysis(self, DocumentLocation, FeatureTypes, JobTag=None, NotificationChannel=None, OutputConfig=None, **kwargs):
+        return self._start('StartDocumentAnalysis', DocumentLocation, JobTag, OutputConfig)
+
+    def start_document_text_detection(self, DocumentLocation, JobTag=None, NotificationChannel=None, OutputConfig=None, **kwargs):
+        return self._start('StartDocumentTextDetection', DocumentLocation, JobTag, OutputConfig)
+
+class FakeComprehendMedical(FakeService):
+    """Asynchronous PHI detection. A job takes job_seconds plus char_seconds per 1000 characters of input, then
+    writes <OutputS3Key>/<account>-PHI-<JobId>/<input file relative to the input prefix>.out with the
+    entities found by detect(text) and a Manifest, the same layout as the service. A start with the
+    ClientRequestToken of an earlier start returns the job of that start
+    """
+    service = 'comprehendmedical'
+    throttle_code = 'TooManyRequestsException'
+    ACCOUNT = '123456789012'
+
+    def __init__(self, stats: CallStats, s3: FakeS3, detect, latency: dict = None, tps: dict = None,
+                 job_seconds: float = 5.0, char_seconds: float = 0.01, max_jobs: int = 10):
+        super().__init__(stats, latency, tps)
+        self.s3 = s3
+        self.detect = detect
+        self.job_seconds = job_seconds
+        self.char_seconds = char_seconds
+        self.jobs = AsyncJobs(max_jobs)
+        self.statuses = {}
+        self.tokens = {}
+
+    def detect_phi(self, Text, **kwargs):
+        self._call('DetectPHI')
+        if len(Text.encode('utf-8')) > 20000:
+            raise client_error('TextSizeLimitExceededException', 'Text exceeds 20000 bytes', 'DetectPHI')
+        return {'Entities': self.detect(Text), 'ModelVersion': '0.0.0'}
+
+    def start_phi_detection_job(self, InputDataConfig, OutputDataConfig, DataAccessRoleArn=None, JobName=None, LanguageCode='en',
+                                ClientRequestToken=None, **kwargs):
+        self._call('StartPHIDetectionJob')
+        if ClientRequestToken in self.tokens:
+            return {'JobId': self.tokens[ClientRequestToken]}
+        bucket, prefix = InputDataConfig['S3Bucket'], InputDataConfig['S3Key']
+        with self.s3.lock:
+            inputs = {key: obj['Body'] for (obj_bucket, key), obj in self.s3.objects.items() if obj_bucket == bucket and key.startswith(prefix)}
+        job_id = uuid.uuid4().hex
+        characters = sum([len(body) for body in inputs.values()])
+        output_prefix = f"{OutputDataConfig['S3Key'].rstrip('/')}/{self.ACCOUNT}-PHI-{job_id}"
+
+        def complete():
+            for key, body in inputs.items():
+                relative = key[len(prefix):].lstrip('/')
+                entities = self.detect(body.decode('utf-8'))
+                self.s3._put(OutputDataConfig['S3Bucket'], f"{output_prefix}/{relative}.out",
+                             json.dumps({'Entities': entities, 'File': relative, 'ModelVersion': '0.0.0'}).encode('utf-8'))
+            manifest = {'Summary': {'Status': 'COMPLETED', 'JobType': 'PHIDetection', 'InputDataConfiguration': InputDataConfig,
+                                    'OutputDataConfiguration': OutputDataConfig, 'TotalFilesCount': len(inputs), 'SuccessfulFilesCount': len(inputs),
+                                    'FailedFilesCount': 0, 'TotalInputCharacters': characters},
+                        'SuccessfulFilesList': [{'Input': key, 'Output': f"{output_prefix}/{key[len(prefix):].lstrip('/')}.out"} for key in inputs]}
+            self.s3._put(OutputDataConfig['S3Bucket'], f"{output_prefix}/Manifest", json.dumps(manifest).encode('utf-8'))
+            if self.statuses.get(job_id) != 'STOPPED':
+                self.statuses[job_id] = 'COMPLETED'
+
+        self.statuses[job_id] = 'SUBMITTED'
+        if not self.jobs.start(self.job_seconds + self.char_seconds * characters / 1000, complete):
+            del self.statuses[job_id]
+            self.stats.count(self.service, 'StartPHIDetectionJob', throttled=True)
+            raise client_error('TooManyRequestsException', 'Concurrent job limit exceeded', 'StartPHIDetectionJob')
+        if ClientRequestToken:
+            self.tokens[ClientRequestToken] = job_id
+        return {'JobId': job_id}
+
+    def describe_phi_detection_job(self, JobId, **kwargs):
+        self._call('DescribePHIDetectionJob')
+        status = self.statuses.get(JobId)
+        if status is None:
+            raise client_error('ResourceNotFoundException', f"Job {JobId} not found", 'DescribePHIDetectionJob')
+        return {'ComprehendMedicalAsyncJobProperties': {'JobId': JobId, 'JobStatus': 'IN_PROGRESS' if status == 'SUBMITTED' else status}}
+
+    def stop_phi_detection_job(self, JobId, **kwargs):
+        self._call('StopPHIDetectionJob')
+        if JobId not in self.statuses:
+            raise client_error('ResourceNotFoundException', f"Job {JobId} not found", 'StopPHIDetectionJob')
+        if self.statuses[JobId] == 'SUBMITTED':
+            self.statuses[JobId] = 'STOPPED'
+        return {'JobId': JobId}
+
+class FakeLambda(FakeService):
+    """Asynchronous (Event) invocations are handed to invoke_async(function_name, payload)
+    """
+    service = 'lambda'
+    throttle_code = 'TooManyRequestsException'
+
+    def __init__(self, stats: CallStats, invoke_async, latency: dict = None, tps: dict = None):
+        super().__init__(stats, latency, tps)
+        self.invoke_async = invoke_async
+
+    def invoke(self, FunctionName, Payload=b'{}', InvocationType='RequestResponse', **kwargs):
+        self._call('Invoke')
+        if InvocationType != 'Event':
+            raise client_error('InvalidParameterValueException', 'Only Event invocations are supported by the fake', 'Invoke')
+        self.invoke_async(FunctionName, json.loads(Payload))
+        return {'StatusCode': 202}
+
+class FakeStepFunctions(FakeService):
+    """Executions are handed to start(name, input). Task tokens are registered by the execution with
+    wait_for_token and resolved by send_task_success
+    """
+    service = 'stepfunctions'
+    throttle_code = 'ThrottlingException'
+
+    def __init__(self, stats: CallStats, start, latency: dict = None, tps: dict = None):
+        super().__init__(stats, latency, tps)
+        self.start = start
+        self.tokens = {}
+        self.executions = set()
+        self.exceptions = type('Exceptions', (), {name: type(name, (ClientError,), {}) for name in
+                                                  ['TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken', 'ExecutionAlreadyExists']})
+
+    def start_execution(self, stateMachineArn, name, input, **kwargs):
+        self._call('StartExecution')
+        with self.lock:
+            if name in self.executions:
+                raise client_error('ExecutionAlreadyExists', f"Execution already exists: {name}", 'StartExecution', self.exceptions.ExecutionAlreadyExists)
+            self.executions.add(name)
+        self.start(name, json.loads(input))
+        return {'executionArn': f"{stateMachineArn}:{name}", 'startDate': time.time()}
+
+    def new_token(self) -> str:
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = dict(event=threading.Event(), output=None)
+        return token
+
+    def wait_for_token(self, token: str, timeout: float) -> dict:
+        """Returns the output sent with the task success, None on timeout
+        """
+        if not self.tokens[token]['event'].wait(timeout):
+            return None
+        return self.tokens[token]['output']
+
+    def send_task_success(self, taskToken, output, **kwargs):
+        self._call('SendTaskSuccess')
+        with self.lock:
+            task = self.tokens.get(taskToken)
+            if task is None:
+                raise client_error('InvalidToken', 'Invalid token', 'SendTaskSuccess', self.exceptions.InvalidToken)
+            if task['event'].is_set():
+                raise client_error('TaskTimedOut', 'Task already completed', 'SendTaskSuccess', self.exceptions.TaskTimedOut)
+            task['output'] = json.loads(output)
+            task['event'].set()
+        return {}
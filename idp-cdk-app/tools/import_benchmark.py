@@ -0,0 +1,97 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Measures the import (cold start initialization) time of each Lambda handler module in src/lambda. Every sample
+imports the handler in a fresh Python interpreter so nothing is cached between samples. Run it inside a
+function image to measure that image, e.g.
+
+    python tools/import_benchmark.py --runs 10
+    python tools/import_benchmark.py --handler idp-get-workflows --importtime 15
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda')
+
+IMPORT_SNIPPET = """
+import importlib.util, sys, time
+sys.path.insert(0, {lambda_dir!r})
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+"""
+
+def import_time(path: str, importtime: bool = False) -> tuple:
+    """Imports a handler in a new interpreter, returns (seconds, None) or (None, error) and the -X importtime report
+    """
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', IMPORT_SNIPPET.format(lambda_dir=LAMBDA_DIR, path=path)]
+    result = subprocess.run(cmd, capture_output=True, text=True, env=env)
+    if result.returncode:
+        return None, result.stderr.strip().splitlines()[-1], result.stderr
+    return float(result.stdout.strip().splitlines()[-1]), None, result.stderr
+
+def top_imports(report: str, count: int) -> list:
+    """Returns the count slowest modules (cumulative microseconds) of a -X importtime report
+    """
+    modules = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        modules.append((int(cumulative_us), name.strip()))
+    return sorted(modules, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold import time of the IDP Lambda handlers')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreter samples per handler')
+    parser.add_argument('--handler', action='append', help='handler module name, e.g. idp-get-workflows (default: all)')
+    parser.add_argument('--importtime', type=int, default=0, help='show the N slowest imported modules of each handler')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(LAMBDA_DIR, 'idp-*.py')))
+    if args.handler:
+        paths = [path for path in paths if os.path.basename(path)[:-len('.py')] in args.handler]
+
+    results = {}
+    for path in paths:
+        name = os.path.basename(path)[:-len('.py')]
+        samples, error, report = [], None, ''
+        for _ in range(args.runs):
+            seconds, error, report = import_time(path, importtime=bool(args.importtime))
+            if error:
+                break
+            samples.append(seconds * 1000)
+        if error:
+            results[name] = dict(error=error)
+        else:
+            results[name] = dict(min_ms=round(min(samples), 1), median_ms=round(statistics.median(samples), 1), max_ms=round(max(samples), 1))
+            if args.importtime:
+                results[name]['slowest'] = [dict(module=module, cumulative_ms=round(us/1000, 1)) for us, module in top_imports(report, args.importtime)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'handler':<32}{'min ms':>10}{'median ms':>12}{'max ms':>10}")
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:<32}  {result['error']}")
+            continue
+        print(f"{name:<32}{result['min_ms']:>10}{result['median_ms']:>12}{result['max_ms']:>10}")
+        for module in result.get('slowest', []):
+            print(f"{'':<4}{module['module']:<40}{module['cumulative_ms']:>10}")
+
+if __name__ == '__main__':
+    main()
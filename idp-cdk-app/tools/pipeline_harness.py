@@ -0,0 +1,453 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Runs the whole de-identification pipeline in one process, without deploying the stacks. The Lambda handlers
+in src/lambda are imported as they are and their AWS clients are replaced with the in-memory fakes of
+fakes.py (S3, DynamoDB, Textract, Comprehend Medical, Lambda and Step Functions). The state machine of
+idp-cdk-stepfunctions-stack.js is replayed by a driver thread per execution, S3 event notifications, SNS job
+notifications and asynchronous Lambda invocations run on a worker pool.
+
+The harness generates synthetic workflows of PNG documents with fake PHI, submits them the way the web app
+does (documents under public/input/, workflow JSON under public/workflows/), waits for every execution to
+finish and reports documents per minute, per-stage latency percentiles and API calls per document, e.g.
+
+    python tools/pipeline_harness.py --workflows 20 --documents 10
+    python tools/pipeline_harness.py --workflows 50 --textract-max-jobs 20 --tps textract.StartDocumentAnalysis=2
+    python tools/pipeline_harness.py --latency s3=0.02 --latency dynamodb.ExecuteStatement=0.01 --json
+    python tools/pipeline_harness.py --workflows 1 --documents 300 --priority bulk --urgent-workflows 3 --textract-max-jobs 10
+
+The last one submits a backfill and then small urgent workflows, whose latency is reported per priority class.
+
+Handlers share the process' /tmp, so idp-process-textract-output (fixed report path) runs one invocation at
+a time; other functions run up to --concurrency invocations at a time.
+"""
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import fakes
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda')
+BUCKET = 'idp-harness-bucket'
+LAYOUT_KEY = 'idp-layout'
+
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'IDP_TABLE': 'idp-harness-table',
+    'IDP_BKT': BUCKET,
+    'IDP_INPUT_BKT': BUCKET,
+    'SNS_TOPIC': 'arn:aws:sns:us-east-1:123456789012:idp-harness-topic',
+    'SNS_ROLE': 'arn:aws:iam::123456789012:role/idp-harness-sns-role',
+    'IAM_ROLE': 'arn:aws:iam::123456789012:role/idp-harness-comprehend-role',
+    'STATE_MACHINE': 'arn:aws:states:us-east-1:123456789012:stateMachine:idp-workflow-state-machine',
+    'LAMBDA_POST_PROCESS': 'idp-process-textract-output',
+    'LAMBDA_REDACT': 'idp-phi-redact-doc',
+    'LAMBDA_REDACT_LARGE': 'idp-phi-redact-doc',
+}
+
+# Handlers writing to fixed /tmp paths
+SERIAL_FUNCTIONS = ['idp-process-textract-output']
+# On-failure destinations of the functions invoked asynchronously, as configured by the Lambda stack
+ON_FAILURE = {'idp-phi-redact-doc': 'idp-async-failure', 'idp-process-textract-output': 'idp-async-failure'}
+PHI_IN_PROGRESS = ['IN_PROGRESS', 'SUBMITTED', 'STOP_REQUESTED']
+PHI_FAILED = ['FAILED', 'STOPPED']
+STAGES = ['ocr', 'text', 'phi', 'redacted']
+
+FIRST_NAMES = ['John', 'Maria', 'Wei', 'Aisha', 'Carlos', 'Olga', 'Kenji', 'Fatima', 'Liam', 'Priya']
+LAST_NAMES = ['Smith', 'Garcia', 'Chen', 'Okafor', 'Silva', 'Ivanova', 'Tanaka', 'Haddad', 'Murphy', 'Patel']
+NOTES = ['Patient presents with mild hypertension', 'Follow up in two weeks', 'No known drug allergies',
+         'Prescribed lisinopril 10 mg daily', 'Blood panel within normal limits', 'Advised low sodium diet']
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))]
+
+def summarize(values: list) -> dict:
+    return dict(count=len(values), p50=round(percentile(values, 50), 3), p95=round(percentile(values, 95), 3),
+                p99=round(percentile(values, 99), 3), max=round(max(values), 3)) if values else dict(count=0)
+
+def parse_settings(settings: list, cast=float) -> dict:
+    """['s3=0.01', 'textract.StartDocumentAnalysis=0.2'] -> {'s3': {'*': 0.01}, 'textract': {'StartDocumentAnalysis': 0.2}}
+    """
+    parsed = collections.defaultdict(dict)
+    for setting in settings if settings else []:
+        name, value = setting.split('=')
+        service, _, operation = name.partition('.')
+        parsed[service][operation if operation else '*'] = cast(value)
+    return parsed
+
+class SyntheticDocuments:
+    """Letter size PNG pages with a patient header and visit notes. The text layout is kept in a PNG text chunk
+    so the fake Textract returns the lines actually drawn, and every PHI value is remembered for the fake
+    Comprehend Medical
+    """
+    def __init__(self, seed: int, duplicates: float):
+        self.random = random.Random(seed)
+        self.duplicates = duplicates
+        self.phi = {}
+        self.generated = []
+
+    def page(self) -> tuple:
+        from PIL import Image, ImageDraw
+        name = f"{self.random.choice(FIRST_NAMES)} {self.random.choice(LAST_NAMES)}"
+        dob = f"{self.random.randint(1, 12):02d}/{self.random.randint(1, 28):02d}/{self.random.randint(1940, 2010)}"
+        mrn = f"{self.random.randint(10000000, 99999999)}"
+        phone = f"555-{self.random.randint(100, 999)}-{self.random.randint(1000, 9999)}"
+        self.phi.update({name: 'NAME', dob: 'DATE', mrn: 'ID', phone: 'PHONE_OR_FAX'})
+        lines = [f"Patient: {name}", f"DOB: {dob}", f"MRN: {mrn}", f"Phone: {phone}"] + self.random.sample(NOTES, 3)
+
+        width, height = 1275, 1650
+        image = Image.new('L', (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        layout = []
+        for idx, text in enumerate(lines):
+            left, top, right, bottom = draw.textbbox((100, 100 + idx * 60), text)
+            draw.text((100, 100 + idx * 60), text, fill=0)
+            layout.append(dict(text=text, left=left / width, top=top / height, width=(right - left) / width, height=(bottom - top) / height))
+        return image, [layout]
+
+    def document(self) -> bytes:
+        if self.generated and self.random.random() < self.duplicates:
+            return self.random.choice(self.generated)
+        from PIL import PngImagePlugin
+        image, layout = self.page()
+        info = PngImagePlugin.PngInfo()
+        info.add_text(LAYOUT_KEY, json.dumps(layout))
+        content = io.BytesIO()
+        image.save(content, format='PNG', pnginfo=info)
+        self.generated.append(content.getvalue())
+        return content.getvalue()
+
+    @staticmethod
+    def layout(content: bytes) -> list:
+        """Pages of lines of a synthetic document, a single page without text for other documents
+        """
+        from PIL import Image
+        try:
+            return json.loads(Image.open(io.BytesIO(content)).text[LAYOUT_KEY])
+        except Exception:
+            return [[]]
+
+    def detect(self, text: str) -> list:
+        entities = []
+        for value, entity_type in self.phi.items():
+            start = text.find(value)
+            while start >= 0:
+                entities.append(dict(Id=len(entities), BeginOffset=start, EndOffset=start + len(value), Score=0.99, Text=value,
+                                     Category='PROTECTED_HEALTH_INFORMATION', Type=entity_type, Traits=[]))
+                start = text.find(value, start + len(value))
+        return entities
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.stats = fakes.CallStats()
+        self.documents = SyntheticDocuments(seed=args.seed, duplicates=args.duplicates)
+        latency, tps = parse_settings(args.latency), parse_settings(args.tps)
+
+        self.s3 = fakes.FakeS3(self.stats, latency['s3'], tps['s3'])
+        self.ddb = fakes.FakeDynamoDB(self.stats, latency['dynamodb'], tps['dynamodb'])
+        self.textract = fakes.FakeTextract(self.stats, self.s3, layout=lambda bucket, key: self.documents.layout(self.s3.objects[(bucket, key)]['Body']),
+                                           notify=self.notify, latency=latency['textract'], tps=tps['textract'],
+                                           job_seconds=args.textract_job_seconds, page_seconds=args.textract_page_seconds, max_jobs=args.textract_max_jobs)
+        self.comprehend = fakes.FakeComprehendMedical(self.stats, self.s3, detect=self.documents.detect, latency=latency['comprehendmedical'],
+                                                      tps=tps['comprehendmedical'], job_seconds=args.phi_job_seconds, max_jobs=args.phi_max_jobs)
+        self.lambda_client = fakes.FakeLambda(self.stats, invoke_async=self.invoke_async, latency=latency['lambda'], tps=tps['lambda'])
+        self.sfn = fakes.FakeStepFunctions(self.stats, start=self.start_execution, latency=latency['stepfunctions'], tps=tps['stepfunctions'])
+        self.clients = {'s3': self.s3, 'dynamodb': self.ddb, 'textract': self.textract, 'comprehendmedical': self.comprehend,
+                        'lambda': self.lambda_client, 'stepfunctions': self.sfn}
+        self.s3.listeners.append(self.s3_notification)
+
+        self.handlers = {}
+        self.limits = {}
+        self.pool = ThreadPoolExecutor(max_workers=args.workers)
+        self.lock = threading.Lock()
+        self.invocations = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.executions = {}
+        self.priorities = {}
+        self.pending = threading.Semaphore(0)
+
+    def load(self):
+        """Sets the function environment, routes the shared client pool of ClientFunctions to the fakes and imports
+        every handler
+        """
+        for name, value in ENVIRONMENT.items():
+            os.environ.setdefault(name, value)
+        os.environ['LOG_LEVEL'] = self.args.log_level
+        if self.args.pipeline_mode:
+            os.environ['PIPELINE_MODE'] = self.args.pipeline_mode
+        sys.path.insert(0, LAMBDA_DIR)
+        import ClientFunctions
+        ClientFunctions.get_client = lambda service, resource=False, config=None: self.clients[service]
+
+        for file_name in sorted(os.listdir(LAMBDA_DIR)):
+            if file_name.startswith('idp-') and file_name.endswith('.py'):
+                name = file_name[:-len('.py')]
+                spec = importlib.util.spec_from_file_location(name.replace('-', '_'), os.path.join(LAMBDA_DIR, file_name))
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                self.handlers[name] = module.lambda_handler
+                self.limits[name] = threading.Semaphore(1 if name in SERIAL_FUNCTIONS else self.args.concurrency)
+
+    def invoke(self, name: str, event: dict):
+        with self.limits[name]:
+            start = time.monotonic()
+            try:
+                return self.handlers[name](json.loads(json.dumps(event)), None)
+            except Exception:
+                with self.lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                with self.lock:
+                    self.invocations[name].append(time.monotonic() - start)
+
+    def invoke_async(self, name: str, event: dict):
+        def run():
+            try:
+                self.invoke(name, event)
+            except Exception as e:
+                logging.getLogger(__name__).error(f"{name} failed: {e}")
+                if name in ON_FAILURE:
+                    # On-failure destination of the function, retries are not replayed
+                    self.invoke(ON_FAILURE[name], {'requestContext': {'functionArn': f"arn:aws:lambda:local:0:function:{name}", 'condition': 'RetriesExhausted'},
+                                                   'requestPayload': event, 'responsePayload': {'errorMessage': str(e)}})
+        self.pool.submit(run)
+
+    def s3_notification(self, bucket: str, key: str):
+        # S3 trigger of idp-init-state-machine
+        if key.startswith('public/workflows/') and key.endswith('.json'):
+            self.invoke_async('idp-init-state-machine', {'Records': [{'s3': {'bucket': {'name': bucket}, 'object': {'key': urllib.parse.quote_plus(key)}}}]})
+
+    def notify(self, message: dict):
+        # SNS subscription of idp-init-textract-bulk to the Textract job notifications
+        self.invoke_async('idp-init-textract-bulk', {'Records': [{'Sns': {'Message': json.dumps(message)}}]})
+
+    def start_execution(self, name: str, state: dict):
+        with self.lock:
+            self.executions[state['workflow_id']] = dict(name=name, started=time.monotonic(), status='RUNNING')
+        threading.Thread(target=self.run_execution, args=(state,), daemon=True).start()
+
+    def run_execution(self, state: dict):
+        """Replays idp-workflow-state-machine, the payload of every task picks the same fields as the stack
+        """
+        workflow_id = state['workflow_id']
+        pick = lambda state, *names: {name: state.get(name) for name in names}
+        try:
+            token = self.sfn.new_token()
+            self.invoke('idp-init-textract', dict(token=token, workflow_id=workflow_id, bucket=state['bucket']))
+            output = self.sfn.wait_for_token(token, timeout=self.args.task_timeout)
+            if output is None:
+                raise TimeoutError('Textract callback task timed out')
+            state = self.invoke('idp-update-wf-status', pick(output['Payload'], 'workflow_id', 'bucket', 'tmp_process_dir', 'phi_input_dir'))
+            if state.get('de_identify') is True:
+                state = self.invoke('idp-init-phi-detection', dict(pick(state, 'workflow_id', 'bucket', 'de_identify', 'phi_input_dir'),
+                                                                   execution=self.executions[workflow_id]['name']))
+                if 'error' in state:
+                    raise RuntimeError('PHIJobLaunchFailure')
+                while True:
+                    state = self.invoke('idp-phi-job-status-check', pick(state, 'workflow_id', 'phi_job_id', 'phi_job_ids', 'phi_output_dir', 'bucket'))
+                    if state['status'] in PHI_FAILED:
+                        raise RuntimeError('PHIJobFailure')
+                    if state['status'] not in PHI_IN_PROGRESS:
+                        break
+                state = self.invoke('idp-process-phi-output', pick(state, 'bucket', 'workflow_id', 'phi_output_dir'))
+                if 'error' in state:
+                    raise RuntimeError('PhiPostProcessFail')
+
+                def branch(doc_prefixes):
+                    prepared = self.invoke('idp-prep-doc-for-redaction', dict(pick(state, 'bucket', 'workflow_id', 'retain_docs', 'encoding_profile'), doc_prefixes=doc_prefixes))
+                    redacted = self.invoke('idp-phi-redact-doc', pick(prepared, 'bucket', 'workflow_id', 'retain_docs', 'encoding_profile', 'redact_data'))
+                    if redacted.get('deferred'):
+                        # The larger memory variant runs the same handler
+                        self.invoke('idp-phi-redact-doc', dict(pick(prepared, 'bucket', 'workflow_id', 'retain_docs', 'encoding_profile'), redact_data=redacted['deferred']))
+                with ThreadPoolExecutor(max_workers=40) as executor:
+                    list(executor.map(branch, state['doc_list']))
+
+                self.invoke('idp-write-wf-summary', pick(state, 'bucket', 'workflow_id'))
+                self.ddb.update_item(TableName=os.environ['IDP_TABLE'], Key={'part_key': {'S': workflow_id}, 'sort_key': {'S': state['input_prefix']}},
+                                     UpdateExpression='SET de_identification_status = :status', ExpressionAttributeValues={':status': {'S': 'processed'}})
+            status = 'SUCCEEDED'
+        except Exception as e:
+            logging.getLogger(__name__).error(f"Execution of workflow {workflow_id} failed: {e}")
+            status = 'FAILED'
+        with self.lock:
+            self.executions[workflow_id].update(status=status, duration=time.monotonic() - self.executions[workflow_id]['started'])
+        self.pending.release()
+
+    def submit(self, index: int, documents: int, priority: str = None):
+        """Uploads the documents and the workflow JSON of a workflow the way the web app does
+        """
+        workflow_id = f"harness-{index:05d}-{random.Random(index).getrandbits(32):08x}"
+        self.priorities[workflow_id] = priority if priority else 'standard'
+        names = [f"wf{index:05d}-doc{idx:03d}.png" for idx in range(documents)]
+        for name in names:
+            self.s3._put(BUCKET, f"public/input/{workflow_id}/{name}", self.documents.document(), content_type='image/png')
+        workflow = [{'S': workflow_id}, {'S': f"input/{workflow_id}/"}, {'S': 'processing'}, {'M': {name: {'S': 'ready'} for name in names}},
+                    {'N': str(int(time.time() * 1000))}, {'N': str(len(names))}, {'BOOL': True}, {'BOOL': self.args.retain_docs}, {'S': 'processing'}]
+        # Optional trailing fields, positional like the web app writes them
+        optional = [self.args.encoding_profile, priority, self.args.textract_profile]
+        defaults = ['auto', 'standard', 'analysis']
+        provided = max([idx + 1 for idx, value in enumerate(optional) if value], default=0)
+        workflow += [{'S': value if value else default} for value, default in zip(optional[:provided], defaults)]
+        self.s3._put(BUCKET, f"public/workflows/{workflow_id}.json", json.dumps(workflow).encode('utf-8'))
+
+    def run(self) -> dict:
+        self.load()
+        metrics = collections.Counter()
+        sink = MetricSink(metrics)
+        start = time.monotonic()
+        with contextlib.redirect_stdout(sink):
+            for index in range(self.args.workflows + self.args.urgent_workflows):
+                if index < self.args.workflows:
+                    self.submit(index, self.args.documents, self.args.priority)
+                else:
+                    self.submit(index, self.args.urgent_documents, 'urgent')
+                if self.args.rate:
+                    time.sleep(1 / self.args.rate)
+            finished = 0
+            while finished < self.args.workflows + self.args.urgent_workflows and self.pending.acquire(timeout=max(0, self.args.timeout - (time.monotonic() - start))):
+                finished += 1
+        elapsed = time.monotonic() - start
+        self.pool.shutdown(wait=False)
+        return self.report(elapsed, metrics)
+
+    def report(self, elapsed: float, metrics: collections.Counter) -> dict:
+        table = os.environ['IDP_TABLE']
+        headers = {key[1]: item for key, item in self.ddb.items.items() if key[0] == table and key[2].startswith('input/')}
+        stage_latency = collections.defaultdict(list)
+        redacted = 0
+        for (item_table, workflow_id, sort_key), item in list(self.ddb.items.items()):
+            if item_table != table or not sort_key.startswith('doc/') or workflow_id not in headers:
+                continue
+            submitted = float(headers[workflow_id]['submit_ts']['N'])
+            for stage in STAGES:
+                if f"stage_{stage}" in item:
+                    stage_latency[stage].append((float(item[f"stage_{stage}"]['N']) - submitted) / 1000)
+            redacted += 1 if 'stage_redacted' in item else 0
+
+        workflows = self.args.workflows + self.args.urgent_workflows
+        documents = self.args.workflows * self.args.documents + self.args.urgent_workflows * self.args.urgent_documents
+        executions = list(self.executions.values())
+        by_priority = collections.defaultdict(list)
+        for workflow_id, execution in list(self.executions.items()):
+            if 'duration' in execution:
+                by_priority[self.priorities.get(workflow_id)].append(execution['duration'])
+        queued = [item for key, item in list(self.ddb.items.items()) if key[0] == table and key[1] == 'scheduler#active']
+        return dict(
+            workflows=workflows,
+            documents=documents,
+            redacted_documents=redacted,
+            succeeded_workflows=len([execution for execution in executions if execution['status'] == 'SUCCEEDED']),
+            failed_workflows=len([execution for execution in executions if execution['status'] == 'FAILED']),
+            unfinished_workflows=workflows - len([execution for execution in executions if execution['status'] != 'RUNNING']),
+            queued_documents=sum([int(float(item.get('queued', {'N': '0'})['N'])) for item in queued]),
+            elapsed_seconds=round(elapsed, 2),
+            documents_per_minute=round(redacted / elapsed * 60, 1) if elapsed else None,
+            workflow_seconds=summarize([execution['duration'] for execution in executions if 'duration' in execution]),
+            workflow_seconds_by_priority={priority: summarize(durations) for priority, durations in sorted(by_priority.items())},
+            stage_seconds_since_submit={stage: summarize(stage_latency[stage]) for stage in STAGES},
+            invocation_seconds={name: summarize(durations) for name, durations in sorted(self.invocations.items())},
+            invocation_errors=dict(self.errors),
+            textract_job_seconds=summarize(self.textract.job_times),
+            peak_jobs=dict(textract=self.textract.jobs.peak, comprehendmedical=self.comprehend.jobs.peak),
+            api_calls=dict(sorted(self.stats.calls.items())),
+            api_calls_per_document={name: round(count / documents, 2) for name, count in sorted(self.stats.calls.items())},
+            api_calls_per_document_total=round(self.stats.total() / documents, 2),
+            throttles=dict(self.stats.throttles),
+            metrics=dict(metrics),
+        )
+
+class MetricSink(io.TextIOBase):
+    """Swallows what the handlers print and counts the embedded metric format records by metric name
+    """
+    def __init__(self, metrics: collections.Counter):
+        self.metrics = metrics
+
+    def write(self, text: str) -> int:
+        for line in text.splitlines():
+            if line.startswith('{"_aws"'):
+                record = json.loads(line)
+                for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                    self.metrics[metric['Name']] += record[metric['Name']]
+        return len(text)
+
+def print_report(report: dict):
+    print(f"{report['workflows']} workflows, {report['documents']} documents in {report['elapsed_seconds']}s: "
+          f"{report['documents_per_minute']} documents/minute, {report['redacted_documents']} redacted, "
+          f"{report['succeeded_workflows']} workflows succeeded, {report['failed_workflows']} failed, {report['unfinished_workflows']} unfinished "
+          f"({report['queued_documents']} documents left in the queue)")
+    print(f"\n{'latency (s)':<40}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    rows = [('workflow', report['workflow_seconds'])]
+    if len(report['workflow_seconds_by_priority']) > 1:
+        rows += [(f"workflow ({priority})", latency) for priority, latency in report['workflow_seconds_by_priority'].items()]
+    rows += [('textract job', report['textract_job_seconds'])]
+    rows += [(f"document {stage} since submit", latency) for stage, latency in report['stage_seconds_since_submit'].items()]
+    rows += [(name, latency) for name, latency in report['invocation_seconds'].items()]
+    for name, latency in rows:
+        if latency['count']:
+            print(f"{name:<40}{latency['count']:>8}{latency['p50']:>10}{latency['p95']:>10}{latency['p99']:>10}{latency['max']:>10}")
+    print(f"\n{'API calls':<48}{'total':>8}{'per doc':>10}{'throttled':>10}")
+    for name, count in report['api_calls'].items():
+        print(f"{name:<48}{count:>8}{report['api_calls_per_document'][name]:>10}{report['throttles'].get(name, 0):>10}")
+    print(f"{'all':<48}{sum(report['api_calls'].values()):>8}{report['api_calls_per_document_total']:>10}")
+    if report['invocation_errors']:
+        print(f"\nInvocation errors: {report['invocation_errors']}")
+    if report['metrics']:
+        print(f"Metrics: {report['metrics']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process end-to-end run of the IDP de-identification pipeline against local fakes')
+    parser.add_argument('--workflows', type=int, default=5, help='synthetic workflows to submit')
+    parser.add_argument('--documents', type=int, default=5, help='documents per workflow')
+    parser.add_argument('--duplicates', type=float, default=0, help='fraction of documents re-using the content of an earlier document (exercises the cache)')
+    parser.add_argument('--rate', type=float, default=0, help='workflows submitted per second (default: all at once)')
+    parser.add_argument('--retain-docs', action='store_true', help='keep the original documents after redaction')
+    parser.add_argument('--priority', help='priority class of the workflows, e.g. bulk (default: standard)')
+    parser.add_argument('--urgent-workflows', type=int, default=0, help='urgent workflows submitted after the others')
+    parser.add_argument('--urgent-documents', type=int, default=5, help='documents per urgent workflow')
+    parser.add_argument('--pipeline-mode', help='staged (default) or streaming: each document is redacted as soon as its text is processed')
+    parser.add_argument('--textract-profile', help='Textract processing profile of the workflows: analysis or ocr (text detection only)')
+    parser.add_argument('--encoding-profile', help='encoding profile of the redacted documents, e.g. bilevel or photo:60')
+    parser.add_argument('--latency', action='append', help='SERVICE[.Operation]=SECONDS added to every call, e.g. s3=0.01')
+    parser.add_argument('--tps', action='append', help='SERVICE.Operation=CALLS per second before the call is throttled')
+    parser.add_argument('--textract-job-seconds', type=float, default=2.0, help='duration of a Textract job')
+    parser.add_argument('--textract-page-seconds', type=float, default=0.1, help='additional duration of a Textract job per page')
+    parser.add_argument('--textract-max-jobs', type=int, default=100, help='concurrent Textract job quota')
+    parser.add_argument('--phi-job-seconds', type=float, default=3.0, help='duration of a Comprehend Medical PHI detection job')
+    parser.add_argument('--phi-max-jobs', type=int, default=10, help='concurrent Comprehend Medical job quota')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent invocations per function')
+    parser.add_argument('--workers', type=int, default=32, help='threads running asynchronous invocations')
+    parser.add_argument('--task-timeout', type=float, default=600, help='seconds the state machine waits for the Textract callback')
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds to wait for every workflow to finish')
+    parser.add_argument('--seed', type=int, default=7, help='seed of the synthetic documents')
+    parser.add_argument('--log-level', default='ERROR', help='LOG_LEVEL of the handlers')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level, stream=sys.stderr)
+    report = Pipeline(args).run()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Compares the PDF rasterizer backends of src/lambda/RasterFunctions.py on the same corpus: render time per page,
+how many pages a backend renders to a different pixel size than page_pixels (they are resized), and where the
+content lands on the final pages compared to the first backend: the ink bounding box of every page (pixels darker
+than INK_LEVEL) is compared edge by edge, a redaction box drawn from the Textract geometry covers the same content
+with every backend whose offset stays within PLACEMENT_TOLERANCE_PX. Pages are rendered
+at the DPI the redaction Lambda would choose without boxes (RASTER_MIN_DPI) unless --dpi is given. Without
+--corpus, synthetic text PDFs are generated, e.g.
+
+    python tools/raster_benchmark.py --corpus ~/pdfs --runs 3
+    python tools/raster_benchmark.py --generate 20 --pages 5 --dpi 150 --dpi 300
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'lambda')
+sys.path.insert(0, LAMBDA_DIR)
+from RasterFunctions import RASTERIZERS, RASTER_MIN_DPI, available, page_pixels
+
+INK_LEVEL = 128
+PLACEMENT_TOLERANCE_PX = 1
+
+def ink_box(image) -> tuple:
+    """(left, top, right, bottom) of the pixels darker than INK_LEVEL, None for a blank page
+    """
+    return image.convert('L').point(lambda value: 255 if value < INK_LEVEL else 0).getbbox()
+
+def placement_offset(boxes: list, reference: list) -> float:
+    """Largest distance in pixels between the ink box edges of the pages of two backends, inf when a page is
+    blank with one backend only
+    """
+    offset = 0
+    for box, reference_box in zip(boxes, reference):
+        if box is None or reference_box is None:
+            offset = offset if box == reference_box else float('inf')
+            continue
+        offset = max([offset] + [abs(edge - reference_edge) for edge, reference_edge in zip(box, reference_box)])
+    return offset
+
+def synthetic_pdf(path: str, pages: int, lines: int = 40):
+    """Writes a letter size PDF of pages of Helvetica text
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in range(pages):
+        text = "".join([f"BT /F1 10 Tf 72 {720 - line * 16} Td (Page {page + 1} line {line + 1} Patient record text sample 0123456789) Tj ET\n" for line in range(lines)])
+        objects.append(f"<< /Length {len(text)} >>\nstream\n{text}endstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    content, offsets = "%PDF-1.4\n", []
+    for idx, obj in enumerate(objects, start=1):
+        offsets.append(len(content))
+        content += f"{idx} 0 obj\n{obj}\nendobj\n"
+    xref = len(content)
+    content += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join([f"{offset:010d} 00000 n \n" for offset in offsets])
+    content += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, 'w', encoding='latin-1') as pdf_file:
+        pdf_file.write(content)
+
+def benchmark(name: str, paths: list, dpi: int, runs: int) -> dict:
+    rasterizer = RASTERIZERS[name]()
+    samples, sizes, pages = [], {}, 0
+    for path in paths:
+        page_sizes = rasterizer.page_sizes(path)
+        pages += len(page_sizes)
+        for _ in range(runs):
+            start = time.perf_counter()
+            images = rasterizer.render(path, dpi=dpi, page_sizes=page_sizes)
+            samples.append((time.perf_counter() - start) / max(len(images), 1))
+        # Sizes before the rasterizer resizes them to page_pixels, to show how often the backend rounds differently
+        sizes[path] = dict(expected=[page_pixels(size, dpi) for size in page_sizes], rendered=[image.size for image in rasterizer.render_pages(path, dpi)],
+                           final=[image.size for image in images], ink=[ink_box(image) for image in images])
+    return dict(pages=pages, ms_per_page=round(statistics.median(samples) * 1000, 2), max_ms_per_page=round(max(samples) * 1000, 2),
+                sizes=sizes)
+
+def main():
+    parser = argparse.ArgumentParser(description='Render time and page size agreement of the PDF rasterizer backends')
+    parser.add_argument('--corpus', help='directory of PDF files')
+    parser.add_argument('--generate', type=int, default=10, help='synthetic PDFs to generate without --corpus')
+    parser.add_argument('--pages', type=int, default=3, help='pages per synthetic PDF')
+    parser.add_argument('--dpi', type=int, action='append', help=f'DPI to render at (default: {RASTER_MIN_DPI})')
+    parser.add_argument('--runs', type=int, default=3, help='renders of every file per backend')
+    parser.add_argument('--backend', action='append', help='backend to compare (default: every available backend)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.corpus:
+            paths = sorted(glob.glob(os.path.join(args.corpus, '*.pdf')))
+        else:
+            paths = [os.path.join(tmp_dir, f"synthetic-{idx:03d}.pdf") for idx in range(args.generate)]
+            for path in paths:
+                synthetic_pdf(path, pages=args.pages)
+
+        backends = [name for name in (args.backend if args.backend else RASTERIZERS.keys()) if available(name)]
+        results = {}
+        for dpi in args.dpi if args.dpi else [RASTER_MIN_DPI]:
+            results[dpi] = {name: benchmark(name, paths, dpi, args.runs) for name in backends}
+            # The first backend is the reference of the placement
+            reference = results[dpi][backends[0]]['sizes'] if backends else {}
+            for name, result in results[dpi].items():
+                sizes = result['sizes']
+                result['resized_pages'] = sum([len([1 for expected, rendered in zip(size['expected'], size['rendered']) if expected != rendered]) for size in sizes.values()])
+                result['max_offset_px'] = max([placement_offset(size['ink'], reference[path]['ink']) for path, size in sizes.items()], default=0)
+                result['identical_placement'] = (all([size['final'] == size['expected'] for size in sizes.values()])
+                                                 and result['max_offset_px'] <= PLACEMENT_TOLERANCE_PX)
+            for result in results[dpi].values():
+                result.pop('sizes')
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{len(paths)} files, backends: {', '.join(backends)}, placement compared to {backends[0] if backends else None}")
+    for dpi, by_backend in results.items():
+        fastest = min([result['ms_per_page'] for result in by_backend.values()])
+        print(f"\n{dpi} DPI")
+        print(f"{'backend':<14}{'pages':>8}{'ms/page':>10}{'max ms':>10}{'vs fastest':>12}{'resized':>10}{'offset px':>11}{'identical boxes':>18}")
+        for name, result in by_backend.items():
+            print(f"{name:<14}{result['pages']:>8}{result['ms_per_page']:>10}{result['max_ms_per_page']:>10}"
+                  f"{round(result['ms_per_page'] / fastest, 2) if fastest else '':>12}{result['resized_pages']:>10}{result['max_offset_px']:>11}{str(result['identical_placement']):>18}")
+
+if __name__ == '__main__':
+    main()
@@ -7,20 +7,13 @@ SPDX-License-Identifier: MIT-0
  * Maintains state at app level via react-query using query caching
  */
 
- import { useQuery } from "@tanstack/react-query";
+ import { useQuery, useQueryClient } from "@tanstack/react-query";
  import {Auth, Signer} from 'aws-amplify';
  
- const getWorkflows = async (modality,token) => {  
+ const getWorkflows = async (modality,token,onUpdate) => {  
     // console.log(`Hook: ${token['startDt']},${token['endDt']}`)  
     let ocrdata = [], phidata = {}, workflows;    
     const essentialCred = Auth.essentialCredentials(await Auth.currentCredentials());                
-    const params = { 
-                    method: "GET", 
-                    url: (modality === "all")
-                        ? `${window.authdata['FunctionUrls']['idpGetWfFunctionUrl']}?fetch=${modality}&startdt=${token['startDt']}&enddt=${token['endDt']}`
-                        : `${window.authdata['FunctionUrls']['idpGetWfFunctionUrl']}?fetch=${modality}`
-                    };
-
     const credentials = {
         secret_key: essentialCred.secretAccessKey,
         access_key: essentialCred.accessKeyId,
@@ -28,9 +21,16 @@ SPDX-License-Identifier: MIT-0
     };  
     // set your region and service here. service should be "lambda"
     const serviceInfo = {region: window.authdata["Auth"]["region"], service: "lambda"};// Signer.sign takes care of all other steps of Signature V4
-    const signedReq = Signer.sign(params, credentials, serviceInfo);
-    
-    try {
+
+    const fetchPage = async (cursors = {}) => {
+        const query = Object.entries(cursors).filter(([, value]) => value).map(([name, value]) => `&${name}=${encodeURIComponent(value)}`).join('');
+        const params = { 
+                        method: "GET", 
+                        url: (modality === "all")
+                            ? `${window.authdata['FunctionUrls']['idpGetWfFunctionUrl']}?fetch=${modality}&startdt=${token['startDt']}&enddt=${token['endDt']}${query}`
+                            : `${window.authdata['FunctionUrls']['idpGetWfFunctionUrl']}?fetch=${modality}${query}`
+                        };
+        const signedReq = Signer.sign(params, credentials, serviceInfo);
         const response = await fetch(`${signedReq.url}`, {
             method: "GET",
             mode: "cors",
@@ -41,35 +41,16 @@ SPDX-License-Identifier: MIT-0
             },
             referrer: "client",            
         });
-        const content = await response.json();
-        // console.log(content['data'])
-        if (response.ok) {   
-            if(modality !== "all"){                        
-                // data['data'] = data['data']['documents']
-                ocrdata = content['data']['documents']
-                if(content['data']['de_identification_status'] === "processed"){
-                    phidata = { 
-                        de_identification_status: content['data']['de_identification_status'],
-                        de_identify: content['data']['de_identify'],
-                        retain_orig_docs: content['data']['retain_orig_docs'],
-                        status: content['data']['phi_manifest']['Summary']['Status'],
-                        totalFiles: content['data']['phi_manifest']['Summary']['InputFileCount'],
-                        successfulFilesCount: content['data']['phi_manifest']['Summary']['SuccessfulFilesCount'],
-                        failedFilesCount: content['data']['phi_manifest']['Summary']['UnprocessedFilesCount'],
-                        documents: content['data']['redacted_documents']
-                    }
-                }else{
-                    phidata = { 
-                        de_identification_status: content['data']['de_identification_status'],
-                        de_identify: content['data']['de_identify'],
-                        retain_orig_docs: content['data']['retain_orig_docs']
-                    }
-                }            
-            }else{            
-                workflows = content['data'].sort((a,b) => b.submit_ts - a.submit_ts)            
-            }                    
-            // ocrdata = data['data'];
-        } 
+        return { response, content: await response.json() };
+    };
+    
+    try {
+        const { response, content } = await fetchPage();
+        if (response.ok) {
+            // The first page is rendered right away, the remaining pages are fetched in the background
+            fetchRest(modality, content, fetchPage, onUpdate);
+            return toResult(modality, content);
+        }
     } catch (error) {
         console.log(error);
         throw error;
@@ -77,9 +58,76 @@ SPDX-License-Identifier: MIT-0
 
     return { "ocr_data": ocrdata, "phi_data": phidata, "workflows": workflows };
  };
+
+ const toResult = (modality, content) => {
+    let ocrdata = [], phidata = {}, workflows;
+    if(modality !== "all"){                        
+        // data['data'] = data['data']['documents']
+        ocrdata = content['data']['documents']
+        if(content['data']['de_identification_status'] === "processed"){
+            phidata = { 
+                de_identification_status: content['data']['de_identification_status'],
+                de_identify: content['data']['de_identify'],
+                retain_orig_docs: content['data']['retain_orig_docs'],
+                status: content['data']['phi_manifest']['Summary']['Status'],
+                totalFiles: content['data']['phi_manifest']['Summary']['InputFileCount'],
+                successfulFilesCount: content['data']['phi_manifest']['Summary']['SuccessfulFilesCount'],
+                failedFilesCount: content['data']['phi_manifest']['Summary']['UnprocessedFilesCount'],
+                documents: content['data']['redacted_documents']
+            }
+        }else{
+            phidata = { 
+                de_identification_status: content['data']['de_identification_status'],
+                de_identify: content['data']['de_identify'],
+                retain_orig_docs: content['data']['retain_orig_docs']
+            }
+        }            
+    }else{            
+        workflows = [...content['data']].sort((a,b) => b.submit_ts - a.submit_ts)            
+    }                    
+    return { "ocr_data": ocrdata, "phi_data": phidata, "workflows": workflows };
+ };
+
+ const fetchRest = async (modality, content, fetchPage, onUpdate) => {
+    try {
+        if (modality === "all") {
+            // The workflow listing is paginated, follow the cursor until the date range is exhausted
+            let nextKey = content['nextKey'];
+            while (nextKey) {
+                const page = await fetchPage({ cursor: nextKey });
+                if (!page.response.ok) break;
+                content = { ...content, data: content['data'].concat(page.content['data']) };
+                nextKey = page.content['nextKey'];
+                onUpdate(toResult(modality, content));
+            }
+        } else {
+            // Workflow documents and redacted documents are paginated, follow both cursors. Pages only hold the
+            // lists they continue
+            let cursors = { documents_cursor: content['nextDocumentsKey'], redacted_documents_cursor: content['nextRedactedKey'] };
+            while (cursors.documents_cursor || cursors.redacted_documents_cursor) {
+                const page = await fetchPage(cursors);
+                if (!page.response.ok) break;
+                const data = { ...content['data'] };
+                if (cursors.documents_cursor) {
+                    data['documents'] = data['documents'].concat(page.content['data']['documents'] || []);
+                }
+                if (cursors.redacted_documents_cursor) {
+                    data['redacted_documents'] = data['redacted_documents'].concat(page.content['data']['redacted_documents'] || []);
+                }
+                content = { ...content, data };
+                cursors = { documents_cursor: page.content['nextDocumentsKey'], redacted_documents_cursor: page.content['nextRedactedKey'] };
+                onUpdate(toResult(modality, content));
+            }
+        }
+    } catch (error) {
+        console.log(error);
+    }
+ };
  
  export function useWorkflows(querykey, modality, token=undefined) {  
-   return useQuery([querykey, modality, token], () => getWorkflows(modality, token), {
+   const queryClient = useQueryClient();
+   const key = [querykey, modality, token];
+   return useQuery(key, () => getWorkflows(modality, token, (result) => queryClient.setQueryData(key, result)), {
      refetchOnWindowFocus: false, //(modality === "all")?true:false,
      refetchInterval: (modality === "all")? 15000:undefined,
      cacheTime: 0
@@ -17,6 +17,7 @@ import {
   Notification, 
   useToaster,
   Progress,
+  SelectPicker,
   Checkbox } from 'rsuite';
 import { v4 as uuidv4 } from 'uuid';
 import { Link } from 'react-router-dom';
@@ -40,6 +41,28 @@ import './styles.less';
  */
 const { scrollTop } = DOMHelper;
 
+// Encoding of the redacted documents, see EncodingFunctions.py of the redaction function
+const encodingProfiles = [
+  {label: 'Automatic (from the document colors)', value: 'auto'},
+  {label: 'Black and white (scanned text, faxes)', value: 'bilevel'},
+  {label: 'Grayscale', value: 'grayscale'},
+  {label: 'Color photo', value: 'photo'},
+  {label: 'Original encoding', value: 'original'}
+];
+
+// Share of the Textract submissions the workflow gets next to the other workflows, see SchedulerFunctions.py
+const priorities = [
+  {label: 'Urgent', value: 'urgent'},
+  {label: 'Standard', value: 'standard'},
+  {label: 'Bulk (backfill)', value: 'bulk'}
+];
+
+// Textract processing of the documents, see TextractFunctions.py of the Textract functions
+const textractProfiles = [
+  {label: 'Text, forms and tables', value: 'analysis'},
+  {label: 'Text only (faster, no forms and tables report)', value: 'ocr'}
+];
+
 const ProcessDocs = ({ endToend=false }) => {
   const [filesToUpload, setfilesToUpload] = useState([]);
   const [manifestFile, setmanifestFile] = useState([])
@@ -49,6 +72,9 @@ const ProcessDocs = ({ endToend=false }) => {
   const [activeUploadingFile, setactiveUploadingFile] = useState("");
   const [deIdentify, setdeIdentify] = useState(false)
   const [retain, setretain] = useState(false)
+  const [encodingProfile, setencodingProfile] = useState('auto')
+  const [priority, setpriority] = useState('standard')
+  const [textractProfile, settextractProfile] = useState('analysis')
   const toaster = useToaster();
   const storage = new StorageService(); 
 
@@ -126,6 +152,9 @@ const ProcessDocs = ({ endToend=false }) => {
     workflow.push({'BOOL': deIdentify});
     workflow.push({'BOOL': retain});
     workflow.push({'S': (deIdentify)?'processing':'not_requested'})
+    workflow.push({'S': encodingProfile});
+    workflow.push({'S': priority});
+    workflow.push({'S': textractProfile});
     return workflow;
   }
 
@@ -147,6 +176,9 @@ const ProcessDocs = ({ endToend=false }) => {
       await storage.writeFile(JSON.stringify(wf),`workflows/${prefix}.json`);
       setdeIdentify(false);
       setretain(false);
+      setencodingProfile('auto');
+      setpriority('standard');
+      settextractProfile('analysis');
       toaster.push(fileUploaded, {placement: 'topEnd'});  
     } catch (error) {      
         setisUploading(false);
@@ -249,6 +281,14 @@ const ProcessDocs = ({ endToend=false }) => {
             De-dientify documents <br/>
             <span style={{fontSize: '12px', color:'gray'}}>When checked, any PHI detected in the documents will be redacted.</span>
           </Checkbox>
+          <div style={{marginTop:'8px', marginBottom: '8px'}}>
+            <span style={{fontSize: '12px', color:'gray'}}>Priority of the workflow</span><br/>
+            <SelectPicker data={priorities} value={priority} onChange={(val) => setpriority(val? val:'standard')} cleanable={false} searchable={false} style={{width: 300}}/>
+          </div>
+          <div style={{marginTop:'8px', marginBottom: '8px'}}>
+            <span style={{fontSize: '12px', color:'gray'}}>Document analysis</span><br/>
+            <SelectPicker data={textractProfiles} value={textractProfile} onChange={(val) => settextractProfile(val? val:'analysis')} cleanable={false} searchable={false} style={{width: 300}}/>
+          </div>
 
           {
             (deIdentify)&&
@@ -257,6 +297,10 @@ const ProcessDocs = ({ endToend=false }) => {
                 Retain original documents <br/>
                 <span style={{fontSize: '12px', color:'gray'}}>When checked, original copies of the documents will be retained else deleted.</span>
               </Checkbox>
+              <div style={{marginTop:'8px', marginBottom: '8px'}}>
+                <span style={{fontSize: '12px', color:'gray'}}>Encoding of the redacted documents</span><br/>
+                <SelectPicker data={encodingProfiles} value={encodingProfile} onChange={(val) => setencodingProfile(val? val:'auto')} cleanable={false} searchable={false} style={{width: 300}}/>
+              </div>
             </div>
           }
         </div>